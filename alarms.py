@@ -0,0 +1,221 @@
+import argparse
+import json
+import logging
+import numpy as np
+import time
+from datetime import datetime, timezone
+from fleet import VARIABLES, FridgeInfo
+from typing import Dict, List, Optional
+
+_logger = logging.getLogger(__name__)
+
+ABOVE, BELOW, RATE = 0, 1, 2
+KINDS = {"above": ABOVE, "below": BELOW, "rate": RATE}
+
+# The dataset is in SI units: temperatures in K, pressures in MPa
+DEFAULT_RULES = [
+    {"name": "CellTooWarm", "variable": "tempC1", "kind": "above", "limit": 281.15, "duration": 60, "severity": "major"},
+    {"name": "CellTooWarm", "variable": "tempC2", "kind": "above", "limit": 281.15, "duration": 60, "severity": "major"},
+    {"name": "CellTooWarm", "variable": "tempC3", "kind": "above", "limit": 281.15, "duration": 60, "severity": "major"},
+    {"name": "CellFreezing", "variable": "tempC1", "kind": "below", "limit": 268.15, "duration": 60, "severity": "minor"},
+    {"name": "CellFreezing", "variable": "tempC2", "kind": "below", "limit": 268.15, "duration": 60, "severity": "minor"},
+    {"name": "CellFreezing", "variable": "tempC3", "kind": "below", "limit": 268.15, "duration": 60, "severity": "minor"},
+    {"name": "CellWarmingFast", "variable": "tempC1", "kind": "rate", "limit": 0.05, "duration": 30, "severity": "minor"},
+    {"name": "CellWarmingFast", "variable": "tempC2", "kind": "rate", "limit": 0.05, "duration": 30, "severity": "minor"},
+    {"name": "CellWarmingFast", "variable": "tempC3", "kind": "rate", "limit": 0.05, "duration": 30, "severity": "minor"},
+    {"name": "HighDischargePressure", "variable": "compOutPres", "kind": "above", "limit": 1.6, "duration": 10,
+     "severity": "major"},
+    {"name": "HighDischargeTemperature", "variable": "compOutTemp", "kind": "above", "limit": 373.15, "duration": 10,
+     "severity": "major"},
+    {"name": "LowSuctionPressure", "variable": "evapOutPres", "kind": "below", "limit": 0.05, "duration": 30,
+     "severity": "minor"},
+]
+
+
+class Rule:
+    """A condition on one variable: above or below a limit, or changing faster than limit per second.
+
+    The alarm is raised when the condition has held for `duration` seconds and cleared as soon as it stops.
+    """
+    def __init__(self, name: str, variable: str, kind: str, limit: float, duration: float = 0.0,
+                 severity: str = "warning"):
+        if variable not in VARIABLES:
+            raise ValueError(f"Unknown variable {variable} in rule {name}")
+        if kind not in KINDS:
+            raise ValueError(f"Unknown kind {kind} in rule {name}, use one of {', '.join(KINDS)}")
+        self.name = name
+        self.variable = variable
+        self.kind = kind
+        self.limit = float(limit)
+        self.duration = float(duration)
+        self.severity = severity
+
+    @classmethod
+    def from_dict(cls, rule: Dict) -> "Rule":
+        return cls(rule["name"], rule["variable"], rule["kind"], rule["limit"], rule.get("duration", 0.0),
+                   rule.get("severity", "warning"))
+
+
+def load_rules(filename: Optional[str] = None) -> List[Rule]:
+    """Rules from a JSON file holding a list of rules, or the default ones"""
+    if filename is None:
+        return [Rule.from_dict(rule) for rule in DEFAULT_RULES]
+    with open(filename) as f:
+        return [Rule.from_dict(rule) for rule in json.load(f)]
+
+
+class AlarmEngine:
+    """Evaluates all the rules on all the fridges at once, from the [fridge, variable] tables of the live values.
+
+    Every state is an array with one cell per (fridge, rule): an evaluation is a handful of array operations
+    whatever the number of fridges, and Python only loops over the alarms that change state.
+    """
+    def __init__(self, fridges: List[FridgeInfo], rules: List[Rule], variables=VARIABLES):
+        self.fridges = list(fridges)
+        self.rules = list(rules)
+        self.variables = tuple(variables)
+        n_fridges, n_rules, n_variables = len(self.fridges), len(self.rules), len(self.variables)
+
+        self.cols = np.array([self.variables.index(rule.variable) for rule in self.rules], dtype=np.int64)
+        self.kinds = np.array([KINDS[rule.kind] for rule in self.rules], dtype=np.int64)
+        self.limits = np.array([rule.limit for rule in self.rules])
+        self.durations = np.array([rule.duration for rule in self.rules])
+        self.rules_of = [np.flatnonzero(self.cols == col).tolist() for col in range(n_variables)]
+
+        # Rate of change of every variable, updated where a new sample arrived
+        self.last_values = np.full((n_fridges, n_variables), np.nan)
+        self.last_times = np.full((n_fridges, n_variables), np.nan)
+        self.rates = np.full((n_fridges, n_variables), np.nan)
+
+        self.since = np.full((n_fridges, n_rules), np.nan)  # when the condition became true, NaN when false
+        self.active = np.zeros((n_fridges, n_rules), dtype=bool)
+        self.activated_at = np.full((n_fridges, n_rules), np.nan)
+        self.evaluations = 0
+
+    def evaluate(self, values: np.ndarray, times: np.ndarray, now: Optional[float] = None) -> List[Dict]:
+        """Updates the alarms from the latest values and their source timestamps; returns the raised and cleared ones"""
+        now = time.time() if now is None else now
+
+        changed = times != self.last_times  # NaN != NaN, but the NaN cells are not used below
+        with np.errstate(invalid="ignore", divide="ignore"):
+            rates = (values - self.last_values) / (times - self.last_times)
+        update = changed & ~np.isnan(rates)
+        self.rates[update] = rates[update]
+        self.last_values[changed] = values[changed]
+        self.last_times[changed] = times[changed]
+
+        x = np.where(self.kinds == RATE, self.rates[:, self.cols], values[:, self.cols])
+        with np.errstate(invalid="ignore"):
+            condition = np.where(self.kinds == BELOW, x < self.limits, x > self.limits)  # NaN compares False
+        self.since = np.where(condition, np.where(np.isnan(self.since), now, self.since), np.nan)
+        should = condition & (now - self.since >= self.durations)
+
+        raised = should & ~self.active
+        cleared = self.active & ~should
+        self.activated_at[raised] = now
+        events = [self._event(row, rule, "raised", values, now) for row, rule in zip(*np.nonzero(raised))]
+        events += [self._event(row, rule, "cleared", values, now) for row, rule in zip(*np.nonzero(cleared))]
+        self.active = should
+        self.activated_at[cleared] = np.nan
+        self.evaluations += 1
+        return events
+
+    def update(self, row: int, col: int, value: float, timestamp: float, now: Optional[float] = None) -> List[Dict]:
+        """Same as evaluate() for a single new sample of one fridge variable, so that every sample is seen and
+        durations start when it arrives; returns the raised and cleared alarms"""
+        now = time.time() if now is None else now
+        last_time = self.last_times[row, col]
+        if timestamp != last_time:
+            rate = (value - self.last_values[row, col]) / (timestamp - last_time)
+            if not np.isnan(rate):
+                self.rates[row, col] = rate
+            self.last_values[row, col] = value
+            self.last_times[row, col] = timestamp
+
+        events = []
+        for rule in self.rules_of[col]:
+            x = self.rates[row, col] if self.kinds[rule] == RATE else value
+            condition = x < self.limits[rule] if self.kinds[rule] == BELOW else x > self.limits[rule]  # NaN: False
+            if not condition:
+                self.since[row, rule] = np.nan
+            elif np.isnan(self.since[row, rule]):
+                self.since[row, rule] = now
+            events += self._transition(row, rule, condition and now - self.since[row, rule] >= self.durations[rule], now)
+        return events
+
+    def expire(self, now: Optional[float] = None) -> List[Dict]:
+        """Raises the alarms whose condition has held for their duration without a new sample since"""
+        now = time.time() if now is None else now
+        with np.errstate(invalid="ignore"):
+            due = (now - self.since >= self.durations) & ~self.active  # NaN since: condition false
+        return [event for row, rule in zip(*np.nonzero(due)) for event in self._transition(row, rule, True, now)]
+
+    def next_deadline(self) -> Optional[float]:
+        """When the first condition that holds reaches its duration, None when no condition is waiting"""
+        waiting = ~np.isnan(self.since) & ~self.active
+        return float((self.since + self.durations)[waiting].min()) if waiting.any() else None
+
+    def _transition(self, row: int, rule: int, should: bool, now: float) -> List[Dict]:
+        if should and not self.active[row, rule]:
+            self.active[row, rule] = True
+            self.activated_at[row, rule] = now
+            return [self._event(row, rule, "raised", self.last_values, now)]
+        if self.active[row, rule] and not should:
+            event = self._event(row, rule, "cleared", self.last_values, now)
+            self.active[row, rule] = False
+            self.activated_at[row, rule] = np.nan
+            return [event]
+        return []
+
+    def _event(self, row: int, rule_index: int, state: str, values: np.ndarray, now: float) -> Dict:
+        fridge, rule = self.fridges[row], self.rules[rule_index]
+        value = self.rates[row, self.cols[rule_index]] if rule.kind == "rate" else values[row, self.cols[rule_index]]
+        return {
+            "supermarket": fridge.supermarket,
+            "location": fridge.location,
+            "fridge": fridge.name,
+            "rule": rule.name,
+            "variable": rule.variable,
+            "kind": rule.kind,
+            "severity": rule.severity,
+            "limit": rule.limit,
+            "value": None if np.isnan(value) else float(value),
+            "state": state,
+            "active_since": _iso(self.activated_at[row, rule_index]),
+            "timestamp": _iso(now),
+        }
+
+    def active_alarms(self, values: np.ndarray) -> List[Dict]:
+        return [self._event(row, rule, "active", values, self.activated_at[row, rule])
+                for row, rule in zip(*np.nonzero(self.active))]
+
+
+def _iso(timestamp: float) -> Optional[str]:
+    return None if np.isnan(timestamp) else datetime.fromtimestamp(timestamp, timezone.utc).isoformat()
+
+
+def bench_engine(n_fridges: int = 10_000, seconds: int = 20):
+    """Times an evaluation per second of n_fridges fridges where every variable changes every second"""
+    fridges = [FridgeInfo(("Supermarket1", "Location1", f"Fridge{i + 1}"), None) for i in range(n_fridges)]
+    engine = AlarmEngine(fridges, load_rules())
+    rng = np.random.default_rng(0)
+    values = 275 + rng.normal(size=(n_fridges, len(VARIABLES)))
+    start, elapsed, events = time.time(), 0.0, 0
+    for second in range(seconds):
+        values += rng.normal(scale=0.5, size=values.shape)
+        times = np.full(values.shape, start + second)
+        begin = time.perf_counter()
+        events += len(engine.evaluate(values, times, start + second))
+        elapsed += time.perf_counter() - begin
+    cells = n_fridges * len(VARIABLES)
+    print(f"{n_fridges} fridges x {len(VARIABLES)} variables, {len(engine.rules)} rules: "
+          f"{elapsed / seconds * 1000:.2f} ms per evaluation ({cells * seconds / elapsed:,.0f} values/s), "
+          f"{events} alarm transitions")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Alarm engine benchmark")
+    parser.add_argument("--fridges", type=int, default=10_000)
+    parser.add_argument("--seconds", type=int, default=20)
+    args = parser.parse_args()
+    bench_engine(args.fridges, args.seconds)
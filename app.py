@@ -1,4 +1,5 @@
 from flask import Flask, render_template, jsonify, request, redirect, url_for
+import gzip
 import requests
 from flask_cors import CORS
 
@@ -8,10 +9,19 @@ CORS(app)  # Questo abilita CORS per tutte le rotte
 # URL dell'API del middleware
 API_URL = "http://localhost:8000/api/"
 
+# Sessione HTTP condivisa: riusa le connessioni verso il middleware e accetta risposte compresse
+session = requests.Session()
+
+# Ultimi dati di ogni frigorifero con il loro ETag, per le richieste condizionali al middleware
+fridge_cache = {}
+
+# Sotto questa dimensione le risposte non vengono compresse
+COMPRESS_MIN_SIZE = 1024
+
 # Funzione per ottenere i dati del supermercato
 def get_supermarkets():
     try:
-        response = requests.get(API_URL + "supermarkets")
+        response = session.get(API_URL + "supermarkets")
         response.raise_for_status()
         return response.json()
     except requests.exceptions.RequestException as e:
@@ -20,7 +30,7 @@ def get_supermarkets():
 # Funzione per ottenere le location di un supermercato
 def get_locations(supermarket_id):
     try:
-        response = requests.get(API_URL + f"supermarkets/locations/{supermarket_id}")
+        response = session.get(API_URL + f"supermarkets/locations/{supermarket_id}")
         response.raise_for_status()
         return response.json()
     except requests.exceptions.RequestException as e:
@@ -29,20 +39,34 @@ def get_locations(supermarket_id):
 # Funzione per ottenere i fridges di una location
 def get_fridges(supermarket_id, location_id):
     try:
-        response = requests.get(API_URL + f"supermarkets/locations/{supermarket_id}/fridges/{location_id}")
+        response = session.get(API_URL + f"supermarkets/locations/{supermarket_id}/fridges/{location_id}")
         response.raise_for_status()
         return response.json()
     except requests.exceptions.RequestException as e:
         return {"error": str(e)}
 
-# Funzione per ottenere i dati di un frigorifero
-def get_fridge_data(supermarket_id, location_id, fridge_id):
+# Funzione per ottenere i dati di un frigorifero e il loro ETag.
+# Se i dati non sono cambiati il middleware risponde 304 e si usano quelli gia' ricevuti
+def get_fridge_data_with_etag(supermarket_id, location_id, fridge_id):
+    key = (supermarket_id, location_id, fridge_id)
+    cached = fridge_cache.get(key)
+    headers = {"If-None-Match": cached[0]} if cached else {}
     try:
-        response = requests.get(API_URL + f"supermarkets/locations/{supermarket_id}/fridges/{location_id}/{fridge_id}")
+        response = session.get(API_URL + f"supermarkets/locations/{supermarket_id}/fridges/{location_id}/{fridge_id}",
+                               headers=headers)
+        if response.status_code == 304 and cached:
+            return cached[1], cached[0]
         response.raise_for_status()
-        return response.json()
+        data = response.json()
+        etag = response.headers.get("ETag")
+        if etag:
+            fridge_cache[key] = (etag, data)
+        return data, etag
     except requests.exceptions.RequestException as e:
-        return {"error": str(e)}
+        return {"error": str(e)}, None
+
+def get_fridge_data(supermarket_id, location_id, fridge_id):
+    return get_fridge_data_with_etag(supermarket_id, location_id, fridge_id)[0]
 
 # Prima schermata: Selezione del supermercato
 @app.route('/')
@@ -78,8 +102,21 @@ def fridge(supermarket_id, location_id, fridge_id):
 
 @app.route('/api/<supermarket_id>/<location_id>/<fridge_id>')
 def fetch_fridge_data(supermarket_id, location_id, fridge_id):
-    fridge_data = get_fridge_data(supermarket_id, location_id, fridge_id)
-    return fridge_data
+    fridge_data, etag = get_fridge_data_with_etag(supermarket_id, location_id, fridge_id)
+    if etag is None:
+        return fridge_data
+
+    # Il browser ha gia' questi dati: niente corpo
+    if etag in [tag.strip() for tag in request.headers.get("If-None-Match", "").split(",")]:
+        return "", 304, {"ETag": etag}
+
+    response = jsonify(fridge_data)
+    response.headers["ETag"] = etag
+    response.headers["Vary"] = "Accept-Encoding"
+    if "gzip" in request.headers.get("Accept-Encoding", "") and len(response.get_data()) >= COMPRESS_MIN_SIZE:
+        response.set_data(gzip.compress(response.get_data(), compresslevel=5))
+        response.headers["Content-Encoding"] = "gzip"
+    return response
 
 if __name__ == '__main__':
     app.run(debug=True)
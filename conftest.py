@@ -0,0 +1,2 @@
+# The modules live at the root of the repository: this file makes pytest put the root on sys.path,
+# so the tests in tests/ can import them whatever directory pytest is started from
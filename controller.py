@@ -1,265 +1,412 @@
-from asyncua import Client
+from asyncua import Client, ua
 import pandas as pd
+from fleet import NAMESPACE, VARIABLES, discover_fridges
+import numpy as np
 import logging
 import asyncio
+import multiprocessing
+import queue
+import argparse
+import hashlib
+import json
+import os
+import struct
+import time
+from datetime import datetime, timezone
 
 _logger = logging.getLogger(__name__)
 
-# define a function to loop the value list
+DATASET_FILE = "./Dataset.csv"  # ./ indica che il file è nella stessa directory del codice
 
-async def thread_function(values, var_server):
-    while True:  # It loops infinitely
-        try: # With try we can use a single code for any kind of node value
-            value = float(values.pop(0)) # pop allow us to extract the element of the list in position 0 (in our case)
-        except:
-            value = str(values.pop(0))
+# Index based cursor over the values of a fridge: it never moves memory, so a tick costs the same
+# whatever the length of the dataset. values can be a column or the whole (rows, columns) block
 
-        await var_server.write_value(value)
-        _logger.info(f"Value {var_server}: {value}")
-        values.append(value) # place the value at the end
+class ReplayCursor:
+    def __init__(self, values, start=0, stop=None, loop=True):
+        stop = len(values) if stop is None else min(stop, len(values))
+        if not 0 <= start < stop:
+            raise ValueError(f"Empty replay range [{start}, {stop}) for {len(values)} values")
+        self.values = np.asarray(values)  # drops the memmap subclass (slow indexing), still no copy
+        self.start = start
+        self.stop = stop
+        self.loop = loop
+        self.position = start
 
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.position >= self.stop:
+            if not self.loop:
+                raise StopIteration
+            self.position = self.start  # wrap around
+        # values are already float32, tolist() gives back plain Python floats
+        value = self.values[self.position].tolist()
+        self.position += 1
+        return value
 
 
-# define function to extract from excel file
+# Microbenchmark of the old pop(0)/append rotation against the cursor, per tick
+
+def bench_cursor(lengths=(1_000, 10_000, 100_000, 1_000_000), ticks=10_000):
+    for length in lengths:
+        column = np.arange(length, dtype=np.float32)
+
+        values = column.tolist()
+        begin = time.perf_counter()
+        for _ in range(ticks):
+            value = values.pop(0)
+            values.append(value)
+        rotate = (time.perf_counter() - begin) / ticks
+
+        cursor = ReplayCursor(column)
+        begin = time.perf_counter()
+        for _ in range(ticks):
+            next(cursor)
+        indexed = (time.perf_counter() - begin) / ticks
+
+        print(f"{length:>10} values: pop(0)/append {rotate * 1e9:10.0f} ns/tick, "
+              f"cursor {indexed * 1e9:6.0f} ns/tick")
+
+
+# Columnar store of the dataset, shared by all the simulated fridges
+
+class Dataset:
+    def __init__(self, data, columns=VARIABLES):
+        # data is a (rows, columns) float32 block in column-major order, so every column is contiguous
+        self.data = data
+        self.columns = tuple(columns)
+        self.n_rows = data.shape[0]
+        self._column_index = {name: i for i, name in enumerate(self.columns)}
+
+    def column(self, name):
+        return self.data[:, self._column_index[name]]
+
+
+# Binary cache of the dataset: a small JSON header followed by the raw column-major float32 block.
+# It is memory mapped, so every controller process on the machine shares the same pages
+
+CACHE_MAGIC = b"FRDGDS01"
+CACHE_ALIGNMENT = 64
+
+
+def cache_path(filename):
+    return filename + ".replay.bin"
+
+
+def _source_checksum(filename):
+    digest = hashlib.sha256()
+    with open(filename, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _parse_source(filename):
+    # The file has no header row, the columns are identified by position
+    if filename.endswith((".xlsx", ".xls")):
+        workbook = pd.read_excel(filename, header=None)
+    else:
+        workbook = pd.read_csv(filename, header=None)
+
+    data = workbook.iloc[:, :len(VARIABLES)].to_numpy(dtype=np.float32)
+    return Dataset(np.asfortranarray(data))
+
+
+def build_cache(filename=DATASET_FILE, cache_file=None):
+    cache_file = cache_file or cache_path(filename)
+    dataset = _parse_source(filename)
+    stat = os.stat(filename)
+
+    header = json.dumps({
+        "columns": list(dataset.columns),
+        "dtype": dataset.data.dtype.str,
+        "rows": dataset.n_rows,
+        "order": "F",
+        "source": os.path.basename(filename),
+        "source_size": stat.st_size,
+        "source_mtime_ns": stat.st_mtime_ns,
+        "source_sha256": _source_checksum(filename),
+    }).encode("utf-8")
+    prefix = len(CACHE_MAGIC) + 4 + len(header)
+    offset = -(-prefix // CACHE_ALIGNMENT) * CACHE_ALIGNMENT
 
-def excel_to_list(Controller, start_row=0):
-    filename = "./Dataset.csv"  # ./ indica che il file è nella stessa directory del codice
+    # Written next to the final file and renamed, so a reader never maps a half written cache
+    tmp_file = f"{cache_file}.{os.getpid()}.tmp"
+    with open(tmp_file, "wb") as f:
+        f.write(CACHE_MAGIC)
+        f.write(struct.pack("<I", len(header)))
+        f.write(header)
+        f.write(b"\0" * (offset - prefix))
+        f.write(dataset.data.tobytes(order="F"))
+    os.replace(tmp_file, cache_file)
+
+    _logger.info(f"Built dataset cache {cache_file} ({dataset.n_rows} rows)")
+    return cache_file
+
+
+def _read_cache_header(cache_file):
+    # Returns (header, data offset), or None when the file is missing or not a cache
     try:
-        workbook = pd.read_excel(filename)
-    except:
-        workbook = pd.read_csv(filename)
-
-    # Estrai i valori a partire dalla riga indicata
-    compOutPres = workbook.iloc[start_row:, 0].values.tolist()
-    compOutTemp = workbook.iloc[start_row:, 1].values.tolist()
-    condInPres = workbook.iloc[start_row:, 2].values.tolist()
-    condInTemp = workbook.iloc[start_row:, 3].values.tolist()
-    condOutPres = workbook.iloc[start_row:, 4].values.tolist()
-    condOutTemp = workbook.iloc[start_row:, 5].values.tolist()
-    evapInPres = workbook.iloc[start_row:, 6].values.tolist()
-    compInTemp = workbook.iloc[start_row:, 7].values.tolist()
-    evapOutPres = workbook.iloc[start_row:, 8].values.tolist()
-    evapOutTemp = workbook.iloc[start_row:, 9].values.tolist()
-    tempC1 = workbook.iloc[start_row:, 10].values.tolist()
-    tempC2 = workbook.iloc[start_row:, 11].values.tolist()
-    tempC3 = workbook.iloc[start_row:, 12].values.tolist()
-
-    # Crea e restituisci l'oggetto Controller
-    controller = Controller(
-        compOutPres, compOutTemp, condInPres, condInTemp,
-        condOutPres, condOutTemp, evapInPres, compInTemp,
-        evapOutPres, evapOutTemp, tempC1, tempC2, tempC3
-    )
-
-    return controller
- 
+        with open(cache_file, "rb") as f:
+            if f.read(len(CACHE_MAGIC)) != CACHE_MAGIC:
+                return None
+            (length,) = struct.unpack("<I", f.read(4))
+            header = json.loads(f.read(length).decode("utf-8"))
+    except (OSError, ValueError, struct.error):
+        return None
+
+    prefix = len(CACHE_MAGIC) + 4 + length
+    return header, -(-prefix // CACHE_ALIGNMENT) * CACHE_ALIGNMENT
+
+
+def _cache_is_fresh(header, filename):
+    stat = os.stat(filename)
+    if header["source_size"] != stat.st_size:
+        return False
+    if header["source_mtime_ns"] == stat.st_mtime_ns:
+        return True
+    # Same size but touched: only the checksum can tell if the content changed
+    return header["source_sha256"] == _source_checksum(filename)
+
+
+def open_cache(cache_file):
+    header, offset = _read_cache_header(cache_file)
+    shape = (header["rows"], len(header["columns"]))
+    data = np.memmap(cache_file, dtype=np.dtype(header["dtype"]), mode="r",
+                     offset=offset, shape=shape, order=header["order"])
+    return Dataset(data, header["columns"])
+
+
+_datasets = {}
+
+# define function to load the dataset, only once per process
+
+def load_dataset(filename=DATASET_FILE, use_cache=True):
+    if filename not in _datasets:
+        if use_cache:
+            cache_file = cache_path(filename)
+            cached = _read_cache_header(cache_file)
+            if cached is None or not _cache_is_fresh(cached[0], filename):
+                build_cache(filename, cache_file)
+            _datasets[filename] = open_cache(cache_file)
+        else:
+            _datasets[filename] = _parse_source(filename)
+
+    return _datasets[filename]
+
+
+# Replay engine: every tick advances one dataset row for each fridge and writes all the variables of the
+# fleet in a single multi-node Write call with a shared SourceTimestamp, so readers always see coherent rows
+
+class FleetReplay:
+    def __init__(self, client, dataset, batch_size=None):
+        self.client = client
+        self.dataset = dataset
+        self.batch_size = batch_size  # max number of fridges per Write call, None = the whole fleet
+        self.nodeids = []
+        self.cursors = []
+        self.ticks = 0
+        self.writes = 0
+        self.errors = 0
+
+    def add_fridge(self, variable_nodeids, start_row=0, stop_row=None, loop=True):
+        # variable_nodeids maps each variable name to its NodeId in the server
+        self.nodeids.append([variable_nodeids[name] for name in self.dataset.columns])
+        self.cursors.append(ReplayCursor(self.dataset.data, start_row, stop_row, loop))
+
+    async def tick(self):
+        if not self.cursors:
+            self.ticks += 1
+            return
+        timestamp = datetime.now(timezone.utc)
+        batch_size = self.batch_size or len(self.cursors)
+
+        for first in range(0, len(self.cursors), batch_size):
+            nodeids = []
+            datavalues = []
+            for fridge_nodeids, cursor in zip(self.nodeids[first:first + batch_size],
+                                              self.cursors[first:first + batch_size]):
+                nodeids += fridge_nodeids
+                for value in next(cursor):
+                    # Double, like the values the server variables are initialised with
+                    datavalues.append(ua.DataValue(ua.Variant(value, ua.VariantType.Double),
+                                                   SourceTimestamp=timestamp))
+
+            results = await self.client.uaclient.write_attributes(nodeids, datavalues)
+            self.writes += len(results)
+            for nodeid, status in zip(nodeids, results):
+                if not status.is_good():
+                    self.errors += 1
+                    _logger.warning(f"Write of {nodeid} failed: {status}")
+
+        self.ticks += 1
+
+
+
+# Paces the replay on a monotonic clock: tick k is due at start + k * sample_period / speed, so the time
+# spent writing is not added to the period and the pacing does not drift. speed=0 replays as fast as possible
+
+class ReplayScheduler:
+    def __init__(self, sample_period=1.0, speed=1.0, report_every=10.0, on_report=None):
+        self.interval = sample_period / speed if speed else 0.0
+        self.report_every = report_every
+        self.on_report = on_report  # called with the stats dict after every report
+        self.missed = 0
+        self.writes_per_second = 0.0
+        self.ticks_per_second = 0.0
+
+    async def run(self, replay):
+        deadline = last_report = time.monotonic()
+        last_ticks, last_writes = replay.ticks, replay.writes
+
+        while True:
+            await replay.tick()
+
+            now = time.monotonic()
+            if now - last_report >= self.report_every:
+                elapsed = now - last_report
+                self.ticks_per_second = (replay.ticks - last_ticks) / elapsed
+                self.writes_per_second = (replay.writes - last_writes) / elapsed
+                _logger.info(f"Replay: {self.writes_per_second:.0f} writes/s, {self.ticks_per_second:.1f} ticks/s, "
+                             f"{self.missed} missed deadlines, {replay.errors} write errors")
+                if self.on_report:
+                    self.on_report({
+                        "writes_per_second": self.writes_per_second,
+                        "ticks_per_second": self.ticks_per_second,
+                        "missed": self.missed,
+                        "writes": replay.writes,
+                        "errors": replay.errors,
+                    })
+                last_report, last_ticks, last_writes = now, replay.ticks, replay.writes
+
+            if not self.interval:
+                await asyncio.sleep(0)  # as fast as possible, but let the other tasks run
+                continue
+
+            deadline += self.interval
+            delay = deadline - now
+            if delay > 0:
+                await asyncio.sleep(delay)
+            else:
+                self.missed += 1
+                if -delay > self.interval:
+                    deadline = now  # too far behind: drop the backlog instead of bursting to catch up
+
+
+# Dataset rows between the first samples of two consecutive fridges
+ROW_STRIDE = 100
+
 
 url="opc.tcp://localhost:3005/"
-namespace="http://examples.factory.github.io"
+namespace=NAMESPACE
 
-async def main():
+async def main(dataset_file=DATASET_FILE, sample_period=1.0, speed=1.0, shard=0, n_shards=1, stats=None):
     print(f"Connecting to {url} ...")
     async with Client(url=url) as client: #instantiation of client class 
         nsidx = await client.get_namespace_index(namespace) # we want to find the namespace index
         print(f"Namespace Index for '{namespace}': {nsidx}")
         print(await client.nodes.root.get_children()) # It prints outr the nodes inside the server
 
-        # Classe Controller
-        class Controller:
-            def __init__(self, compOutPres, compOutTemp, condInPres, condInTemp,
-                         condOutPres, condOutTemp, evapInPres, compInTemp,
-                         evapOutPres, evapOutTemp, tempC1, tempC2, tempC3):
-                self.compOutPres = compOutPres
-                self.compOutTemp = compOutTemp
-                self.condInPres = condInPres
-                self.condInTemp = condInTemp
-                self.condOutPres = condOutPres
-                self.condOutTemp = condOutTemp
-                self.evapInPres = evapInPres
-                self.compInTemp = compInTemp
-                self.evapOutPres = evapOutPres
-                self.evapOutTemp = evapOutTemp
-                self.tempC1 = tempC1
-                self.tempC2 = tempC2
-                self.tempC3 = tempC3
-
-        # Controller per il primo frigorifero (riga iniziale 0)
-        controller_S1L1F1 = excel_to_list(Controller, start_row=0)
-        # Controller per il secondo frigorifero (riga iniziale 100)
-        controller_S1L1F2 = excel_to_list(Controller, start_row=100)
-
-        controller_S1L2F1 = excel_to_list(Controller, start_row=200)
-
-        controller_S2L1F1 = excel_to_list(Controller, start_row=300)
-
-        # Nodi del primo frigorifero
-        object = await client.nodes.root.get_child("0:Objects")
-
-        # Supermarket 1
-
-        supermarket1 = await object.get_child(f"{nsidx}:Supermarket1")
-
-        # Location 1
-
-        location1 = await supermarket1.get_child(f"{nsidx}:Location1")
-        
-        #Nodi fridge 1
-
-        fridge1 = await location1.get_child(f"{nsidx}:Fridge1")
-
-        compOutPres_S1L1F1 = await fridge1.get_child(f"{nsidx}:compOutPres")
-        compOutTemp_S1L1F1 = await fridge1.get_child(f"{nsidx}:compOutTemp")
-        condInPres_S1L1F1 = await fridge1.get_child(f"{nsidx}:condInPres")
-        condInTemp_S1L1F1 = await fridge1.get_child(f"{nsidx}:condInTemp")
-        condOutPres_S1L1F1 = await fridge1.get_child(f"{nsidx}:condOutPres")
-        condOutTemp_S1L1F1 = await fridge1.get_child(f"{nsidx}:condOutTemp")
-        evapInPres_S1L1F1 = await fridge1.get_child(f"{nsidx}:evapInPres")
-        compInTemp_S1L1F1 = await fridge1.get_child(f"{nsidx}:compInTemp")
-        evapOutPres_S1L1F1 = await fridge1.get_child(f"{nsidx}:evapOutPres")
-        evapOutTemp_S1L1F1 = await fridge1.get_child(f"{nsidx}:evapOutTemp")
-        tempC1_S1L1F1 = await fridge1.get_child(f"{nsidx}:tempC1")
-        tempC2_S1L1F1 = await fridge1.get_child(f"{nsidx}:tempC2")
-        tempC3_S1L1F1 = await fridge1.get_child(f"{nsidx}:tempC3")
-
-        #Nodi fridge 2 
-
-        fridge2 = await location1.get_child(f"{nsidx}:Fridge2")
-
-        compOutPres_S1L1F2 = await fridge2.get_child(f"{nsidx}:compOutPres")
-        compOutTemp_S1L1F2 = await fridge2.get_child(f"{nsidx}:compOutTemp")
-        condInPres_S1L1F2 = await fridge2.get_child(f"{nsidx}:condInPres")
-        condInTemp_S1L1F2 = await fridge2.get_child(f"{nsidx}:condInTemp")
-        condOutPres_S1L1F2 = await fridge2.get_child(f"{nsidx}:condOutPres")
-        condOutTemp_S1L1F2 = await fridge2.get_child(f"{nsidx}:condOutTemp")
-        evapInPres_S1L1F2 = await fridge2.get_child(f"{nsidx}:evapInPres")
-        compInTemp_S1L1F2 = await fridge2.get_child(f"{nsidx}:compInTemp")
-        evapOutPres_S1L1F2 = await fridge2.get_child(f"{nsidx}:evapOutPres")
-        evapOutTemp_S1L1F2 = await fridge2.get_child(f"{nsidx}:evapOutTemp")
-        tempC1_S1L1F2 = await fridge2.get_child(f"{nsidx}:tempC1")
-        tempC2_S1L1F2 = await fridge2.get_child(f"{nsidx}:tempC2")
-        tempC3_S1L1F2 = await fridge2.get_child(f"{nsidx}:tempC3")
-
-        # Location 2
-
-        location2 = await supermarket1.get_child(f"{nsidx}:Location2")
-        
-        #Nodi fridge 1
-
-        fridge1_2 = await location2.get_child(f"{nsidx}:Fridge1")
-
-        compOutPres_S1L2F1 = await fridge1_2.get_child(f"{nsidx}:compOutPres")
-        compOutTemp_S1L2F1 = await fridge1_2.get_child(f"{nsidx}:compOutTemp")
-        condInPres_S1L2F1 = await fridge1_2.get_child(f"{nsidx}:condInPres")
-        condInTemp_S1L2F1 = await fridge1_2.get_child(f"{nsidx}:condInTemp")
-        condOutPres_S1L2F1 = await fridge1_2.get_child(f"{nsidx}:condOutPres")
-        condOutTemp_S1L2F1 = await fridge1_2.get_child(f"{nsidx}:condOutTemp")
-        evapInPres_S1L2F1 = await fridge1_2.get_child(f"{nsidx}:evapInPres")
-        compInTemp_S1L2F1 = await fridge1_2.get_child(f"{nsidx}:compInTemp")
-        evapOutPres_S1L2F1 = await fridge1_2.get_child(f"{nsidx}:evapOutPres")
-        evapOutTemp_S1L2F1 = await fridge1_2.get_child(f"{nsidx}:evapOutTemp")
-        tempC1_S1L2F1 = await fridge1_2.get_child(f"{nsidx}:tempC1")
-        tempC2_S1L2F1 = await fridge1_2.get_child(f"{nsidx}:tempC2")
-        tempC3_S1L2F1 = await fridge1_2.get_child(f"{nsidx}:tempC3")
-
-        # Supermarket 2
-
-        supermarket2 = await object.get_child(f"{nsidx}:Supermarket2")
-
-        # Location 1
-
-        location1_2 = await supermarket2.get_child(f"{nsidx}:Location1")
-        
-        #Nodi fridge 1
-
-        fridge1_22 = await location1_2.get_child(f"{nsidx}:Fridge1")
-
-        compOutPres_S2L1F1 = await fridge1_22.get_child(f"{nsidx}:compOutPres")
-        compOutTemp_S2L1F1 = await fridge1_22.get_child(f"{nsidx}:compOutTemp")
-        condInPres_S2L1F1 = await fridge1_22.get_child(f"{nsidx}:condInPres")
-        condInTemp_S2L1F1 = await fridge1_22.get_child(f"{nsidx}:condInTemp")
-        condOutPres_S2L1F1 = await fridge1_22.get_child(f"{nsidx}:condOutPres")
-        condOutTemp_S2L1F1 = await fridge1_22.get_child(f"{nsidx}:condOutTemp")
-        evapInPres_S2L1F1 = await fridge1_22.get_child(f"{nsidx}:evapInPres")
-        compInTemp_S2L1F1 = await fridge1_22.get_child(f"{nsidx}:compInTemp")
-        evapOutPres_S2L1F1 = await fridge1_22.get_child(f"{nsidx}:evapOutPres")
-        evapOutTemp_S2L1F1 = await fridge1_22.get_child(f"{nsidx}:evapOutTemp")
-        tempC1_S2L1F1 = await fridge1_22.get_child(f"{nsidx}:tempC1")
-        tempC2_S2L1F1 = await fridge1_22.get_child(f"{nsidx}:tempC2")
-        tempC3_S2L1F1 = await fridge1_22.get_child(f"{nsidx}:tempC3")
-
-        # Task per il primo frigorifero
-        tasks = [
-            asyncio.ensure_future(thread_function(controller_S1L1F1.compOutPres,compOutPres_S1L1F1)),
-            asyncio.ensure_future(thread_function(controller_S1L1F1.compOutTemp,compOutTemp_S1L1F1)),
-            asyncio.ensure_future(thread_function(controller_S1L1F1.condInPres,condInPres_S1L1F1)),
-            asyncio.ensure_future(thread_function(controller_S1L1F1.condInTemp,condInTemp_S1L1F1)),
-            asyncio.ensure_future(thread_function(controller_S1L1F1.condOutPres,condOutPres_S1L1F1)),
-            asyncio.ensure_future(thread_function(controller_S1L1F1.condOutTemp,condOutTemp_S1L1F1)),
-            asyncio.ensure_future(thread_function(controller_S1L1F1.evapInPres,evapInPres_S1L1F1)),
-            asyncio.ensure_future(thread_function(controller_S1L1F1.compInTemp,compInTemp_S1L1F1)),
-            asyncio.ensure_future(thread_function(controller_S1L1F1.evapOutPres,evapOutPres_S1L1F1)),
-            asyncio.ensure_future(thread_function(controller_S1L1F1.evapOutTemp,evapOutTemp_S1L1F1)), 
-            asyncio.ensure_future(thread_function(controller_S1L1F1.tempC1,tempC1_S1L1F1)),
-            asyncio.ensure_future(thread_function(controller_S1L1F1.tempC2,tempC2_S1L1F1)),
-            asyncio.ensure_future(thread_function(controller_S1L1F1.tempC3,tempC3_S1L1F1)),
-        ]
-             
-        # Task per il secondo frigorifero
-        tasks += [
-            asyncio.ensure_future(thread_function(controller_S1L1F2.compOutPres,compOutPres_S1L1F2)),
-            asyncio.ensure_future(thread_function(controller_S1L1F2.compOutTemp,compOutTemp_S1L1F2)),
-            asyncio.ensure_future(thread_function(controller_S1L1F2.condInPres,condInPres_S1L1F2)),
-            asyncio.ensure_future(thread_function(controller_S1L1F2.condInTemp,condInTemp_S1L1F2)),
-            asyncio.ensure_future(thread_function(controller_S1L1F2.condOutPres,condOutPres_S1L1F2)),
-            asyncio.ensure_future(thread_function(controller_S1L1F2.condOutTemp,condOutTemp_S1L1F2)),
-            asyncio.ensure_future(thread_function(controller_S1L1F2.evapInPres,evapInPres_S1L1F2)),
-            asyncio.ensure_future(thread_function(controller_S1L1F2.compInTemp,compInTemp_S1L1F2)),
-            asyncio.ensure_future(thread_function(controller_S1L1F2.evapOutPres,evapOutPres_S1L1F2)),
-            asyncio.ensure_future(thread_function(controller_S1L1F2.evapOutTemp,evapOutTemp_S1L1F2)), 
-            asyncio.ensure_future(thread_function(controller_S1L1F2.tempC1,tempC1_S1L1F2)),
-            asyncio.ensure_future(thread_function(controller_S1L1F2.tempC2,tempC2_S1L1F2)),
-            asyncio.ensure_future(thread_function(controller_S1L1F2.tempC3,tempC3_S1L1F2)),
-        ]
-
-        tasks += [
-            asyncio.ensure_future(thread_function(controller_S1L2F1.compOutPres,compOutPres_S1L2F1)),
-            asyncio.ensure_future(thread_function(controller_S1L2F1.compOutTemp,compOutTemp_S1L2F1)),
-            asyncio.ensure_future(thread_function(controller_S1L2F1.condInPres,condInPres_S1L2F1)),
-            asyncio.ensure_future(thread_function(controller_S1L2F1.condInTemp,condInTemp_S1L2F1)),
-            asyncio.ensure_future(thread_function(controller_S1L2F1.condOutPres,condOutPres_S1L2F1)),
-            asyncio.ensure_future(thread_function(controller_S1L2F1.condOutTemp,condOutTemp_S1L2F1)),
-            asyncio.ensure_future(thread_function(controller_S1L2F1.evapInPres,evapInPres_S1L2F1)),
-            asyncio.ensure_future(thread_function(controller_S1L2F1.compInTemp,compInTemp_S1L2F1)),
-            asyncio.ensure_future(thread_function(controller_S1L2F1.evapOutPres,evapOutPres_S1L2F1)),
-            asyncio.ensure_future(thread_function(controller_S1L2F1.evapOutTemp,evapOutTemp_S1L2F1)), 
-            asyncio.ensure_future(thread_function(controller_S1L2F1.tempC1,tempC1_S1L2F1)),
-            asyncio.ensure_future(thread_function(controller_S1L2F1.tempC2,tempC2_S1L2F1)),
-            asyncio.ensure_future(thread_function(controller_S1L2F1.tempC3,tempC3_S1L2F1)),
-        ]
-
-        tasks += [
-            asyncio.ensure_future(thread_function(controller_S2L1F1.compOutPres,compOutPres_S2L1F1)),
-            asyncio.ensure_future(thread_function(controller_S2L1F1.compOutTemp,compOutTemp_S2L1F1)),
-            asyncio.ensure_future(thread_function(controller_S2L1F1.condInPres,condInPres_S2L1F1)),
-            asyncio.ensure_future(thread_function(controller_S2L1F1.condInTemp,condInTemp_S2L1F1)),
-            asyncio.ensure_future(thread_function(controller_S2L1F1.condOutPres,condOutPres_S2L1F1)),
-            asyncio.ensure_future(thread_function(controller_S2L1F1.condOutTemp,condOutTemp_S2L1F1)),
-            asyncio.ensure_future(thread_function(controller_S2L1F1.evapInPres,evapInPres_S2L1F1)),
-            asyncio.ensure_future(thread_function(controller_S2L1F1.compInTemp,compInTemp_S2L1F1)),
-            asyncio.ensure_future(thread_function(controller_S2L1F1.evapOutPres,evapOutPres_S2L1F1)),
-            asyncio.ensure_future(thread_function(controller_S2L1F1.evapOutTemp,evapOutTemp_S2L1F1)), 
-            asyncio.ensure_future(thread_function(controller_S2L1F1.tempC1,tempC1_S2L1F1)),
-            asyncio.ensure_future(thread_function(controller_S2L1F1.tempC2,tempC2_S2L1F1)),
-            asyncio.ensure_future(thread_function(controller_S2L1F1.tempC3,tempC3_S2L1F1)),
-        ]
-        
-
-        # Esecuzione parallela dei task
-        await asyncio.gather(*tasks)
+        dataset = load_dataset(dataset_file)
+        replay = FleetReplay(client, dataset)
 
-# Esecuzione del codice
-if __name__ == "__main__":
+        # Every instance of the Fridges type gets its own offset in the dataset
+        fridges = await discover_fridges(client, nsidx)
+        offsets = [(i * ROW_STRIDE) % dataset.n_rows for i in range(len(fridges))]
+
+        # With several workers, each one replays every n_shards-th fridge of the fleet
+        for fridge, start_row in list(zip(fridges, offsets))[shard::n_shards]:
+            if len(fridge.variables) != len(VARIABLES):
+                _logger.warning(f"Skipping {fridge}: some variables are missing")
+                continue
+            replay.add_fridge(fridge.variables, start_row)
+
+        # More workers than fridges: this shard has nothing to replay
+        if not replay.cursors:
+            _logger.warning(f"No fridges to replay in shard {shard + 1}/{n_shards} ({len(fridges)} fridges)")
+            return
+
+        on_report = None
+        if stats is not None:
+            on_report = lambda report: stats.put({"worker": shard, **report})
+
+        await ReplayScheduler(sample_period, speed, on_report=on_report).run(replay)
+
+
+# Sharded controller: the fleet is partitioned across worker processes, each one with its own OPC UA
+# session. The workers map the same dataset cache read-only, the launcher aggregates their stats
+
+def _worker(shard, n_shards, dataset_file, sample_period, speed, stats):
     logging.basicConfig(level=logging.INFO)
-    asyncio.run(main())
+    asyncio.run(main(dataset_file, sample_period, speed, shard, n_shards, stats))
+
+
+def run_sharded(workers, dataset_file=DATASET_FILE, sample_period=1.0, speed=1.0, report_every=10.0):
+    load_dataset(dataset_file)  # build or validate the cache once, the workers only map it
+
+    context = multiprocessing.get_context("spawn")
+    stats = context.Queue()
+    processes = [
+        context.Process(target=_worker, args=(shard, workers, dataset_file, sample_period, speed, stats),
+                        name=f"controller-{shard}", daemon=True)
+        for shard in range(workers)
+    ]
+    for process in processes:
+        process.start()
 
+    latest = {}
+    last_report = time.monotonic()
+    try:
+        while any(process.is_alive() for process in processes):
+            try:
+                report = stats.get(timeout=1.0)
+                latest[report["worker"]] = report
+            except queue.Empty:
+                pass
+
+            now = time.monotonic()
+            if latest and now - last_report >= report_every:
+                # Only the last report of the workers still running, and how many of them it covers:
+                # a worker that has not reported yet is not counted as writing nothing
+                alive = [shard for shard, process in enumerate(processes) if process.is_alive()]
+                reports = [latest[shard] for shard in alive if shard in latest]
+                _logger.info(
+                    f"Fleet: {sum(r['writes_per_second'] for r in reports):.0f} writes/s reported by "
+                    f"{len(reports)}/{len(alive)} live workers ({workers} started), "
+                    f"{sum(r['missed'] for r in reports)} missed deadlines, "
+                    f"{sum(r['errors'] for r in reports)} write errors")
+                last_report = now
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.join()
 
+# Esecuzione del codice
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay the dataset into the supermarket OPC UA server")
+    parser.add_argument("--dataset", default=DATASET_FILE, help="CSV or XLSX file to replay")
+    parser.add_argument("--sample-period", type=float, default=1.0,
+                        help="seconds between two rows of the dataset")
+    parser.add_argument("--speed", type=float, default=1.0,
+                        help="time compression factor, e.g. 10 replays ten rows per sample period; 0 = as fast as possible")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="number of controller processes the fleet is partitioned across")
+    parser.add_argument("--build-cache", action="store_true",
+                        help="convert the dataset into its memory mapped binary cache and exit")
+    parser.add_argument("--bench-cursor", action="store_true",
+                        help="print the per tick cost of the replay cursor for growing dataset lengths and exit")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    if args.build_cache:
+        build_cache(args.dataset)
+    elif args.bench_cursor:
+        bench_cursor()
+    elif args.workers > 1:
+        run_sharded(args.workers, args.dataset, args.sample_period, args.speed)
+    else:
+        asyncio.run(main(args.dataset, args.sample_period, args.speed))
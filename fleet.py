@@ -0,0 +1,175 @@
+from asyncua import ua
+import logging
+import re
+from typing import Dict, List, Optional, Tuple
+
+_logger = logging.getLogger(__name__)
+
+NAMESPACE = "http://examples.factory.github.io"
+
+# Fridge variables, in the same order as the columns of the dataset
+VARIABLES = (
+    "compOutPres", "compOutTemp", "condInPres", "condInTemp",
+    "condOutPres", "condOutTemp", "evapInPres", "compInTemp",
+    "evapOutPres", "evapOutTemp", "tempC1", "tempC2", "tempC3",
+)
+
+# Path of the Fridges object type below BaseObjectType (see supermarket_server.py)
+FRIDGE_TYPE_PATH = ("SupermarketType", "LocationType", "Fridges")
+
+# Max number of nodes sent in one Browse / TranslateBrowsePathsToNodeIds request
+BATCH_SIZE = 1000
+
+# Supermarket -> Location -> Fridge is three levels below Objects
+MAX_DEPTH = 3
+
+
+class FridgeInfo:
+    """A Fridges instance found in the server, with the NodeIds of its variables"""
+    def __init__(self, path: Tuple[str, ...], nodeid: ua.NodeId):
+        self.path = path
+        self.nodeid = nodeid
+        self.variables: Dict[str, ua.NodeId] = {}
+
+    @property
+    def supermarket(self) -> str:
+        return self.path[0]
+
+    @property
+    def location(self) -> str:
+        return self.path[-2]
+
+    @property
+    def name(self) -> str:
+        return self.path[-1]
+
+    def __repr__(self):
+        return f"FridgeInfo({'/'.join(self.path)}, {self.nodeid.to_string()})"
+
+
+def natural_key(path):
+    """Sort key that puts Fridge2 before Fridge10"""
+    return [tuple(int(part) if part.isdigit() else part for part in re.split(r"(\d+)", name)) for name in path]
+
+
+def _relative_path(nsidx: int, names) -> ua.RelativePath:
+    return ua.RelativePath(Elements=[
+        ua.RelativePathElement(
+            ReferenceTypeId=ua.NodeId(ua.ObjectIds.HierarchicalReferences),
+            IsInverse=False,
+            IncludeSubtypes=True,
+            TargetName=ua.QualifiedName(name, nsidx),
+        )
+        for name in names
+    ])
+
+
+async def translate_paths(client, paths: List[Tuple[ua.NodeId, ua.RelativePath]],
+                          batch_size: int = BATCH_SIZE) -> List[Optional[ua.NodeId]]:
+    """Resolves many browse paths with batched TranslateBrowsePathsToNodeIds calls (None when not found)"""
+    nodeids = []
+    for first in range(0, len(paths), batch_size):
+        browse_paths = [ua.BrowsePath(StartingNode=start, RelativePath=relative)
+                        for start, relative in paths[first:first + batch_size]]
+        for result in await client.uaclient.translate_browsepaths_to_nodeids(browse_paths):
+            if result.StatusCode.is_good() and result.Targets:
+                nodeids.append(result.Targets[0].TargetId)
+            else:
+                nodeids.append(None)
+    return nodeids
+
+
+async def browse_children(client, nodeids: List[ua.NodeId], batch_size: int = BATCH_SIZE,
+                          node_class: ua.NodeClass = ua.NodeClass.Object) -> List[List[ua.ReferenceDescription]]:
+    """Browses the hierarchical children of many nodes with batched Browse / BrowseNext calls"""
+    children = []
+    for first in range(0, len(nodeids), batch_size):
+        params = ua.BrowseParameters(
+            View=ua.ViewDescription(),
+            RequestedMaxReferencesPerNode=0,
+            NodesToBrowse=[
+                ua.BrowseDescription(
+                    NodeId=nodeid,
+                    BrowseDirection=ua.BrowseDirection.Forward,
+                    ReferenceTypeId=ua.NodeId(ua.ObjectIds.HierarchicalReferences),
+                    IncludeSubtypes=True,
+                    NodeClassMask=node_class,
+                    ResultMask=ua.BrowseResultMask.All,
+                )
+                for nodeid in nodeids[first:first + batch_size]
+            ],
+        )
+        results = await client.uaclient.browse(params)
+        references = [list(result.References) for result in results]
+
+        # The server may split long reference lists: fetch the rest of all of them together
+        pending = {i: result.ContinuationPoint for i, result in enumerate(results) if result.ContinuationPoint}
+        while pending:
+            indexes = list(pending)
+            next_results = await client.uaclient.browse_next(ua.BrowseNextParameters(
+                ReleaseContinuationPoints=False,
+                ContinuationPoints=[pending[i] for i in indexes],
+            ))
+            pending = {}
+            for i, result in zip(indexes, next_results):
+                references[i] += result.References
+                if result.ContinuationPoint:
+                    pending[i] = result.ContinuationPoint
+
+        children += references
+    return children
+
+
+async def discover_fridges(client, nsidx: Optional[int] = None, batch_size: int = BATCH_SIZE,
+                           objects: Optional[Dict[Tuple[str, ...], ua.NodeId]] = None) -> List[FridgeInfo]:
+    """Finds every instance of the Fridges object type and the NodeIds of its variables.
+
+    The number of round trips depends on the depth of the tree, not on the number of fridges
+    (as long as a level fits in one batch). If objects is given, it is filled with the path and
+    NodeId of every other object met on the way (supermarkets, locations).
+    """
+    if nsidx is None:
+        nsidx = await client.get_namespace_index(NAMESPACE)
+
+    (fridge_type,) = await translate_paths(client, [
+        (ua.NodeId(ua.ObjectIds.BaseObjectType), _relative_path(nsidx, FRIDGE_TYPE_PATH))])
+    if fridge_type is None:
+        raise RuntimeError("Fridges object type not found in the server")
+
+    # Breadth first walk from Objects, one batched Browse per level of the tree
+    fridges = []
+    level = [((), ua.NodeId(ua.ObjectIds.ObjectsFolder))]
+    for _ in range(MAX_DEPTH):
+        if not level:
+            break
+        children = await browse_children(client, [nodeid for _, nodeid in level], batch_size)
+        next_level = []
+        for (path, _), references in zip(level, children):
+            for ref in references:
+                if ref.BrowseName.NamespaceIndex != nsidx:
+                    continue  # skip the standard Server object and friends
+                child = (path + (ref.BrowseName.Name,), ref.NodeId)
+                if ref.TypeDefinition == fridge_type:
+                    fridges.append(FridgeInfo(*child))
+                else:
+                    next_level.append(child)
+                    if objects is not None:
+                        objects[child[0]] = child[1]
+        level = next_level
+
+    fridges.sort(key=lambda fridge: natural_key(fridge.path))
+
+    # All the variables of all the fridges in one batched TranslateBrowsePathsToNodeIds
+    relatives = {name: _relative_path(nsidx, (name,)) for name in VARIABLES}
+    paths = [(fridge.nodeid, relatives[name]) for fridge in fridges for name in VARIABLES]
+    nodeids = await translate_paths(client, paths, batch_size)
+    for i, fridge in enumerate(fridges):
+        for j, name in enumerate(VARIABLES):
+            nodeid = nodeids[i * len(VARIABLES) + j]
+            if nodeid is None:
+                _logger.warning(f"Variable {name} not found in {fridge}")
+            else:
+                fridge.variables[name] = nodeid
+
+    _logger.info(f"Discovered {len(fridges)} fridges")
+    return fridges
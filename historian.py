@@ -0,0 +1,216 @@
+from asyncua import ua
+from asyncua.server.history import HistoryManager, HistoryStorageInterface, SubHandler
+from datetime import datetime, timedelta, timezone
+import logging
+import numpy as np
+from typing import Dict, List, Optional
+from timeseries import BYTES_PER_SAMPLE, HISTORY_MEMORY_CAP, RingBuffer
+
+_logger = logging.getLogger(__name__)
+
+_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+
+def _to_us(dt: datetime) -> int:
+    """Microseconds since the Unix epoch (naive datetimes are UTC)"""
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return (dt - _EPOCH) // timedelta(microseconds=1)
+
+
+def _from_us(us: int) -> datetime:
+    return _EPOCH + timedelta(microseconds=int(us))
+
+
+def _is_unspecified(dt: Optional[datetime]) -> bool:
+    return dt is None or _to_us(dt) <= _to_us(ua.get_win_epoch())
+
+
+class RingBufferHistory(HistoryStorageInterface):
+    """History storage keeping the last `depth` samples of every variable in a ring buffer,
+    with timestamps as int64 microseconds since the Unix epoch"""
+    def __init__(self, depth: int = 3600, memory_cap: int = HISTORY_MEMORY_CAP,
+                 max_history_data_response_size: int = 10000):
+        super().__init__(max_history_data_response_size)
+        self.depth = depth
+        self.memory_cap = memory_cap
+        self.memory_used = 0
+        self._rings: Dict[ua.NodeId, RingBuffer] = {}
+
+    async def init(self):
+        pass
+
+    async def stop(self):
+        pass
+
+    async def new_historized_node(self, node_id, period, count=0):
+        depth = count or self.depth
+        if depth < 1:
+            raise ua.UaError(f"History depth of {node_id} must be at least 1 sample, not {depth}")
+        size = depth * BYTES_PER_SAMPLE
+        if self.memory_used + size > self.memory_cap:
+            raise ua.UaError(f"History memory cap of {self.memory_cap} bytes reached, cannot historize {node_id}")
+        self._rings[node_id] = RingBuffer(1, depth, time_dtype=np.int64)
+        self.memory_used += size
+
+    async def save_node_value(self, node_id, datavalue):
+        ring = self._rings.get(node_id)
+        if ring is None or datavalue.Value is None or datavalue.Value.Value is None:
+            return
+        timestamp = datavalue.SourceTimestamp or datavalue.ServerTimestamp or datetime.now(timezone.utc)
+        ring.append(0, _to_us(timestamp), datavalue.Value.Value)
+
+    async def read_node_history(self, node_id, start, end, nb_values):
+        ring = self._rings.get(node_id)
+        if ring is None:
+            _logger.warning(f"History read for {node_id}, which is not historized")
+            return [], None
+
+        # Same conventions as asyncua's HistoryDict: an unspecified start time reads backwards
+        reverse = False
+        if _is_unspecified(start):
+            times, values = ring.ordered(0)
+            if not _is_unspecified(end):
+                times, values = ring.window(0, 0, _to_us(end))
+            reverse = True
+        elif _is_unspecified(end):
+            times, values = ring.window(0, _to_us(start), np.iinfo(np.int64).max)
+        elif start > end:
+            times, values = ring.window(0, _to_us(end), _to_us(start))
+            reverse = True
+        else:
+            times, values = ring.window(0, _to_us(start), _to_us(end))
+
+        if reverse:
+            times, values = times[::-1], values[::-1]
+        if nb_values:
+            times, values = times[:nb_values], values[:nb_values]
+
+        cont = None
+        if len(times) > self.max_history_data_response_size:
+            cont = _from_us(times[self.max_history_data_response_size])
+            times = times[:self.max_history_data_response_size]
+            values = values[:self.max_history_data_response_size]
+
+        return [_datavalue(us, value) for us, value in zip(times.tolist(), values.tolist())], cont
+
+    def aggregate(self, node_id, aggregate: ua.NodeId, start: datetime, end: datetime,
+                  interval: float) -> List[ua.DataValue]:
+        """One DataValue per processing interval (in milliseconds, 0 = a single interval) between start and end"""
+        ring = self._rings.get(node_id)
+        if ring is None:
+            raise ua.UaStatusCodeError(ua.StatusCodes.BadHistoryOperationUnsupported)
+        function = _AGGREGATES.get(aggregate)
+        if function is None:
+            raise ua.UaStatusCodeError(ua.StatusCodes.BadAggregateNotSupported)
+        # Unlike a raw read, processed data needs both ends of the period
+        if _is_unspecified(start) or _is_unspecified(end):
+            raise ua.UaStatusCodeError(ua.StatusCodes.BadInvalidTimestampArgument)
+
+        start_us, end_us = _to_us(start), _to_us(end)
+        reverse = start_us > end_us
+        if reverse:
+            start_us, end_us = end_us, start_us
+        interval_us = int(interval * 1000) or max(end_us - start_us, 1)
+        n_buckets = max(-(-(end_us - start_us) // interval_us), 1)
+
+        times, values = ring.window(0, start_us, end_us - 1)
+        buckets = (times - start_us) // interval_us
+        counts = np.bincount(buckets, minlength=n_buckets)
+        results, good = function(values.astype(np.float64), buckets, counts, n_buckets)
+
+        datavalues = []
+        for i in range(n_buckets):
+            timestamp = _from_us(start_us + i * interval_us)
+            if good[i]:
+                datavalues.append(ua.DataValue(ua.Variant(float(results[i]), ua.VariantType.Double),
+                                               SourceTimestamp=timestamp, ServerTimestamp=timestamp))
+            else:
+                datavalues.append(ua.DataValue(StatusCode=ua.StatusCode(ua.StatusCodes.BadNoData),
+                                               SourceTimestamp=timestamp, ServerTimestamp=timestamp))
+        return datavalues[::-1] if reverse else datavalues
+
+
+def _datavalue(us, value):
+    timestamp = _from_us(us)
+    return ua.DataValue(ua.Variant(value, ua.VariantType.Double), SourceTimestamp=timestamp, ServerTimestamp=timestamp)
+
+
+# Vectorized aggregates over the samples of each bucket. The samples are sorted by time, so every bucket is a
+# contiguous run and reduceat can work on the run starts. Each function returns (values, bucket has data)
+
+def _reduce(ufunc):
+    def aggregate(values, buckets, counts, n_buckets):
+        result = np.zeros(n_buckets)
+        if len(values):
+            starts = np.concatenate(([0], np.flatnonzero(np.diff(buckets)) + 1))
+            result[buckets[starts]] = ufunc.reduceat(values, starts)
+        return result, counts > 0
+    return aggregate
+
+
+def _average(values, buckets, counts, n_buckets):
+    sums = np.bincount(buckets, weights=values, minlength=n_buckets)
+    return sums / np.maximum(counts, 1), counts > 0
+
+
+def _count(values, buckets, counts, n_buckets):
+    return counts.astype(np.float64), np.ones(n_buckets, dtype=bool)
+
+
+def _first_or_last(last):
+    def aggregate(values, buckets, counts, n_buckets):
+        result = np.zeros(n_buckets)
+        if len(values):
+            ends = np.flatnonzero(np.diff(buckets))
+            index = np.concatenate((ends, [len(values) - 1])) if last else np.concatenate(([0], ends + 1))
+            result[buckets[index]] = values[index]
+        return result, counts > 0
+    return aggregate
+
+
+def _range(values, buckets, counts, n_buckets):
+    maximum, good = _reduce(np.maximum)(values, buckets, counts, n_buckets)
+    minimum, _ = _reduce(np.minimum)(values, buckets, counts, n_buckets)
+    return maximum - minimum, good
+
+
+_AGGREGATES = {
+    ua.NodeId(ua.ObjectIds.AggregateFunction_Average): _average,
+    ua.NodeId(ua.ObjectIds.AggregateFunction_Minimum): _reduce(np.minimum),
+    ua.NodeId(ua.ObjectIds.AggregateFunction_Maximum): _reduce(np.maximum),
+    ua.NodeId(ua.ObjectIds.AggregateFunction_Total): _reduce(np.add),
+    ua.NodeId(ua.ObjectIds.AggregateFunction_Count): _count,
+    ua.NodeId(ua.ObjectIds.AggregateFunction_Range): _range,
+    ua.NodeId(ua.ObjectIds.AggregateFunction_Start): _first_or_last(last=False),
+    ua.NodeId(ua.ObjectIds.AggregateFunction_End): _first_or_last(last=True),
+}
+
+
+class FridgeHistoryManager(HistoryManager):
+    """History manager answering raw HistoryRead from a RingBufferHistory, and processed ones as well"""
+
+    async def historize_nodes(self, nodes, count=0):
+        """Like historize_data_change, but with a single subscribe call for all the nodes"""
+        if not self._sub:
+            self._sub = await self._create_subscription(SubHandler(self.storage))
+        for node in nodes:
+            await self.storage.new_historized_node(node.nodeid, None, count)
+        handles = await self._sub.subscribe_data_change(nodes)
+        self._handlers.update(zip(nodes, handles))
+
+    async def read_history(self, params):
+        details = params.HistoryReadDetails
+        if not isinstance(details, ua.ReadProcessedDetails):
+            return await super().read_history(params)
+
+        results = []
+        for rv, aggregate in zip(params.NodesToRead, details.AggregateType):
+            result = ua.HistoryReadResult()
+            try:
+                result.HistoryData = ua.HistoryData(DataValues=self.storage.aggregate(
+                    rv.NodeId, aggregate, details.StartTime, details.EndTime, details.ProcessingInterval))
+            except ua.UaStatusCodeError as e:
+                result.StatusCode = ua.StatusCode(e.code)
+            results.append(result)
+        return results
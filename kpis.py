@@ -0,0 +1,70 @@
+import numpy as np
+from fleet import VARIABLES
+
+# Derived indicators of the refrigeration cycle, in the units of the raw variables (K, MPa)
+#   superheat      evaporator outlet temperature above the saturation temperature at the evaporator outlet pressure
+#   subcooling     saturation temperature at the condenser outlet pressure above the condenser outlet temperature
+#   pressureRatio  compressor discharge pressure / evaporator outlet (suction) pressure
+#   evapSatTemp, condSatTemp  the two saturation temperatures
+KPIS = ("superheat", "subcooling", "pressureRatio", "evapSatTemp", "condSatTemp")
+
+# Saturation table of the refrigerant: temperature (K), absolute pressure (MPa)
+REFRIGERANTS = {
+    "R134a": np.array([
+        (233.15, 0.05121), (243.15, 0.08438), (253.15, 0.13273), (263.15, 0.20060), (273.15, 0.29280),
+        (283.15, 0.41461), (293.15, 0.57171), (303.15, 0.77020), (313.15, 1.01660), (323.15, 1.31790),
+        (333.15, 1.68180), (343.15, 2.11680), (353.15, 2.63320), (363.15, 3.24420), (373.15, 3.97240),
+    ]),
+}
+DEFAULT_REFRIGERANT = "R134a"
+
+# Below this a temperature is a sensor fault, not a reading
+MIN_TEMPERATURE = 150.0
+
+
+class SaturationTable:
+    """Saturation temperature from pressure by interpolation in a refrigerant table.
+
+    ln(P) is close to linear in 1/T (Clausius-Clapeyron), so the interpolation is done on those axes:
+    with 10 K steps the error stays far below the resolution of the sensors.
+    """
+    def __init__(self, refrigerant: str = DEFAULT_REFRIGERANT):
+        if refrigerant not in REFRIGERANTS:
+            raise ValueError(f"Unknown refrigerant {refrigerant}, use one of {', '.join(REFRIGERANTS)}")
+        table = REFRIGERANTS[refrigerant]
+        self.refrigerant = refrigerant
+        self.log_pressures = np.log(table[:, 1])
+        self.inverse_temperatures = 1.0 / table[:, 0]
+
+    def temperature(self, pressure: np.ndarray) -> np.ndarray:
+        """Saturation temperature (K) of every pressure (MPa); NaN outside the table"""
+        pressure = np.asarray(pressure, dtype=np.float64)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            log_pressure = np.log(pressure)
+        inside = (log_pressure >= self.log_pressures[0]) & (log_pressure <= self.log_pressures[-1])
+        inverse = np.interp(np.where(inside, log_pressure, self.log_pressures[0]),
+                            self.log_pressures, self.inverse_temperatures)
+        return np.where(inside, 1.0 / inverse, np.nan)
+
+
+def compute_kpis(values: np.ndarray, table: SaturationTable, variables=VARIABLES) -> np.ndarray:
+    """The KPIS of every row of a [fridge, variable] table, as a [fridge, kpi] table (NaN when not computable)"""
+    def column(name):
+        return values[:, variables.index(name)].astype(np.float64)
+
+    def temperature(name):
+        t = column(name)
+        return np.where(t >= MIN_TEMPERATURE, t, np.nan)
+
+    evap_pressure = column("evapOutPres")
+    evap_saturation = table.temperature(evap_pressure)
+    cond_saturation = table.temperature(column("condOutPres"))
+    with np.errstate(invalid="ignore", divide="ignore"):
+        ratio = np.where(evap_pressure > 0, column("compOutPres") / evap_pressure, np.nan)
+    return np.stack([
+        temperature("evapOutTemp") - evap_saturation,
+        cond_saturation - temperature("condOutTemp"),
+        ratio,
+        evap_saturation,
+        cond_saturation,
+    ], axis=1)
@@ -0,0 +1,114 @@
+from asyncua import ua
+from datetime import datetime, timezone
+from fleet import BATCH_SIZE, VARIABLES, FridgeInfo
+import logging
+import numpy as np
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+_logger = logging.getLogger(__name__)
+
+# Publishing interval of the data change subscription, in milliseconds
+PUBLISHING_INTERVAL = 500
+
+
+class LiveValueCache:
+    """Latest value of every fridge variable, kept up to date by data change subscriptions.
+
+    Values and timestamps live in [fridge, variable] arrays, in the order of `fridges` and `variables`,
+    so fleet-wide computations can work on them directly. Timestamps are seconds since the Unix epoch
+    and NaN means that no value has been received yet.
+    """
+    def __init__(self, fridges: List[FridgeInfo], variables=VARIABLES):
+        self.fridges = list(fridges)
+        self.variables = tuple(variables)
+        self.rows = {fridge.path: row for row, fridge in enumerate(self.fridges)}
+        self.positions: Dict[ua.NodeId, Tuple[int, int]] = {}
+        for row, fridge in enumerate(self.fridges):
+            for col, name in enumerate(self.variables):
+                if name in fridge.variables:
+                    self.positions[fridge.variables[name]] = (row, col)
+
+        shape = (len(self.fridges), len(self.variables))
+        self.values = np.full(shape, np.nan)
+        self.source_times = np.full(shape, np.nan)
+        self.received_at = np.full(shape, np.nan)
+        self.updates = 0
+        self.subscription = None
+        self._listeners: List[Callable[[int, int], None]] = []
+
+    def add_listener(self, callback: Callable[[int, int], None]):
+        """callback(row, col) is called after every update of a cell"""
+        self._listeners.append(callback)
+
+    def remove_listener(self, callback: Callable[[int, int], None]):
+        self._listeners.remove(callback)
+
+    async def subscribe(self, client, period: float = PUBLISHING_INTERVAL, batch_size: int = BATCH_SIZE):
+        """Monitors all the variables, batch_size monitored items per CreateMonitoredItems call"""
+        self.subscription = await client.create_subscription(period, self)
+        nodes = [client.get_node(nodeid) for nodeid in self.positions]
+        for first in range(0, len(nodes), batch_size):
+            await self.subscription.subscribe_data_change(nodes[first:first + batch_size])
+        _logger.info(f"Live value cache subscribed to {len(nodes)} variables of {len(self.fridges)} fridges")
+
+    async def close(self):
+        if self.subscription is not None:
+            try:
+                await self.subscription.delete()
+            except Exception as e:
+                _logger.warning(f"Could not delete the live value subscription: {e}")
+            self.subscription = None
+
+    def datachange_notification(self, node, val, data):
+        position = self.positions.get(node.nodeid)
+        if position is None:
+            return
+        row, col = position
+        dv = data.monitored_item.Value
+        now = time.time()
+        good = val is not None and (dv.StatusCode is None or dv.StatusCode.is_good())
+        timestamp = dv.SourceTimestamp or dv.ServerTimestamp
+
+        self.values[row, col] = val if good else np.nan
+        self.source_times[row, col] = timestamp.timestamp() if timestamp else now
+        self.received_at[row, col] = now
+        self.updates += 1
+        for callback in self._listeners:
+            callback(row, col)
+
+    def status_change_notification(self, status):
+        _logger.warning(f"Live value subscription status changed: {status}")
+
+    def select(self, fridges: List[FridgeInfo], variables=None) -> Tuple[List[FridgeInfo], np.ndarray, np.ndarray]:
+        """Values and source timestamps of some fridges and variables, as [fridge, variable] blocks.
+
+        Fridges that are not in the cache are left out of the result.
+        """
+        cols = [self.variables.index(name) for name in (variables or self.variables)]
+        found = [fridge for fridge in fridges if fridge.path in self.rows]
+        rows = [self.rows[fridge.path] for fridge in found]
+        block = np.ix_(rows, cols)
+        return found, self.values[block], self.source_times[block]
+
+    def fridge_data(self, fridge: FridgeInfo) -> Optional[Dict]:
+        """The values of a fridge in the same shape as a direct read, None until all of them have been received"""
+        row = self.rows.get(fridge.path)
+        if row is None:
+            return None
+        cols = [col for col, name in enumerate(self.variables) if name in fridge.variables]
+        if np.isnan(self.received_at[row, cols]).any():
+            return None
+
+        data = {}
+        for col in cols:
+            name = self.variables[col]
+            node_id = fridge.variables[name].to_string()
+            data[node_id] = {
+                "browse_name": name,
+                "node_id": node_id,
+                "value": None if np.isnan(self.values[row, col]) else float(self.values[row, col]),
+                "timestamp": datetime.fromtimestamp(self.source_times[row, col], timezone.utc),
+                "received_at": datetime.fromtimestamp(self.received_at[row, col], timezone.utc),
+            }
+        return data
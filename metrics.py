@@ -0,0 +1,128 @@
+import bisect
+import functools
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+# Latency buckets in seconds, from 0.5 ms to 10 s
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _labels(names: Tuple[str, ...], values: Tuple[str, ...]) -> str:
+    if not names:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n") for v in values)
+    return "{" + ",".join(f'{name}="{value}"' for name, value in zip(names, escaped)) + "}"
+
+
+class Counter:
+    """A value that only goes up; `collect` may compute it at scrape time from counters kept elsewhere"""
+    TYPE = "counter"
+
+    def __init__(self, name: str, help: str, labels: Tuple[str, ...] = (),
+                 collect: Optional[Callable[[], Dict[Tuple[str, ...], float]]] = None):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.collect = collect
+        self.values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, *labels: str, amount: float = 1.0):
+        self.values[labels] = self.values.get(labels, 0.0) + amount
+
+    def render(self) -> List[str]:
+        if self.collect is not None:
+            self.values = self.collect()
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.TYPE}"]
+        lines += [f"{self.name}{_labels(self.labels, key)} {value}" for key, value in sorted(self.values.items())]
+        return lines
+
+
+class Gauge(Counter):
+    """A value that goes up and down"""
+    TYPE = "gauge"
+
+    def set(self, *labels: str, value: float):
+        self.values[labels] = value
+
+
+class Histogram:
+    def __init__(self, name: str, help: str, labels: Tuple[str, ...] = (), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = tuple(buckets)
+        self.series: Dict[Tuple[str, ...], List] = {}  # labels -> [counts per bucket, sum, count]
+
+    def observe(self, *labels: str, value: float):
+        series = self.series.get(labels)
+        if series is None:
+            series = self.series[labels] = [[0] * len(self.buckets), 0.0, 0]
+        index = bisect.bisect_left(self.buckets, value)
+        if index < len(self.buckets):
+            series[0][index] += 1
+        series[1] += value
+        series[2] += 1
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        names = self.labels + ("le",)
+        for key, (counts, total, count) in sorted(self.series.items()):
+            cumulative = 0
+            for bound, n in zip(self.buckets, counts):
+                cumulative += n
+                lines.append(f"{self.name}_bucket{_labels(names, key + (repr(bound),))} {cumulative}")
+            lines.append(f"{self.name}_bucket{_labels(names, key + ('+Inf',))} {count}")
+            lines.append(f"{self.name}_sum{_labels(self.labels, key)} {total}")
+            lines.append(f"{self.name}_count{_labels(self.labels, key)} {count}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        """The Prometheus text exposition format (version 0.0.4)"""
+        lines = []
+        for metric in self.metrics:
+            lines += metric.render()
+        return "\n".join(lines) + "\n"
+
+
+# OPC UA services of UaClient timed by instrument_uaclient
+UA_SERVICES = {
+    "browse": "Browse",
+    "browse_next": "BrowseNext",
+    "read": "Read",
+    "read_attributes": "Read",
+    "translate_browsepaths_to_nodeids": "TranslateBrowsePathsToNodeIds",
+    "create_monitored_items": "CreateMonitoredItems",
+}
+
+
+def instrument_uaclient(uaclient, latency: Histogram, errors: Counter):
+    """Times the service calls of an asyncua UaClient (labels: service), counting the ones that raise"""
+    # Recent asyncua versions send the services from a session object that UaClient and Node both call
+    session = getattr(uaclient, "session", None)
+    target = session if hasattr(session, "read") else uaclient
+    for method, service in UA_SERVICES.items():
+        call = getattr(target, method, None)
+        if call is None:
+            continue
+
+        @functools.wraps(call)
+        async def timed(*args, _call=call, _service=service, **kwargs):
+            start = time.perf_counter()
+            try:
+                return await _call(*args, **kwargs)
+            except Exception:
+                errors.inc(_service)
+                raise
+            finally:
+                latency.observe(_service, value=time.perf_counter() - start)
+
+        setattr(target, method, timed)
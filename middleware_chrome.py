@@ -1,16 +1,39 @@
-from fastapi import FastAPI, HTTPException
-from asyncua import Client, Node
+from fastapi import FastAPI, HTTPException, Query, Request
+from fastapi.responses import Response, StreamingResponse
+from asyncua import Client, Node, ua
 import asyncio
-from typing import Dict, Any, Optional
-from datetime import datetime
+from typing import Dict, Any, List, Optional, Tuple
+from datetime import datetime, timezone
 import uvicorn
 from pydantic import BaseModel
+from contextlib import asynccontextmanager
+import gzip
+import hashlib
+import json
+import numpy as np
 import logging
+import os
+import random
 import re
+import time
+from alarms import AlarmEngine, load_rules
+from fleet import VARIABLES, FridgeInfo, discover_fridges, natural_key
+from kpis import DEFAULT_REFRIGERANT, KPIS, SaturationTable, compute_kpis
+from live_cache import LiveValueCache
+from query import ValueIndex, parse_condition
+from stats import OnlineStats
+from metrics import Counter, Gauge, Histogram, Registry, instrument_uaclient
+from timeseries import DOWNSAMPLING, HISTORY_MEMORY_CAP, SeriesBuffer
 
-# Logging configuration
+# Logging configuration. The log of every request and of every OPC UA message is off unless
+# MIDDLEWARE_VERBOSE=1: on the hot path it costs more than the work it describes
+VERBOSE_LOGGING = os.environ.get("MIDDLEWARE_VERBOSE", "0") == "1"
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
+if VERBOSE_LOGGING:
+    logger.setLevel(logging.DEBUG)
+else:
+    logging.getLogger("asyncua").setLevel(logging.WARNING)
 
 # Pydantic models for the response
 class OPCValue(BaseModel):
@@ -24,22 +47,158 @@ class OPCNodeInfo(BaseModel):
     browse_name: str
     description: Optional[str] = None
 
+class PooledSession:
+    """One OPC UA session of the pool"""
+    def __init__(self, number: int):
+        self.number = number
+        self.client: Optional[Client] = None
+        self.healthy = False
+        self.in_flight = 0
+        self.reconnecting: Optional[asyncio.Task] = None
+
+
 class OPCConnection:
-    def __init__(self, url: str):
+    """A pool of sessions to the OPC UA server.
+
+    Requests take the least loaded healthy session, with at most max_in_flight requests per session.
+    A keep-alive read checks every session every keep_alive seconds; broken sessions are reconnected
+    in the background with exponential backoff. Session 0 is the primary one, where the subscriptions
+    live: on_reconnect coroutines are called every time it comes back.
+    """
+    def __init__(self, url: str, pool_size: int = 4, max_in_flight: int = 8, keep_alive: float = 5.0,
+                 backoff_min: float = 0.5, backoff_max: float = 30.0, acquire_timeout: float = 10.0):
         self.url = url
-        self.client = None
+        self.max_in_flight = max_in_flight
+        self.keep_alive = keep_alive
+        self.backoff_min = backoff_min
+        self.backoff_max = backoff_max
+        self.acquire_timeout = acquire_timeout
+        self.sessions = [PooledSession(i) for i in range(pool_size)]
+        self.on_reconnect = []
+        self.on_open = []  # functions called with every new client, before it is used
+        self.waits = 0
+        self.reconnects = 0
+        self.failures = 0
+        self._available = asyncio.Condition()
+        self._keep_alive_task: Optional[asyncio.Task] = None
+
+    @property
+    def client(self) -> Optional[Client]:
+        """The primary session"""
+        return self.sessions[0].client
+
+    async def _open(self, session: PooledSession):
+        client = Client(url=self.url)
+        for callback in self.on_open:
+            callback(client)
+        await client.connect()
+        session.client = client
+        session.healthy = True
+        async with self._available:
+            self._available.notify_all()
 
     async def connect(self):
-        if not self.client:
-            self.client = Client(url=self.url)
-            await self.client.connect()
-            logger.info(f"Connected to OPC UA server: {self.url}")
+        if self.client is None:
+            await self._open(self.sessions[0])  # the primary must be there at startup
+            for session in self.sessions[1:]:
+                try:
+                    await self._open(session)
+                except Exception as e:
+                    logger.warning(f"Session {session.number} not connected: {e}")
+                    self._schedule_reconnect(session)
+            self._keep_alive_task = asyncio.create_task(self._keep_alive())
+            logger.info(f"Connected to OPC UA server: {self.url} ({len(self.sessions)} sessions)")
 
     async def disconnect(self):
-        if self.client:
-            await self.client.disconnect()
-            self.client = None
-            logger.info("Disconnected from OPC UA server")
+        if self._keep_alive_task is not None:
+            self._keep_alive_task.cancel()
+            self._keep_alive_task = None
+        for session in self.sessions:
+            if session.reconnecting is not None:
+                session.reconnecting.cancel()
+            if session.client is not None:
+                try:
+                    await session.client.disconnect()
+                except Exception:
+                    pass
+            session.client = None
+            session.healthy = False
+        logger.info("Disconnected from OPC UA server")
+
+    async def _keep_alive(self):
+        while True:
+            await asyncio.sleep(self.keep_alive)
+            for session in self.sessions:
+                if not session.healthy:
+                    continue
+                try:
+                    await asyncio.wait_for(session.client.nodes.server_state.read_value(), self.keep_alive)
+                except Exception as e:
+                    logger.warning(f"Session {session.number} lost: {e!r}")
+                    self.mark_broken(session)
+
+    def mark_broken(self, session: PooledSession):
+        if session.healthy:
+            session.healthy = False
+            self.failures += 1
+            self._schedule_reconnect(session)
+
+    def _schedule_reconnect(self, session: PooledSession):
+        if session.reconnecting is None or session.reconnecting.done():
+            session.reconnecting = asyncio.create_task(self._reconnect(session))
+
+    async def _reconnect(self, session: PooledSession):
+        attempt = 0
+        while True:
+            if session.client is not None:
+                try:
+                    await session.client.disconnect()
+                except Exception:
+                    pass
+                session.client = None
+            try:
+                await self._open(session)
+                break
+            except Exception as e:
+                delay = min(self.backoff_max, self.backoff_min * 2 ** attempt) * random.uniform(0.5, 1.0)
+                attempt += 1
+                logger.warning(f"Reconnection of session {session.number} failed ({e!r}), retrying in {delay:.1f}s")
+                await asyncio.sleep(delay)
+        self.reconnects += 1
+        logger.info(f"Session {session.number} reconnected after {attempt} failed attempts")
+        if session.number == 0:
+            for callback in self.on_reconnect:
+                try:
+                    await callback()
+                except Exception as e:
+                    logger.error(f"Error restoring the primary session: {e}")
+
+    def _pick(self) -> Optional[PooledSession]:
+        candidates = [s for s in self.sessions if s.healthy and s.in_flight < self.max_in_flight]
+        return min(candidates, key=lambda s: s.in_flight) if candidates else None
+
+    @asynccontextmanager
+    async def session(self):
+        """A client of the least loaded healthy session, waiting when all of them are busy"""
+        session = self._pick()
+        if session is None:
+            self.waits += 1
+            async with self._available:
+                try:
+                    session = await asyncio.wait_for(self._available.wait_for(self._pick), self.acquire_timeout)
+                except asyncio.TimeoutError:
+                    raise ConnectionError("No OPC UA session available")
+        session.in_flight += 1
+        try:
+            yield session.client
+        except (ConnectionError, asyncio.TimeoutError, ua.UaError) as e:
+            if not isinstance(e, ua.UaStatusCodeError):  # a Bad status is an answer, the session is fine
+                self.mark_broken(session)
+            raise
+        finally:
+            session.in_flight -= 1
+            async with self._available:
+                self._available.notify_all()
 
     async def get_node(self, node_id: str) -> Node:
         if not self.client:
@@ -49,70 +208,685 @@ class OPCConnection:
     async def get_objects_node(self):
         if not self.client:
             await self.connect()
-        return await self.client.get_objects_node()
+        return self.client.nodes.objects
+
+    @property
+    def available(self) -> bool:
+        return any(session.healthy for session in self.sessions)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "pool_size": len(self.sessions),
+            "healthy": sum(session.healthy for session in self.sessions),
+            "in_flight": sum(session.in_flight for session in self.sessions),
+            "max_in_flight_per_session": self.max_in_flight,
+            "waits": self.waits,
+            "failures": self.failures,
+            "reconnects": self.reconnects,
+        }
+
+# In-memory index of the address space: Supermarket/Location/Fridge -> NodeIds of the fridge and its variables.
+# It is built with a few batched Browse calls and refreshed on ModelChange events or when older than ttl seconds
+class AddressSpaceIndex:
+    def __init__(self, ttl: float = 300.0):
+        self.ttl = ttl
+        self.fridges: Dict[Tuple[str, str, str], FridgeInfo] = {}
+        self.tree: Dict[str, Dict[str, List[str]]] = {}
+        self.built_at = 0.0
+        self.stale = True
+        self.on_refresh = []  # coroutines called with the new list of fridges after every refresh
+        self._lock = asyncio.Lock()
+
+    async def refresh(self, client: Client):
+        objects = {}
+        fridges = await discover_fridges(client, objects=objects)
+
+        # Supermarkets and locations are listed even when they have no fridge yet
+        tree = {}
+        for path in sorted(objects, key=natural_key):
+            if len(path) == 1:
+                tree.setdefault(path[0], {})
+            elif len(path) == 2:
+                tree.setdefault(path[0], {}).setdefault(path[1], [])
+        for fridge in fridges:
+            tree.setdefault(fridge.supermarket, {}).setdefault(fridge.location, []).append(fridge.name)
+
+        self.fridges = {(fridge.supermarket, fridge.location, fridge.name): fridge for fridge in fridges}
+        self.tree = tree
+        self.built_at = time.monotonic()
+        self.stale = False
+        logger.info(f"Address space index built: {len(tree)} supermarkets, {len(fridges)} fridges")
+        for callback in self.on_refresh:
+            await callback(fridges)
+
+    def invalidate(self):
+        self.stale = True
+
+    @property
+    def expired(self) -> bool:
+        return self.stale or time.monotonic() - self.built_at > self.ttl
+
+    async def ensure_fresh(self, client: Client):
+        if self.expired:
+            async with self._lock:
+                if self.expired:  # someone else may have refreshed it
+                    await self.refresh(client)
+
+    def locations(self, supermarket_id: str) -> Dict[str, List[str]]:
+        if supermarket_id not in self.tree:
+            raise HTTPException(status_code=404, detail=f"Unknown supermarket {supermarket_id}")
+        return self.tree[supermarket_id]
+
+    def fridge_names(self, supermarket_id: str, location_id: str) -> List[str]:
+        locations = self.locations(supermarket_id)
+        if location_id not in locations:
+            raise HTTPException(status_code=404, detail=f"Unknown location {location_id} in {supermarket_id}")
+        return locations[location_id]
+
+    def fridge(self, supermarket_id: str, location_id: str, fridge_id: str) -> FridgeInfo:
+        fridge = self.fridges.get((supermarket_id, location_id, fridge_id))
+        if fridge is None:
+            raise HTTPException(status_code=404,
+                                detail=f"Unknown fridge {fridge_id} in {location_id}, {supermarket_id}")
+        return fridge
+
+    def fridges_in(self, supermarket_id: Optional[str] = None, location_id: Optional[str] = None,
+                   fridge_id: Optional[str] = None) -> List[FridgeInfo]:
+        """The fridges of the whole fleet, of a supermarket, of a location or a single one"""
+        if fridge_id is not None:
+            return [self.fridge(supermarket_id, location_id, fridge_id)]
+        if location_id is not None:
+            return [self.fridges[(supermarket_id, location_id, name)]
+                    for name in self.fridge_names(supermarket_id, location_id)]
+        if supermarket_id is not None:
+            return [self.fridges[(supermarket_id, location, name)]
+                    for location, names in self.locations(supermarket_id).items() for name in names]
+        return [self.fridges[(supermarket, location, name)]
+                for supermarket, locations in self.tree.items()
+                for location, names in locations.items() for name in names]
+
+
+class ModelChangeHandler:
+    """Invalidates the index when the server reports a change of the address space"""
+    def __init__(self, index: AddressSpaceIndex):
+        self.index = index
+
+    def event_notification(self, event):
+        logger.info("Model change event received, address space index invalidated")
+        self.index.invalidate()
+
+
+# Streaming of live values (Server-Sent Events). Every client has its own set of changed cells: a change of a cell
+# that has not been sent yet replaces the pending one, so a slow client gets fewer, newer frames and never a queue
+STREAM_MAX_RATE = 2.0  # default frames per second per client
+STREAM_MAX_RATE_LIMIT = 20.0
+STREAM_KEEP_ALIVE = 15.0  # seconds without changes before a keep-alive comment
+
+class StreamClient:
+    def __init__(self, paths: List[Tuple[str, ...]], max_rate: float):
+        self.paths = set(paths)
+        self.min_interval = 1.0 / max_rate
+        self.dirty: Dict[Tuple[str, ...], set] = {}
+        self.wakeup = asyncio.Event()
+        self.coalesced = 0
+
+    def mark(self, path: Tuple[str, ...], col: int):
+        cols = self.dirty.setdefault(path, set())
+        if col in cols:
+            self.coalesced += 1
+        cols.add(col)
+        self.wakeup.set()
+
+    def take(self) -> Dict[Tuple[str, ...], set]:
+        dirty, self.dirty = self.dirty, {}
+        self.wakeup.clear()
+        return dirty
+
+
+class LiveStreams:
+    """Fan-out of the changes of the live value cache to the streaming clients"""
+    def __init__(self):
+        self.clients: Dict[Tuple[str, ...], set] = {}  # fridge path -> clients watching it
+
+    def add(self, client: StreamClient):
+        for path in client.paths:
+            self.clients.setdefault(path, set()).add(client)
+
+    def remove(self, client: StreamClient):
+        for path in client.paths:
+            watchers = self.clients.get(path)
+            if watchers is not None:
+                watchers.discard(client)
+                if not watchers:
+                    del self.clients[path]
+
+    def listener(self, cache: LiveValueCache):
+        def notify(row: int, col: int):
+            path = cache.fridges[row].path
+            for client in self.clients.get(path, ()):
+                client.mark(path, col)
+        return notify
+
+
+def _stream_values(cache: LiveValueCache, changes: Dict[Tuple[str, ...], set]) -> Dict:
+    values = {}
+    for path, cols in changes.items():
+        row = cache.rows.get(path)
+        if row is None:
+            continue
+        fridge = cache.fridges[row]
+        for col in sorted(cols):
+            if np.isnan(cache.received_at[row, col]):
+                continue
+            name = cache.variables[col]
+            node_id = fridge.variables[name].to_string()
+            value = cache.values[row, col]
+            values[node_id] = {
+                "browse_name": name,
+                "node_id": node_id,
+                "value": None if np.isnan(value) else float(value),
+                "timestamp": datetime.fromtimestamp(cache.source_times[row, col], timezone.utc).isoformat(),
+            }
+    return values
+
+
+# Compression of the responses, negotiated with Accept-Encoding. brotli is optional
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESS_MIN_SIZE = 1024  # bytes; smaller bodies are sent as they are
+
+
+def _accepted_encodings(request: Request) -> set:
+    accepted = set()
+    for part in request.headers.get("accept-encoding", "").split(","):
+        coding, _, params = part.strip().partition(";")
+        if coding and params.replace(" ", "") not in ("q=0", "q=0.0", "q=0.00", "q=0.000"):
+            accepted.add(coding.lower())
+    return accepted
+
+
+class EncodedBody:
+    """A response body, with its compressed variants made on first use and then kept"""
+    def __init__(self, body: bytes, media_type: str, etag: Optional[str] = None):
+        self.media_type = media_type
+        self.etag = etag
+        self.variants = {"identity": body}
+
+    def encoded(self, encoding: str) -> bytes:
+        body = self.variants.get(encoding)
+        if body is None:
+            if encoding == "br":
+                body = brotli.compress(self.variants["identity"], quality=4)
+            else:
+                body = gzip.compress(self.variants["identity"], compresslevel=5)
+            self.variants[encoding] = body
+        return body
+
+    def response(self, request: Request) -> Response:
+        headers = {"Vary": "Accept-Encoding"}
+        if self.etag is not None:
+            headers["ETag"] = self.etag
+            if _etag_matches(request, self.etag):
+                return Response(status_code=304, headers=headers)
+
+        encoding = "identity"
+        if len(self.variants["identity"]) >= COMPRESS_MIN_SIZE:
+            accepted = _accepted_encodings(request)
+            if brotli is not None and "br" in accepted:
+                encoding = "br"
+            elif "gzip" in accepted:
+                encoding = "gzip"
+        if encoding != "identity":
+            headers["Content-Encoding"] = encoding
+        return Response(self.encoded(encoding), media_type=self.media_type, headers=headers)
+
+
+def _etag_matches(request: Request, etag: str) -> bool:
+    if_none_match = request.headers.get("if-none-match")
+    if not if_none_match:
+        return False
+    tags = [tag.strip() for tag in if_none_match.split(",")]
+    return "*" in tags or etag in tags or f"W/{etag}" in tags
+
+
+def _json_default(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+
+def fridge_body(data: Dict) -> EncodedBody:
+    """The JSON of a fridge, with an ETag made from the SourceTimestamps of its variables"""
+    stamps = "|".join(f"{node_id}@{item['timestamp'].isoformat()}" for node_id, item in data.items())
+    etag = '"' + hashlib.sha1(stamps.encode()).hexdigest()[:20] + '"'
+    return EncodedBody(json.dumps(data, default=_json_default).encode(), "application/json", etag)
+
+
+# Binary encodings of the snapshot are optional
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import pyarrow
+    import pyarrow.ipc
+except ImportError:
+    pyarrow = None
+
+SNAPSHOT_FORMATS = ("json", "columnar", "msgpack", "arrow")
+
+
+def _nan_to_none(values: np.ndarray) -> list:
+    return [None if value != value else value for value in values.tolist()]
+
+
+def _newest(times: np.ndarray) -> np.ndarray:
+    """Newest timestamp of every row, NaN for rows that have none"""
+    newest = np.where(np.isnan(times), -np.inf, times).max(axis=1, initial=-np.inf)
+    return np.where(np.isinf(newest), np.nan, newest)
+
+
+def _snapshot_columns(fridges: List[FridgeInfo], names: List[str], values: np.ndarray,
+                      times: np.ndarray) -> Dict[str, list]:
+    """One column per variable plus the fridge path and the newest source timestamp of each fridge"""
+    updated = _newest(times)
+    columns = {
+        "supermarket": [fridge.supermarket for fridge in fridges],
+        "location": [fridge.location for fridge in fridges],
+        "fridge": [fridge.name for fridge in fridges],
+        "updated_at": _nan_to_none(updated),
+    }
+    for col, name in enumerate(names):
+        columns[name] = _nan_to_none(values[:, col])
+    return columns
+
+
+# Identical concurrent requests share one fetch, and its result is kept for a short time to absorb bursts
+FRIDGE_MICRO_CACHE_TTL = 0.5  # seconds, 0 disables the micro-cache and only coalesces
+
+class SingleFlight:
+    """Calls of do() with the same key while a fetch is running wait for that fetch instead of starting another"""
+    def __init__(self, ttl: float = FRIDGE_MICRO_CACHE_TTL, max_entries: int = 10000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.coalesced = 0
+        self.misses = 0
+        self._in_flight: Dict[Any, asyncio.Task] = {}
+        self._results: Dict[Any, Tuple[float, Any]] = {}
+
+    async def do(self, key, fetch):
+        entry = self._results.get(key)
+        if entry is not None and entry[0] > time.monotonic():
+            self.hits += 1
+            return entry[1]
+
+        task = self._in_flight.get(key)
+        if task is not None:
+            self.coalesced += 1
+        else:
+            self.misses += 1
+            # The fetch runs in its own task, so a caller that goes away does not cancel it for the others
+            task = asyncio.ensure_future(fetch())
+            self._in_flight[key] = task
+            task.add_done_callback(lambda done: self._done(key, done))
+        return await asyncio.shield(task)
+
+    def _done(self, key, task: asyncio.Task):
+        del self._in_flight[key]
+        if task.cancelled() or task.exception() is not None or self.ttl <= 0:
+            return
+        now = time.monotonic()
+        if len(self._results) >= self.max_entries:
+            self._results = {k: entry for k, entry in self._results.items() if entry[0] > now}
+            if len(self._results) >= self.max_entries:
+                self._results.clear()
+        self._results[key] = (now + self.ttl, task.result())
+
+    def stats(self) -> Dict[str, Any]:
+        requests = self.hits + self.coalesced + self.misses
+        return {
+            "hits": self.hits,
+            "coalesced": self.coalesced,
+            "misses": self.misses,
+            "hit_rate": (self.hits + self.coalesced) / requests if requests else 0.0,
+            "in_flight": len(self._in_flight),
+            "ttl": self.ttl,
+        }
+
 
 # Global connection instance
 opc_connection = OPCConnection("opc.tcp://localhost:3005")
+address_space = AddressSpaceIndex()
+live_values: Optional[LiveValueCache] = None
+live_streams = LiveStreams()
+fridge_reads = SingleFlight()
+
+# Recent history of the charted variables (HISTORY_VARIABLES, comma separated), fed by the live value cache.
+# HISTORY_DEPTH samples are kept per variable, fewer if the fleet does not fit in HISTORY_MEMORY MiB
+HISTORY_VARIABLES = tuple(os.environ.get("HISTORY_VARIABLES", "tempC1,tempC2,tempC3").split(","))
+HISTORY_DEPTH = int(os.environ.get("HISTORY_DEPTH", 4 * 3600))
+HISTORY_MEMORY = int(os.environ.get("HISTORY_MEMORY", HISTORY_MEMORY_CAP // (1024 * 1024))) * 1024 * 1024
+HISTORY_MAX_POINTS = 5000
+if not set(HISTORY_VARIABLES) <= set(VARIABLES):
+    raise ValueError(f"Unknown HISTORY_VARIABLES {', '.join(sorted(set(HISTORY_VARIABLES) - set(VARIABLES)))}")
+live_history: Optional[SeriesBuffer] = None
+live_history_paths: List[Tuple[str, ...]] = []
+
+# Alarm rules (a JSON file in ALARM_RULES, or the defaults of alarms.py), evaluated on every sample as the
+# live value cache receives it. Conditions that hold without new samples are raised when their duration ends;
+# the snapshots of the fleet (queries, KPIs) are rebuilt at most every ALARM_PERIOD seconds
+ALARM_PERIOD = 0.5
+ALARM_QUEUE_SIZE = 1000  # alarm events waiting for a slow stream client before the oldest are dropped
+alarm_rules = load_rules(os.environ.get("ALARM_RULES"))
+alarm_engine: Optional[AlarmEngine] = None
+alarm_clients: set = set()
+
+# Running statistics and anomaly scores of every fridge variable, fed by the live value cache like the alarms;
+# the peer scores compare the whole fleet and are computed by the analysis loop
+live_stats: Optional[OnlineStats] = None
+
+# Sorted index of the current values for the fleet queries, rebuilt by the same loop
+fleet_index: Optional[ValueIndex] = None
+fleet_index_built_at = 0.0
+QUERY_MAX_TOP = 10000
+
+# Superheat, subcooling and pressure ratio of every fridge, recomputed by the same loop
+# (REFRIGERANT selects the saturation table, R134a by default)
+saturation_table = SaturationTable(os.environ.get("REFRIGERANT", DEFAULT_REFRIGERANT))
+fleet_kpis: Optional[np.ndarray] = None
+fleet_kpis_rows: Dict[Tuple[str, str, str], int] = {}
 
 app = FastAPI()
 
+# Metrics, served in the Prometheus text format at /metrics
+metrics = Registry()
+HTTP_LATENCY = metrics.register(Histogram(
+    "middleware_http_request_duration_seconds", "Time to answer an HTTP request, by route", ("method", "route")))
+HTTP_ERRORS = metrics.register(Counter(
+    "middleware_http_errors_total", "HTTP requests answered with a 5xx status or an exception", ("route",)))
+HTTP_IN_FLIGHT = metrics.register(Gauge(
+    "middleware_http_requests_in_flight", "HTTP requests being answered"))
+UA_LATENCY = metrics.register(Histogram(
+    "middleware_opcua_service_duration_seconds", "Time of the OPC UA service calls", ("service",)))
+UA_ERRORS = metrics.register(Counter(
+    "middleware_opcua_service_errors_total", "OPC UA service calls that failed", ("service",)))
+FRIDGE_SOURCE = metrics.register(Counter(
+    "middleware_fridge_data_total", "Fridge data fetches, by source: live value cache or Read", ("source",)))
+metrics.register(Gauge(
+    "middleware_opcua_sessions", "Sessions of the OPC UA pool, by state", ("state",),
+    collect=lambda: {("healthy",): opc_connection.stats()["healthy"],
+                     ("broken",): len(opc_connection.sessions) - opc_connection.stats()["healthy"]}))
+metrics.register(Gauge(
+    "middleware_opcua_requests_in_flight", "Requests using an OPC UA session of the pool",
+    collect=lambda: {(): opc_connection.stats()["in_flight"]}))
+metrics.register(Counter(
+    "middleware_opcua_pool_events_total", "Waits for a session, session failures and reconnections", ("event",),
+    collect=lambda: {(event,): opc_connection.stats()[event] for event in ("waits", "failures", "reconnects")}))
+metrics.register(Counter(
+    "middleware_fridge_reads_total", "Coalescing of get_fridge_data: micro-cache hits, coalesced requests, misses",
+    ("result",), collect=lambda: {(result,): fridge_reads.stats()[result] for result in ("hits", "coalesced", "misses")}))
+metrics.register(Gauge(
+    "middleware_fridge_reads_hit_rate", "Share of get_fridge_data requests that did not start a fetch",
+    collect=lambda: {(): fridge_reads.stats()["hit_rate"]}))
+metrics.register(Counter(
+    "middleware_live_value_updates_total", "Data change notifications received by the live value cache",
+    collect=lambda: {(): live_values.updates if live_values is not None else 0}))
+metrics.register(Gauge(
+    "middleware_stream_clients", "Clients of the streaming endpoints",
+    collect=lambda: {(): len(set().union(*live_streams.clients.values()))}))
+
+ALARM_EVALUATION = metrics.register(Histogram(
+    "middleware_alarm_evaluation_duration_seconds", "Time of a check of the alarm durations on the fleet"))
+ALARM_EVENTS = metrics.register(Counter(
+    "middleware_alarm_events_total", "Alarms raised and cleared", ("severity", "state")))
+metrics.register(Gauge(
+    "middleware_alarms_active", "Active alarms, by severity", ("severity",),
+    collect=lambda: _active_alarm_counts()))
+
+QUERY_INDEX_BUILD = metrics.register(Histogram(
+    "middleware_query_index_build_duration_seconds", "Time to sort the current values of the fleet for the queries"))
+KPI_UPDATE = metrics.register(Histogram(
+    "middleware_kpi_update_duration_seconds", "Time to compute the KPIs of the fleet"))
+STATS_UPDATE = metrics.register(Histogram(
+    "middleware_stats_update_duration_seconds", "Time to compute the peer anomaly scores of the fleet"))
+
+def _active_alarm_counts() -> Dict[Tuple[str, ...], float]:
+    counts = {}
+    if alarm_engine is not None:
+        per_rule = alarm_engine.active.sum(axis=0)
+        for rule, count in zip(alarm_engine.rules, per_rule.tolist()):
+            counts[(rule.severity,)] = counts.get((rule.severity,), 0) + count
+    return counts
+
+opc_connection.on_open.append(lambda client: instrument_uaclient(client.uaclient, UA_LATENCY, UA_ERRORS))
+
+
+@app.middleware("http")
+async def measure_requests(request: Request, call_next):
+    HTTP_IN_FLIGHT.inc(amount=1)
+    start = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        HTTP_IN_FLIGHT.inc(amount=-1)
+        route = request.scope.get("route")
+        path = route.path if route is not None else "unmatched"
+        HTTP_LATENCY.observe(request.method, path, value=time.perf_counter() - start)
+        if status >= 500:
+            HTTP_ERRORS.inc(path)
+
+
+@app.get("/metrics")
+async def get_metrics():
+    return Response(metrics.render(), media_type="text/plain; version=0.0.4")
+
+
+# The live values follow the index: a new subscription is made every time the fridges change
+def history_recorder(cache: LiveValueCache, history: SeriesBuffer):
+    # column of the history of every variable of the cache, None when it is not kept
+    columns = [HISTORY_VARIABLES.index(name) if name in HISTORY_VARIABLES else None for name in VARIABLES]
+
+    def record(row: int, col: int):
+        column = columns[col]
+        if column is None:
+            return
+        value = cache.values[row, col]
+        if not np.isnan(value):
+            history.append(history.series(row, column), cache.source_times[row, col], value)
+    return record
+
+def alarm_listener(cache: LiveValueCache, engine: AlarmEngine):
+    def evaluate(row: int, col: int):
+        events = engine.update(row, col, cache.values[row, col], cache.source_times[row, col])
+        if events:
+            publish_alarms(events)
+    return evaluate
+
+def stats_recorder(cache: LiveValueCache, stats: OnlineStats):
+    def record(row: int, col: int):
+        stats.add(row, col, cache.values[row, col], cache.source_times[row, col])
+    return record
+
+async def rebuild_live_values(fridges: List[FridgeInfo]):
+    global live_values, live_history, live_history_paths, alarm_engine, live_stats
+    paths = [f.path for f in fridges]
+    if live_values is not None and [f.path for f in live_values.fridges] == paths:
+        return
+    # The history survives a reconnection, but not a change of the fridges
+    if live_history is None or live_history_paths != paths:
+        live_history = SeriesBuffer(len(fridges), len(HISTORY_VARIABLES), HISTORY_DEPTH, HISTORY_MEMORY)
+        live_history_paths = paths
+        alarm_engine = AlarmEngine(fridges, alarm_rules)
+        live_stats = OnlineStats(fridges)
+    cache = LiveValueCache(fridges)
+    cache.add_listener(live_streams.listener(cache))
+    cache.add_listener(history_recorder(cache, live_history))
+    cache.add_listener(alarm_listener(cache, alarm_engine))
+    cache.add_listener(stats_recorder(cache, live_stats))
+    try:
+        await cache.subscribe(opc_connection.client)
+    except Exception as e:
+        logger.warning(f"Live value subscription failed, fridge data is read on demand: {e}")
+        await cache.close()
+        cache = None
+    old, live_values = live_values, cache
+    if old is not None:
+        await old.close()
+
+# Index refresh and subscriptions of the primary session, at startup and after every reconnection
+async def attach_primary():
+    await address_space.refresh(opc_connection.client)
+    try:
+        subscription = await opc_connection.client.create_subscription(1000, ModelChangeHandler(address_space))
+        await subscription.subscribe_events(opc_connection.client.nodes.server,
+                                            ua.ObjectIds.BaseModelChangeEventType)
+    except Exception as e:
+        logger.warning(f"No ModelChange events, the address space index relies on its TTL: {e}")
+
+async def restore_primary():
+    global live_values
+    old, live_values = live_values, None  # its subscription died with the old session
+    if old is not None:
+        await old.close()
+    await attach_primary()
+
+async def fresh_index():
+    """Refreshes the index only when it is stale; while the server is unreachable the last one is served"""
+    if not address_space.expired:
+        return
+    built = address_space.built_at > 0
+    if built and not opc_connection.available:
+        return
+    try:
+        async with opc_connection.session() as client:
+            await address_space.ensure_fresh(client)
+    except (ConnectionError, asyncio.TimeoutError, ua.UaError) as e:
+        if not built:
+            raise HTTPException(status_code=503, detail=f"OPC UA server not available: {e}")
+        logger.warning(f"Address space index not refreshed, serving the last one: {e}")
+
 @app.on_event("startup")
 async def startup_event():
     await opc_connection.connect()
+    address_space.on_refresh.append(rebuild_live_values)
+    opc_connection.on_reconnect.append(restore_primary)
+    await attach_primary()
+    global alarm_task
+    alarm_task = asyncio.create_task(analyse_live_values())
 
 @app.on_event("shutdown")
 async def shutdown_event():
+    alarm_task.cancel()
     await opc_connection.disconnect()
 
-async def read_node_value(node: Node) -> Dict:
-    """Reads the value of an OPC UA node"""
-    try:
-        value = await node.read_value()
-        dv = await node.read_data_value()
-        browse_name = await node.read_browse_name()
-        
-        return {
-            "browse_name": browse_name.Name,
-            "node_id": node.nodeid.to_string(),
-            "value": value,
+alarm_task: Optional[asyncio.Task] = None
+
+def rebuild_fleet_index(cache: LiveValueCache):
+    global fleet_index, fleet_index_built_at
+    start = time.perf_counter()
+    fleet_index = ValueIndex(cache.values)
+    fleet_index_built_at = time.time()
+    QUERY_INDEX_BUILD.observe(value=time.perf_counter() - start)
+
+def update_kpis(cache: LiveValueCache):
+    global fleet_kpis, fleet_kpis_rows
+    start = time.perf_counter()
+    fleet_kpis = compute_kpis(cache.values, saturation_table)
+    fleet_kpis_rows = cache.rows
+    KPI_UPDATE.observe(value=time.perf_counter() - start)
+
+async def analyse_live_values():
+    updates = -1
+    while True:
+        # Wakes up when the first alarm duration ends, if that comes before the next pass
+        deadline = alarm_engine.next_deadline() if alarm_engine is not None else None
+        await asyncio.sleep(ALARM_PERIOD if deadline is None else min(max(deadline - time.time(), 0), ALARM_PERIOD))
+        cache, engine, stats = live_values, alarm_engine, live_stats
+        if cache is None or engine is None or len(cache.fridges) != len(engine.fridges):
+            continue
+        # An error in one pass must not end the task: alarms, stats, query and KPIs would silently freeze
+        try:
+            start = time.perf_counter()
+            publish_alarms(engine.expire())
+            ALARM_EVALUATION.observe(value=time.perf_counter() - start)
+            if cache.updates != updates:
+                updates = cache.updates
+                analyse(cache, stats)
+        except Exception:
+            logger.exception("Error analysing the live values")
+
+def analyse(cache: LiveValueCache, stats: OnlineStats):
+    start = time.perf_counter()
+    stats.score_peers()
+    STATS_UPDATE.observe(value=time.perf_counter() - start)
+    rebuild_fleet_index(cache)
+    update_kpis(cache)
+
+def publish_alarms(events: List[Dict]):
+    for event in events:
+        ALARM_EVENTS.inc(event["severity"], event["state"])
+        logger.info(f"Alarm {event['state']}: {event['rule']} on {event['supermarket']}.{event['location']}."
+                    f"{event['fridge']}.{event['variable']} = {event['value']} (limit {event['limit']})")
+        for queue in alarm_clients:
+            if queue.full():
+                queue.get_nowait()
+            queue.put_nowait(event)
+
+async def read_fridge_values(client: Client, fridge: FridgeInfo) -> Dict:
+    """Reads all the variables of a fridge with a single Read service call"""
+    names = list(fridge.variables)
+    params = ua.ReadParameters(
+        TimestampsToReturn=ua.TimestampsToReturn.Source,
+        NodesToRead=[ua.ReadValueId(NodeId=fridge.variables[name], AttributeId=ua.AttributeIds.Value)
+                     for name in names],
+    )
+    results = await client.uaclient.read(params)
+
+    data = {}
+    for name, dv in zip(names, results):
+        node_id = fridge.variables[name].to_string()
+        if not dv.StatusCode.is_good():
+            logger.error(f"Error reading node {node_id}: {dv.StatusCode}")
+            continue
+        # The browse name is the key of the variable in the index, no need to read it
+        data[node_id] = {
+            "browse_name": name,
+            "node_id": node_id,
+            "value": dv.Value.Value,
             "timestamp": dv.SourceTimestamp or datetime.now(),
             # "quality": str(dv.StatusCode)
         }
-    except Exception as e:
-        logger.error(f"Error reading node {node.nodeid}: {e}")
-        raise HTTPException(status_code=500, detail=str(e))
+    return data
+
+# State of the OPC UA session pool
+@app.get("/api/pool")
+async def get_pool_stats():
+    return opc_connection.stats()
+
+# Counters of the request coalescing of get_fridge_data
+@app.get("/api/coalescing")
+async def get_coalescing_stats():
+    return fridge_reads.stats()
 
 # Get supermarkets, return a list of supermarket names
 @app.get("/api/supermarkets")
 async def get_supermarkets():
     try:
         # Log all'inizio della funzione per vedere se viene eseguita
-        logger.info("Fetching supermarkets...")
+        logger.debug("Fetching supermarkets...")
+        await fresh_index()
 
-        # Recupera il nodo "Objects"
-        objects = await opc_connection.client.nodes.root.get_child("0:Objects")
-        namespace = "http://examples.factory.github.io"
-        nsidx = await opc_connection.client.get_namespace_index(namespace)
-
-        # Ottieni i figli del nodo "Objects" (Supermercati)
-        supermarkets = await objects.get_children()
-
-        # Logga i nodi trovati
-        logger.info(f"Found nodes: {supermarkets}")
-
-        # Compila l'espressione regolare
+        # I supermercati vengono dall'indice in memoria, nessuna chiamata al server
         supermarket_pattern = re.compile(r"^Supermarket\d+$")
-        identified_supermarkets = {}
-
-        # Cicla attraverso i nodi trovati
-        for supermarket in supermarkets:
-            browse_name = await supermarket.read_browse_name()  # Ottieni il browse_name del nodo
-            logger.info(f"Node ID: {supermarket.nodeid}, Browse Name: {browse_name}")
-
-            # Confronta il browse_name con l'espressione regolare
-            if supermarket_pattern.match(browse_name.Name):
-                logger.info(f"Identified supermarket: {browse_name.Name}")
-                identified_supermarkets[browse_name.Name] = browse_name.Name
+        identified_supermarkets = {name: name for name in address_space.tree if supermarket_pattern.match(name)}
 
         # Se non sono stati trovati supermercati, restituisci un messaggio vuoto
         if not identified_supermarkets:
@@ -121,6 +895,8 @@ async def get_supermarkets():
         # Restituisce i supermercati trovati
         return identified_supermarkets
 
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error retrieving supermarkets: {e}")
         raise HTTPException(status_code=500, detail=str(e))
@@ -131,41 +907,22 @@ async def get_supermarkets():
 async def get_supermarket_locations(supermarket_id: str):
     try:
         # Log all'inizio della funzione per vedere se viene eseguita
-        logger.info("Fetching locations...")
-
-        # Recupera il nodo "Objects"
-        objects = await opc_connection.client.nodes.root.get_child("0:Objects")
-        namespace = "http://examples.factory.github.io"
-        nsidx = await opc_connection.client.get_namespace_index(namespace)
-        supermarket = await objects.get_child(f"{nsidx}:{supermarket_id}")
-
-        # Ottieni i figli del nodo "Objects" (Supermercati)
-        locations = await supermarket.get_children()
+        logger.debug("Fetching locations...")
+        await fresh_index()
 
-        # Logga i nodi trovati
-        logger.info(f"Found nodes: {locations}")
-
-        # Compila l'espressione regolare
         location_pattern = re.compile(r"^Location\d+$")
-        identified_locations = {}
-
-        # Cicla attraverso i nodi trovati
-        for location in locations:
-            browse_name = await location.read_browse_name()  # Ottieni il browse_name del nodo
-            logger.info(f"Node ID: {location.nodeid}, Browse Name: {browse_name}")
-
-            # Confronta il browse_name con l'espressione regolare
-            if location_pattern.match(browse_name.Name):
-                logger.info(f"Identified location: {browse_name.Name}")
-                identified_locations[browse_name.Name] = browse_name.Name
+        identified_locations = {
+            name: name for name in address_space.locations(supermarket_id) if location_pattern.match(name)
+        }
 
-        # Se non sono stati trovati supermercati, restituisci un messaggio vuoto
+        # Se non sono state trovate location, restituisci un messaggio vuoto
         if not identified_locations:
             logger.warning("No locations identified")
 
-        # Restituisce i supermercati trovati
         return identified_locations
-    
+
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error retrieving locations for {supermarket_id}: {e}")
         raise HTTPException(status_code=500, detail=str(e))
@@ -175,80 +932,472 @@ async def get_supermarket_locations(supermarket_id: str):
 async def get_supermarket_fridges(supermarket_id: str, location_id: str):
     try:
         # Log all'inizio della funzione per vedere se viene eseguita
-        logger.info("Fetching locations...")
-
-        # Recupera il nodo "Objects"
-        objects = await opc_connection.client.nodes.root.get_child("0:Objects")
-        namespace = "http://examples.factory.github.io"
-        nsidx = await opc_connection.client.get_namespace_index(namespace)
-        supermarket = await objects.get_child(f"{nsidx}:{supermarket_id}")
-        location = await supermarket.get_child(f"{nsidx}:{location_id}")
-
-        # Ottieni i figli del nodo "Objects" (Supermercati)
-        fridges = await location.get_children()
+        logger.debug("Fetching fridges...")
+        await fresh_index()
 
-        # Logga i nodi trovati
-        logger.info(f"Found nodes: {fridges}")
-
-        # Compila l'espressione regolare
         fridge_pattern = re.compile(r"^Fridge\d+$")
-        identified_fridges = {}
-
-        # Cicla attraverso i nodi trovati
-        for fridge in fridges:
-            browse_name = await fridge.read_browse_name()  # Ottieni il browse_name del nodo
-            logger.info(f"Node ID: {fridge.nodeid}, Browse Name: {browse_name}")
-
-            # Confronta il browse_name con l'espressione regolare
-            if fridge_pattern.match(browse_name.Name):
-                logger.info(f"Identified fridge: {browse_name.Name}")
-                identified_fridges[browse_name.Name] = browse_name.Name
+        identified_fridges = {
+            name: name for name in address_space.fridge_names(supermarket_id, location_id)
+            if fridge_pattern.match(name)
+        }
 
-        # Se non sono stati trovati supermercati, restituisci un messaggio vuoto
+        # Se non sono stati trovati frigoriferi, restituisci un messaggio vuoto
         if not identified_fridges:
             logger.warning("No fridges identified")
 
-        # Restituisce i supermercati trovati
         return identified_fridges
-    
+
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error retrieving fridges for {location_id} in {supermarket_id}: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
 # Get data for a specific fridge
 @app.get("/api/supermarkets/locations/{supermarket_id}/fridges/{location_id}/{fridge_id}")
-async def get_fridge_data(supermarket_id: str, location_id: str, fridge_id: str):
+async def get_fridge_data(request: Request, supermarket_id: str, location_id: str, fridge_id: str):
     try:
-        objects = await opc_connection.client.nodes.root.get_child("0:Objects")
-        namespace = "http://examples.factory.github.io"
-        nsidx = await opc_connection.client.get_namespace_index(namespace)
+        await fresh_index()
+        fridge = address_space.fridge(supermarket_id, location_id, fridge_id)
 
-        # Fetch fridge node and its data
-        supermarket = await objects.get_child(f"{nsidx}:{supermarket_id}")
-        location = await supermarket.get_child(f"{nsidx}:{location_id}")
-        fridge = await location.get_child(f"{nsidx}:{fridge_id}")
-        variables = await fridge.get_children()
+        # Served from the subscription cache; read from the server only until its first values arrive
+        async def fetch():
+            data = live_values.fridge_data(fridge) if live_values is not None else None
+            if data is None:
+                FRIDGE_SOURCE.inc("read")
+                async with opc_connection.session() as client:
+                    data = await read_fridge_values(client, fridge)
+            else:
+                FRIDGE_SOURCE.inc("cache")
+            return fridge_body(data)
 
-        data = {}
-
-        for variable in variables:
-            try:
-                value_data = await read_node_value(variable)
-                data[variable.nodeid.to_string()] = value_data
-            except Exception as e:
-                logger.error(f"Error reading node {variable.nodeid}: {e}")
-                continue
-
-        return data
+        # The encoded body is shared by the coalesced requests, a 304 when the timestamps did not change
+        body = await fridge_reads.do(fridge.path, fetch)
+        return body.response(request)
 
+    except HTTPException:
+        raise
+    except ConnectionError as e:
+        logger.error(f"OPC UA server not available for fridge {fridge_id}: {e}")
+        raise HTTPException(status_code=503, detail=str(e))
     except Exception as e:
         logger.error(f"Error retrieving data for fridge {fridge_id} in {location_id}, {supermarket_id}: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
+# Current values of many fridges in one response: the whole fleet, a supermarket or a location.
+# variables is a comma separated list; format is json (one object per fridge), columnar, msgpack or arrow
+@app.get("/api/snapshot")
+async def get_snapshot(request: Request, supermarket: Optional[str] = None, location: Optional[str] = None,
+                       variables: Optional[str] = None, format: str = "json"):
+    if format not in SNAPSHOT_FORMATS:
+        raise HTTPException(status_code=400, detail=f"Unknown format {format}, use one of {', '.join(SNAPSHOT_FORMATS)}")
+    if location is not None and supermarket is None:
+        raise HTTPException(status_code=400, detail="location needs a supermarket")
+    names = [name.strip() for name in variables.split(",") if name.strip()] if variables else list(VARIABLES)
+    unknown = [name for name in names if name not in VARIABLES]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown variables: {', '.join(unknown)}")
+    if live_values is None:
+        raise HTTPException(status_code=503, detail="Live values not available")
+
+    await fresh_index()
+    fridges, values, times = live_values.select(address_space.fridges_in(supermarket, location), names)
+    logger.debug(f"Snapshot of {len(fridges)} fridges, {len(names)} variables, {format}")
+
+    if format == "json":
+        rows = values.tolist()
+        body = {
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+            "fridges": {
+                ".".join(fridge.path): {name: (None if value != value else value) for name, value in zip(names, row)}
+                for fridge, row in zip(fridges, rows)
+            },
+        }
+        return EncodedBody(json.dumps(body).encode(), "application/json").response(request)
+
+    if format == "columnar":
+        body = {"timestamp": datetime.now(timezone.utc).isoformat(),
+                "columns": _snapshot_columns(fridges, names, values, times)}
+        return EncodedBody(json.dumps(body).encode(), "application/json").response(request)
+
+    if format == "msgpack":
+        if msgpack is None:
+            raise HTTPException(status_code=501, detail="msgpack is not installed")
+        body = {"timestamp": time.time(), "columns": _snapshot_columns(fridges, names, values, times)}
+        return EncodedBody(msgpack.packb(body), "application/msgpack").response(request)
+
+    # Arrow IPC stream: one record batch, float64 columns with nulls for missing values
+    if pyarrow is None:
+        raise HTTPException(status_code=501, detail="pyarrow is not installed")
+    updated = _newest(times)
+    arrays = {
+        "supermarket": pyarrow.array([fridge.supermarket for fridge in fridges]),
+        "location": pyarrow.array([fridge.location for fridge in fridges]),
+        "fridge": pyarrow.array([fridge.name for fridge in fridges]),
+        "updated_at": pyarrow.array(updated, from_pandas=True),
+    }
+    for col, name in enumerate(names):
+        arrays[name] = pyarrow.array(values[:, col], from_pandas=True)
+    batch = pyarrow.RecordBatch.from_pydict(arrays)
+    sink = pyarrow.BufferOutputStream()
+    with pyarrow.ipc.new_stream(sink, batch.schema) as writer:
+        writer.write_batch(batch)
+    return EncodedBody(sink.getvalue().to_pybytes(), "application/vnd.apache.arrow.stream").response(request)
+
+
+def _parse_time(value: Optional[str], default: float) -> float:
+    """Seconds since the Unix epoch, or an ISO 8601 date (UTC when no offset is given)"""
+    if value is None:
+        return default
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    try:
+        dt = datetime.fromisoformat(value)
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"Invalid time {value}")
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return dt.timestamp()
+
+# Recent values of a fridge variable between start and end (default: the last hour), downsampled to at most
+# `points` points with LTTB or min/max buckets. Times are returned in seconds since the Unix epoch, with
+# the number of samples kept per variable (depth), which bounds how far back the history goes
+@app.get("/api/history/{supermarket_id}/{location_id}/{fridge_id}/{variable}")
+async def get_variable_history(request: Request, supermarket_id: str, location_id: str, fridge_id: str, variable: str,
+                               start: Optional[str] = None, end: Optional[str] = None,
+                               points: int = 1000, method: str = "lttb"):
+    if variable not in VARIABLES:
+        raise HTTPException(status_code=404, detail=f"Unknown variable {variable}")
+    if variable not in HISTORY_VARIABLES:
+        raise HTTPException(status_code=404, detail=f"No history is kept for {variable}, "
+                                                    f"only for {', '.join(HISTORY_VARIABLES)}")
+    if method not in DOWNSAMPLING:
+        raise HTTPException(status_code=400, detail=f"Unknown method {method}, use one of {', '.join(DOWNSAMPLING)}")
+    if not 3 <= points <= HISTORY_MAX_POINTS:
+        raise HTTPException(status_code=400, detail=f"points must be between 3 and {HISTORY_MAX_POINTS}")
+    if live_values is None or live_history is None:
+        raise HTTPException(status_code=503, detail="Live values not available")
+
+    await fresh_index()
+    fridge = address_space.fridge(supermarket_id, location_id, fridge_id)
+    row = live_values.rows.get(fridge.path)
+    if row is None:
+        raise HTTPException(status_code=503, detail=f"No history yet for {fridge_id}")
+    end_time = _parse_time(end, time.time())
+    start_time = _parse_time(start, end_time - 3600)
+
+    times, values = live_history.window(live_history.series(row, HISTORY_VARIABLES.index(variable)),
+                                        start_time, end_time)
+    sampled_times, sampled_values = DOWNSAMPLING[method](times, values, points)
+    body = {
+        "node_id": fridge.variables[variable].to_string() if variable in fridge.variables else None,
+        "variable": variable,
+        "method": method,
+        "start": start_time,
+        "end": end_time,
+        "raw_points": len(times),
+        "depth": live_history.depth,
+        "timestamps": sampled_times.tolist(),
+        "values": sampled_values.tolist(),
+    }
+    return EncodedBody(json.dumps(body).encode(), "application/json").response(request)
+
+
+# Active alarms, optionally of a supermarket or location and of a severity
+@app.get("/api/alarms")
+async def get_alarms(supermarket: Optional[str] = None, location: Optional[str] = None,
+                     severity: Optional[str] = None):
+    if alarm_engine is None or live_values is None:
+        raise HTTPException(status_code=503, detail="Live values not available")
+    alarms = [
+        alarm for alarm in alarm_engine.active_alarms(live_values.values)
+        if (supermarket is None or alarm["supermarket"] == supermarket)
+        and (location is None or alarm["location"] == location)
+        and (severity is None or alarm["severity"] == severity)
+    ]
+    return {"timestamp": datetime.now(timezone.utc).isoformat(), "alarms": alarms}
+
+# Alarms raised and cleared, as Server-Sent Events. A client that cannot keep up loses the oldest events
+@app.get("/api/alarms/stream")
+async def stream_alarms(request: Request):
+    queue = asyncio.Queue(ALARM_QUEUE_SIZE)
+
+    async def events():
+        alarm_clients.add(queue)
+        try:
+            while True:
+                try:
+                    event = await asyncio.wait_for(queue.get(), STREAM_KEEP_ALIVE)
+                except asyncio.TimeoutError:
+                    if await request.is_disconnected():
+                        break
+                    yield ": keep-alive\n\n"
+                    continue
+                yield f"event: alarm\ndata: {json.dumps(event)}\n\n"
+        finally:
+            alarm_clients.discard(queue)
+
+    return StreamingResponse(events(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+def _finite(value: float) -> Optional[float]:
+    return float(value) if np.isfinite(value) else None
+
+# Running statistics and anomaly z-scores of the variables of a fridge
+@app.get("/api/stats/{supermarket_id}/{location_id}/{fridge_id}")
+async def get_fridge_stats(supermarket_id: str, location_id: str, fridge_id: str):
+    if live_stats is None:
+        raise HTTPException(status_code=503, detail="Live values not available")
+    await fresh_index()
+    fridge = address_space.fridge(supermarket_id, location_id, fridge_id)
+    row = live_stats.rows.get(fridge.path)
+    if row is None:
+        raise HTTPException(status_code=503, detail=f"No statistics yet for {fridge_id}")
+    std, ewm_std = live_stats.std()[row], live_stats.ewm_std()[row]
+    variables = {
+        name: {
+            "count": int(live_stats.count[row, col]),
+            "mean": _finite(live_stats.mean[row, col]) if live_stats.count[row, col] else None,
+            "std": _finite(std[col]),
+            "min": _finite(live_stats.min[row, col]),
+            "max": _finite(live_stats.max[row, col]),
+            "ewma": _finite(live_stats.ewma[row, col]) if live_stats.count[row, col] else None,
+            "ewm_std": _finite(ewm_std[col]),
+            "latest": _finite(live_stats.latest[row, col]),
+            "z_self": _finite(live_stats.z_self[row, col]),
+            "z_peer": _finite(live_stats.z_peer[row, col]),
+        }
+        for col, name in enumerate(live_stats.variables)
+    }
+    return {"score": _finite(live_stats.scores()[row]), "variables": variables}
+
+# Fridges with the highest anomaly scores, optionally of a supermarket or location
+@app.get("/api/anomalies")
+async def get_anomalies(supermarket: Optional[str] = None, location: Optional[str] = None,
+                        top: int = 20, min_score: float = 0.0):
+    if live_stats is None:
+        raise HTTPException(status_code=503, detail="Live values not available")
+    scores = live_stats.scores()
+    selected = np.isfinite(scores) & (scores >= min_score)
+    if supermarket is not None:
+        selected &= np.array([f.supermarket == supermarket for f in live_stats.fridges], dtype=bool)
+    if location is not None:
+        selected &= np.array([f.location == location for f in live_stats.fridges], dtype=bool)
+    rows = np.flatnonzero(selected)
+    rows = rows[np.argsort(-scores[rows], kind="stable")[:max(top, 0)]]
+
+    anomalies = []
+    for row in rows.tolist():
+        fridge = live_stats.fridges[row]
+        z = np.abs(np.stack((live_stats.z_self[row], live_stats.z_peer[row])))
+        z = np.where(np.isnan(z), -np.inf, z)
+        kind, col = np.unravel_index(int(np.argmax(z)), z.shape)
+        anomalies.append({
+            "supermarket": fridge.supermarket,
+            "location": fridge.location,
+            "fridge": fridge.name,
+            "score": float(scores[row]),
+            "variable": live_stats.variables[col],
+            "against": "self" if kind == 0 else "peer",
+            "z_self": _finite(live_stats.z_self[row, col]),
+            "z_peer": _finite(live_stats.z_peer[row, col]),
+        })
+    return {"timestamp": datetime.now(timezone.utc).isoformat(), "anomalies": anomalies}
+
+
+# Fleet query on the current values, e.g. /api/query?where=tempC3>271.15&order_by=compOutPres&top=20
+# where: conditions (>, >=, <, <=, =) on the variables, all of them must hold. Values are in the units of the
+# server (K, MPa). order_by/top rank the matching fridges; group_by=supermarket|location returns per group
+# count and min/mean/max of `variables` instead of the fridges
+@app.get("/api/query")
+async def query_fleet(where: List[str] = Query(default=[]), supermarket: Optional[str] = None,
+                      location: Optional[str] = None, order_by: Optional[str] = None, ascending: bool = False,
+                      top: int = 100, group_by: Optional[str] = None, variables: Optional[str] = None):
+    try:
+        conditions = [parse_condition(condition) for condition in where]
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if order_by is not None and order_by not in VARIABLES:
+        raise HTTPException(status_code=400, detail=f"Unknown variable {order_by}")
+    if group_by not in (None, "supermarket", "location"):
+        raise HTTPException(status_code=400, detail="group_by must be supermarket or location")
+    if location is not None and supermarket is None:
+        raise HTTPException(status_code=400, detail="location needs a supermarket")
+    if not 0 < top <= QUERY_MAX_TOP:
+        raise HTTPException(status_code=400, detail=f"top must be between 1 and {QUERY_MAX_TOP}")
+    if variables:
+        names = [name.strip() for name in variables.split(",") if name.strip()]
+    else:
+        names = list(dict.fromkeys([variable for variable, _, _ in conditions] + ([order_by] if order_by else [])))
+        names = names or list(VARIABLES)
+    unknown = [name for name in names if name not in VARIABLES]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown variables: {', '.join(unknown)}")
+
+    cache = live_values
+    if cache is None:
+        raise HTTPException(status_code=503, detail="Live values not available")
+    index = fleet_index
+    if index is None or index.n_rows != len(cache.fridges):
+        rebuild_fleet_index(cache)
+        index = fleet_index
+
+    mask = np.ones(index.n_rows, dtype=bool)
+    for variable, op, limit in conditions:
+        mask &= index.select(VARIABLES.index(variable), op, limit)
+    if supermarket is not None:
+        mask &= np.array([f.supermarket == supermarket for f in cache.fridges], dtype=bool)
+    if location is not None:
+        mask &= np.array([f.location == location for f in cache.fridges], dtype=bool)
+
+    cols = [VARIABLES.index(name) for name in names]
+    values = index.values
+    body = {
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "index_built_at": datetime.fromtimestamp(fleet_index_built_at, timezone.utc).isoformat(),
+        "matched": int(mask.sum()),
+    }
+
+    if group_by is not None:
+        keys = [(f.supermarket,) if group_by == "supermarket" else (f.supermarket, f.location) for f in cache.fridges]
+        group_ids = {}
+        groups = np.array([group_ids.setdefault(key, len(group_ids)) for key in keys], dtype=np.int64)
+        rows = np.flatnonzero(mask)
+        n_groups = len(group_ids)
+        count = np.bincount(groups[rows], minlength=n_groups)
+        stats = {}
+        for name, col in zip(names, cols):
+            column = values[rows, col]
+            present = ~np.isnan(column)
+            g, column = groups[rows][present], column[present]
+            n = np.bincount(g, minlength=n_groups)
+            total = np.bincount(g, column, minlength=n_groups)
+            lowest, highest = np.full(n_groups, np.inf), np.full(n_groups, -np.inf)
+            np.minimum.at(lowest, g, column)
+            np.maximum.at(highest, g, column)
+            with np.errstate(invalid="ignore", divide="ignore"):
+                stats[name] = (lowest, total / n, highest)
+        body["groups"] = [
+            dict(zip(("supermarket", "location"), key),
+                 count=int(count[i]),
+                 variables={name: {"min": _finite(stats[name][0][i]), "mean": _finite(stats[name][1][i]),
+                                   "max": _finite(stats[name][2][i])} for name in names})
+            for key, i in sorted(group_ids.items(), key=lambda item: natural_key(item[0])) if count[i]
+        ]
+        return body
+
+    if order_by is not None:
+        rows = index.ranked(VARIABLES.index(order_by), mask, descending=not ascending)[:top]
+    else:
+        rows = np.flatnonzero(mask)[:top]
+    selected = values[np.ix_(rows, cols)].tolist()
+    body["fridges"] = [
+        {"supermarket": cache.fridges[row].supermarket, "location": cache.fridges[row].location,
+         "fridge": cache.fridges[row].name,
+         "values": {name: (None if value != value else value) for name, value in zip(names, row_values)}}
+        for row, row_values in zip(rows.tolist(), selected)
+    ]
+    return body
+
+
+# Derived KPIs (superheat, subcooling, pressure ratio, saturation temperatures) of a supermarket, a location
+# or the whole fleet, one column per KPI
+@app.get("/api/kpis")
+async def get_kpis(request: Request, supermarket: Optional[str] = None, location: Optional[str] = None):
+    if location is not None and supermarket is None:
+        raise HTTPException(status_code=400, detail="location needs a supermarket")
+    kpis, rows = fleet_kpis, fleet_kpis_rows
+    if kpis is None:
+        raise HTTPException(status_code=503, detail="KPIs not available yet")
+    await fresh_index()
+    fridges = [fridge for fridge in address_space.fridges_in(supermarket, location) if fridge.path in rows]
+    selected = [rows[fridge.path] for fridge in fridges]
+    columns = {
+        "supermarket": [fridge.supermarket for fridge in fridges],
+        "location": [fridge.location for fridge in fridges],
+        "fridge": [fridge.name for fridge in fridges],
+    }
+    for col, name in enumerate(KPIS):
+        columns[name] = _nan_to_none(kpis[selected, col])
+    body = {"timestamp": datetime.now(timezone.utc).isoformat(), "refrigerant": saturation_table.refrigerant,
+            "columns": columns}
+    return EncodedBody(json.dumps(body).encode(), "application/json").response(request)
+
+# KPIs of a fridge
+@app.get("/api/kpis/{supermarket_id}/{location_id}/{fridge_id}")
+async def get_fridge_kpis(supermarket_id: str, location_id: str, fridge_id: str):
+    kpis, rows = fleet_kpis, fleet_kpis_rows
+    if kpis is None:
+        raise HTTPException(status_code=503, detail="KPIs not available yet")
+    await fresh_index()
+    fridge = address_space.fridge(supermarket_id, location_id, fridge_id)
+    row = rows.get(fridge.path)
+    if row is None:
+        raise HTTPException(status_code=503, detail=f"No KPIs yet for {fridge_id}")
+    return {"refrigerant": saturation_table.refrigerant,
+            "kpis": {name: _finite(kpis[row, col]) for col, name in enumerate(KPIS)}}
+
+
+# Stream the value changes of a supermarket, a location or a fridge as Server-Sent Events
+async def stream_events(request: Request, fridges: List[FridgeInfo], max_rate: float):
+    client = StreamClient([fridge.path for fridge in fridges], min(max_rate, STREAM_MAX_RATE_LIMIT))
+    live_streams.add(client)
+    try:
+        # The first frame has all the current values of the scope, then only what changed
+        changes = {fridge.path: set(range(len(live_values.variables))) for fridge in fridges} if live_values else {}
+        while True:
+            if changes and live_values is not None:
+                frame = {"timestamp": datetime.now(timezone.utc).isoformat(),
+                         "values": _stream_values(live_values, changes)}
+                yield f"event: values\ndata: {json.dumps(frame)}\n\n"
+                # Changes arriving while we wait are coalesced into the next frame
+                await asyncio.sleep(client.min_interval)
+            try:
+                await asyncio.wait_for(client.wakeup.wait(), STREAM_KEEP_ALIVE)
+            except asyncio.TimeoutError:
+                if await request.is_disconnected():
+                    break
+                yield ": keep-alive\n\n"
+            changes = client.take()
+    finally:
+        live_streams.remove(client)
+        logger.debug(f"Stream closed, {client.coalesced} changes coalesced")
+
+
+def _stream_response(request: Request, fridges: List[FridgeInfo], max_rate: float) -> StreamingResponse:
+    if max_rate <= 0:
+        raise HTTPException(status_code=400, detail="max_rate must be positive")
+    if live_values is None:
+        raise HTTPException(status_code=503, detail="Live values not available")
+    logger.debug(f"Streaming {len(fridges)} fridges at up to {min(max_rate, STREAM_MAX_RATE_LIMIT)} frames/s")
+    return StreamingResponse(stream_events(request, fridges, max_rate), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+@app.get("/api/stream/{supermarket_id}")
+async def stream_supermarket(request: Request, supermarket_id: str, max_rate: float = STREAM_MAX_RATE):
+    await fresh_index()
+    return _stream_response(request, address_space.fridges_in(supermarket_id), max_rate)
+
+@app.get("/api/stream/{supermarket_id}/{location_id}")
+async def stream_location(request: Request, supermarket_id: str, location_id: str,
+                          max_rate: float = STREAM_MAX_RATE):
+    await fresh_index()
+    return _stream_response(request, address_space.fridges_in(supermarket_id, location_id), max_rate)
+
+@app.get("/api/stream/{supermarket_id}/{location_id}/{fridge_id}")
+async def stream_fridge(request: Request, supermarket_id: str, location_id: str, fridge_id: str,
+                        max_rate: float = STREAM_MAX_RATE):
+    await fresh_index()
+    return _stream_response(request, address_space.fridges_in(supermarket_id, location_id, fridge_id), max_rate)
+
 if __name__ == "__main__":
     uvicorn.run(
         "middleware_chrome:app",
         host="0.0.0.0",
         port=8000,
-        reload=True
+        reload=True,
+        access_log=VERBOSE_LOGGING
     )
@@ -1,9 +1,10 @@
 # opc_udp_middleware.py
-from asyncua import Client
+from asyncua import Client, ua
 import asyncio
 import json
 from datetime import datetime
 import logging
+import random
 from typing import Dict, Any, Optional
 import socket
 
@@ -16,16 +17,30 @@ class OPCUDPBridge:
                  opc_url: str = "opc.tcp://localhost:3005",
                  unity_ip: str = "127.0.0.1", 
                  unity_port: int = 12345,
-                 update_rate: float = 0.1):  # Time in seconds between updates
+                 update_rate: float = 0.1,  # Publishing interval in seconds: at most one frame per interval
+                 sampling_interval: Optional[float] = None,  # Seconds between two samples on the server, default update_rate
+                 deadband: float = 0.0,  # Absolute change a value needs to be notified, 0 = any change
+                 keep_alive: float = 1.0,  # Seconds between two checks of the connection
+                 backoff_max: float = 30.0):  # Longest pause between two reconnection attempts
         self.opc_url = opc_url
         self.unity_ip = unity_ip
         self.unity_port = unity_port
         self.update_rate = update_rate
+        self.sampling_interval = update_rate if sampling_interval is None else sampling_interval
+        self.deadband = deadband
         self.client = None
         self.udp_socket = None
         self.running = False
         self.monitored_nodes = {}
         self.last_values = {}
+        # The server pushes the changes through a subscription instead of being polled
+        self.subscription = None
+        self.node_keys = {}  # NodeId -> key in monitored_nodes
+        self.flush_scheduled = False
+        self.frames = 0
+        self.keep_alive = keep_alive
+        self.backoff_max = backoff_max
+        self.reconnects = 0
 
     async def connect(self):
         """Connects to OPC UA server and initializes UDP socket"""
@@ -57,6 +72,7 @@ class OPCUDPBridge:
                 'node': node,
                 'alias': alias or node_id
             }
+            self.node_keys[node.nodeid] = node_id
             logger.info(f"Added node: {node_id} with alias: {alias}")
         except Exception as e:
             logger.error(f"Error adding node {node_id}: {e}")
@@ -82,6 +98,9 @@ class OPCUDPBridge:
 
     async def send_to_unity(self, data: Dict):
         """Sends data to Unity via UDP"""
+        self.send_frame(data)
+
+    def send_frame(self, data: Dict):
         try:
             json_data = json.dumps(data)
             self.udp_socket.sendto(
@@ -92,36 +111,120 @@ class OPCUDPBridge:
         except Exception as e:
             logger.error(f"Error sending data to Unity: {e}")
 
+    async def subscribe(self):
+        """Creates the subscription and one monitored item per node"""
+        self.subscription = await self.client.create_subscription(self.update_rate * 1000, self)
+
+        # Absolute deadband: the server only reports a value that moved by more than deadband
+        data_filter = None
+        if self.deadband > 0:
+            data_filter = ua.DataChangeFilter()
+            data_filter.Trigger = ua.DataChangeTrigger.StatusValue
+            data_filter.DeadbandType = ua.DeadbandType.Absolute
+            data_filter.DeadbandValue = self.deadband
+
+        requests = []
+        for handle, node_info in enumerate(self.monitored_nodes.values(), start=1):
+            parameters = ua.MonitoringParameters()
+            parameters.ClientHandle = handle
+            parameters.SamplingInterval = self.sampling_interval * 1000
+            parameters.QueueSize = 1
+            parameters.DiscardOldest = True
+            if data_filter is not None:
+                parameters.Filter = data_filter
+            request = ua.MonitoredItemCreateRequest()
+            request.ItemToMonitor = ua.ReadValueId(NodeId=node_info['node'].nodeid, AttributeId=ua.AttributeIds.Value)
+            request.MonitoringMode = ua.MonitoringMode.Reporting
+            request.RequestedParameters = parameters
+            requests.append(request)
+
+        results = await self.subscription.create_monitored_items(requests)
+        for node_id, result in zip(self.monitored_nodes, results):
+            if isinstance(result, ua.StatusCode):
+                logger.error(f"Could not monitor node {node_id}: {result}")
+        logger.info(f"Subscribed to {len(requests)} nodes (publishing {self.update_rate * 1000:.0f} ms, "
+                    f"sampling {self.sampling_interval * 1000:.0f} ms, deadband {self.deadband})")
+
+    def datachange_notification(self, node, val, data):
+        """Called by the subscription for every changed value"""
+        node_id = self.node_keys.get(node.nodeid)
+        if node_id is None:
+            return
+        dv = data.monitored_item.Value
+        self.last_values[str(node_id)] = {
+            'alias': self.monitored_nodes[node_id]['alias'],
+            'value': val,
+            'timestamp': dv.SourceTimestamp.isoformat() if dv.SourceTimestamp else datetime.now().isoformat(),
+            'quality': str(dv.StatusCode)
+        }
+        # All the notifications of a publish response are delivered in the same pass of the event loop,
+        # so a flush scheduled after the first one runs once they have all been applied: one frame per cycle
+        if not self.flush_scheduled:
+            self.flush_scheduled = True
+            asyncio.get_running_loop().call_soon(self.flush)
+
+    def status_change_notification(self, status):
+        logger.warning(f"Subscription status changed: {status}")
+
+    def flush(self):
+        """Sends the current values of all the nodes to Unity in a single frame"""
+        self.flush_scheduled = False
+        json_object = {
+            'timestamp': datetime.now().isoformat(),
+            'values': dict(self.last_values)
+        }
+        logger.debug(json_object)
+        self.send_frame(json_object)
+        self.frames += 1
+
     async def update_loop(self):
-        """Main loop for updating and sending data"""
+        """Subscribes to the nodes, then the frames are sent as the changes arrive.
+
+        The connection is checked every keep_alive seconds: when it is lost the bridge reconnects
+        and subscribes again, the last values keep being served to Unity meanwhile.
+        """
         while self.running:
             try:
-                # Read all values
-                current_values = {}
-                for node_id in self.monitored_nodes:
-                    value = await self.read_node_value(node_id)
-                    if value:
-                        current_values[str(node_id)] = value
-
-                # Send only if there are changes
-                if current_values != self.last_values:
-                    json_object = {
-                        'timestamp': datetime.now().isoformat(),
-                        'values': current_values
-                    }
-                    print(json_object)
-                    await self.send_to_unity(json_object)
-                    self.last_values = current_values
-
-                await asyncio.sleep(self.update_rate)
-
+                if self.subscription is None:
+                    await self.subscribe()
+                await asyncio.sleep(self.keep_alive)
+                await asyncio.wait_for(self.client.nodes.server_state.read_value(), self.keep_alive)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                if not self.running:
+                    break
+                logger.error(f"Error in update loop: {e!r}")
+                await self.reconnect()
+
+    async def reconnect(self):
+        """Opens a new session with exponential backoff and binds the monitored nodes to it"""
+        self.subscription = None  # it died with the old session
+        attempt = 0
+        while self.running:
+            try:
+                await self.client.disconnect()
+            except Exception:
+                pass
+            delay = min(self.backoff_max, 2 ** attempt) * random.uniform(0.5, 1.0)
+            await asyncio.sleep(delay)
+            try:
+                self.client = Client(url=self.opc_url)
+                await self.client.connect()
             except Exception as e:
-                logger.error(f"Error in update loop: {e}")
-                await asyncio.sleep(1)  # Pause before retrying
+                attempt += 1
+                logger.warning(f"Reconnection to {self.opc_url} failed ({e!r}), attempt {attempt}")
+                continue
+            for node_id, node_info in self.monitored_nodes.items():
+                node_info['node'] = self.client.get_node(node_id)
+            self.reconnects += 1
+            logger.info(f"Reconnected to OPC UA server: {self.opc_url} after {attempt} failed attempts")
+            return
 
     async def start(self):
         """Starts the bridge"""
-        await self.connect()
+        if self.client is None:
+            await self.connect()
         self.running = True
         logger.info("Bridge started")
         await self.update_loop()
@@ -129,6 +232,12 @@ class OPCUDPBridge:
     async def stop(self):
         """Stops the bridge"""
         self.running = False
+        if self.subscription:
+            try:
+                await self.subscription.delete()
+            except Exception as e:
+                logger.warning(f"Could not delete the subscription: {e}")
+            self.subscription = None
         if self.client:
             await self.client.disconnect()
         if self.udp_socket:
@@ -154,7 +263,9 @@ async def main():
         opc_url="opc.tcp://localhost:3005",    # OPC UA server URL
         unity_ip="127.0.0.1",                  # Unity application IP
         unity_port=12345,                      # Unity application UDP port
-        update_rate=0.1                        # Update every 100ms
+        update_rate=0.1,                       # At most one frame every 100ms
+        sampling_interval=0.1,                 # Server samples the variables every 100ms
+        deadband=0.0                           # Send every change, however small
     )
 
     """
@@ -0,0 +1,56 @@
+import numpy as np
+import re
+from fleet import VARIABLES
+from typing import Tuple
+
+_CONDITION = re.compile(r"^\s*(\w+)\s*(>=|<=|==|=|>|<)\s*([-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?)\s*$")
+
+
+def parse_condition(text: str, variables=VARIABLES) -> Tuple[str, str, float]:
+    """'tempC3>271.15' -> ('tempC3', '>', 271.15)"""
+    match = _CONDITION.match(text)
+    if match is None:
+        raise ValueError(f"Invalid condition {text!r}, expected e.g. tempC3>271.15")
+    variable, op, limit = match.groups()
+    if variable not in variables:
+        raise ValueError(f"Unknown variable {variable}")
+    return variable, "==" if op == "=" else op, float(limit)
+
+
+class ValueIndex:
+    """Sorted index of every column of a [fridge, variable] table of current values.
+
+    order[:, col] lists the rows by increasing value of col, missing (NaN) values last, and sorted holds the
+    values in that order: a range filter is two binary searches and a top-k is a slice. The index keeps a copy
+    of the table, so the answers are consistent with it while the live values keep changing.
+
+    The fridge variables are OPC UA Floats: the copy is float32 and the limits are rounded to float32 before
+    searching, so that tempC1=4.1 finds the float32 nearest to 4.1.
+    """
+    def __init__(self, values: np.ndarray, dtype=np.float32):
+        self.values = values.astype(dtype)
+        self.order = np.argsort(self.values, axis=0)  # NaN sort last
+        self.sorted = np.take_along_axis(self.values, self.order, axis=0)
+        self.valid = (~np.isnan(self.values)).sum(axis=0)
+        self.n_rows = self.values.shape[0]
+
+    def select(self, col: int, op: str, limit: float) -> np.ndarray:
+        """Boolean mask of the rows whose value in col satisfies `value op limit`"""
+        column = self.sorted[:self.valid[col], col]
+        limit = column.dtype.type(limit)
+        if op in (">", ">="):
+            first, last = np.searchsorted(column, limit, side="right" if op == ">" else "left"), len(column)
+        elif op in ("<", "<="):
+            first, last = 0, np.searchsorted(column, limit, side="left" if op == "<" else "right")
+        else:
+            first, last = np.searchsorted(column, limit, side="left"), np.searchsorted(column, limit, side="right")
+        mask = np.zeros(self.n_rows, dtype=bool)
+        mask[self.order[first:last, col]] = True
+        return mask
+
+    def ranked(self, col: int, mask: np.ndarray, descending: bool = True) -> np.ndarray:
+        """The rows of mask that have a value in col, sorted by that value"""
+        rows = self.order[:self.valid[col], col]
+        if descending:
+            rows = rows[::-1]
+        return rows[mask[rows]]
@@ -0,0 +1,116 @@
+import numpy as np
+from fleet import VARIABLES, FridgeInfo
+from typing import List
+
+# Weight of a new sample in the exponentially weighted mean and variance
+EWMA_ALPHA = 0.05
+
+# Fewer fridges than this in a location and the peer score is not computed
+MIN_PEERS = 3
+
+# Fewer earlier samples than this and the self score is not computed: the EWMA variance starts at zero
+MIN_SAMPLES = 20
+
+
+class OnlineStats:
+    """Running statistics of every fridge variable, updated in O(1) per sample and vectorized over the fleet.
+
+    count/mean/m2 follow Welford's algorithm over the whole history, ewma/ewm_var weight recent samples
+    more. The anomaly scores are z-scores of the latest value against the fridge's own EWMA before that
+    value ("self") and against the fridges of the same location ("peer"). Samples come either one at a time
+    (add) or as whole tables (update); the peer scores are computed on demand by score_peers.
+    """
+    def __init__(self, fridges: List[FridgeInfo], variables=VARIABLES, alpha: float = EWMA_ALPHA):
+        self.fridges = list(fridges)
+        self.variables = tuple(variables)
+        self.alpha = alpha
+        self.rows = {fridge.path: row for row, fridge in enumerate(self.fridges)}
+        shape = (len(self.fridges), len(self.variables))
+        self.count = np.zeros(shape, dtype=np.int64)
+        self.mean = np.zeros(shape)
+        self.m2 = np.zeros(shape)
+        self.min = np.full(shape, np.inf)
+        self.max = np.full(shape, -np.inf)
+        self.ewma = np.zeros(shape)
+        self.ewm_var = np.zeros(shape)
+        self.latest = np.full(shape, np.nan)
+        self.last_times = np.full(shape, np.nan)
+
+        locations = {}
+        self.groups = np.array([locations.setdefault((fridge.supermarket, fridge.location), len(locations))
+                                for fridge in self.fridges], dtype=np.int64)
+        self.n_groups = len(locations)
+        self.z_self = np.full(shape, np.nan)
+        self.z_peer = np.full(shape, np.nan)
+
+    def update(self, values: np.ndarray, times: np.ndarray) -> int:
+        """Adds the samples whose timestamp changed since the last call; returns how many there were"""
+        new = (times != self.last_times) & ~np.isnan(values) & ~np.isnan(times)
+        self.last_times[new] = times[new]
+        x = values[new]
+        if x.size:
+            self._add(new, x)
+            self.score_peers()
+        return int(x.size)
+
+    def add(self, row: int, col: int, value: float, timestamp: float) -> bool:
+        """Adds one sample of a fridge variable unless its timestamp is already known; returns whether it was new"""
+        if timestamp == self.last_times[row, col] or np.isnan(value) or np.isnan(timestamp):
+            return False
+        self.last_times[row, col] = timestamp
+        self._add((row, col), value)
+        return True
+
+    def _add(self, cells, x):
+        """Adds the samples x to the cells (a mask or a single (row, col))"""
+        count = self.count[cells] + 1
+        delta = x - self.mean[cells]
+        mean = self.mean[cells] + delta / count
+        self.m2[cells] += delta * (x - mean)
+        self.mean[cells] = mean
+        self.count[cells] = count
+        self.min[cells] = np.minimum(self.min[cells], x)
+        self.max[cells] = np.maximum(self.max[cells], x)
+
+        # The new sample is scored against the history before it, then added to it. The EWMA variance
+        # is debiased from its zero start, and only used once enough samples are behind it
+        first = count == 1
+        ewma = self.ewma[cells]
+        with np.errstate(invalid="ignore", divide="ignore"):
+            ewm_std = np.sqrt(self.ewm_var[cells] / (1 - (1 - self.alpha) ** (count - 2)))
+            self.z_self[cells] = np.where((count > MIN_SAMPLES) & (ewm_std > 0), (x - ewma) / ewm_std, np.nan)
+        ewm_delta = np.where(first, 0.0, x - ewma)
+        self.ewma[cells] = np.where(first, x, ewma + self.alpha * ewm_delta)
+        self.ewm_var[cells] = (1 - self.alpha) * (self.ewm_var[cells] + self.alpha * ewm_delta ** 2)
+        self.latest[cells] = x
+
+    def std(self) -> np.ndarray:
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return np.where(self.count > 1, np.sqrt(self.m2 / (self.count - 1)), np.nan)
+
+    def ewm_std(self) -> np.ndarray:
+        """Exponentially weighted standard deviation, debiased from the zero start of the variance"""
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return np.where(self.count > 1, np.sqrt(self.ewm_var / (1 - (1 - self.alpha) ** (self.count - 1))), np.nan)
+
+    def score_peers(self):
+        with np.errstate(invalid="ignore", divide="ignore"):
+            # Mean and spread of each location, one bincount per variable over the fridges that have a value
+            present = ~np.isnan(self.latest)
+            latest = np.where(present, self.latest, 0.0)
+            size = np.stack([np.bincount(self.groups, present[:, c], self.n_groups)
+                             for c in range(latest.shape[1])], axis=1)
+            total = np.stack([np.bincount(self.groups, latest[:, c], self.n_groups)
+                              for c in range(latest.shape[1])], axis=1)
+            squares = np.stack([np.bincount(self.groups, latest[:, c] ** 2, self.n_groups)
+                                for c in range(latest.shape[1])], axis=1)
+            group_mean = total / size
+            group_std = np.sqrt(np.maximum(squares / size - group_mean ** 2, 0.0))
+            mean, std, peers = group_mean[self.groups], group_std[self.groups], size[self.groups]
+            self.z_peer = np.where((peers >= MIN_PEERS) & (std > 0), (self.latest - mean) / std, np.nan)
+
+    def scores(self) -> np.ndarray:
+        """Anomaly score of every fridge: the largest |z| of its variables, self or peer (NaN when none)"""
+        z = np.abs(np.concatenate((self.z_self, self.z_peer), axis=1))
+        z = np.where(np.isnan(z), -np.inf, z).max(axis=1)
+        return np.where(np.isinf(z), np.nan, z)
@@ -1,10 +1,198 @@
 import logging
 import asyncio
+import argparse
+import json
+import time
+import numpy as np
 from asyncua import Server, ua
+from datetime import datetime, timezone
+from fleet import VARIABLES, FridgeInfo
+from controller import DATASET_FILE, ROW_STRIDE, ReplayCursor, ReplayScheduler, load_dataset
+from historian import FridgeHistoryManager, RingBufferHistory
+from kpis import DEFAULT_REFRIGERANT, KPIS, REFRIGERANTS, SaturationTable, compute_kpis
+from timeseries import BYTES_PER_SAMPLE, HISTORY_MEMORY_CAP
+
+_logger = logging.getLogger(__name__)
+
+# Topology used when no manifest is given: supermarket -> location -> list of fridges
+DEFAULT_TOPOLOGY = {
+    "Supermarket1": {"Location1": ["Fridge1", "Fridge2"], "Location2": ["Fridge1"]},
+    "Supermarket2": {"Location1": ["Fridge1"]},
+}
+
+# Max number of nodes added to the address space in one add_nodes call
+BUILD_BATCH_SIZE = 10000
+
+
+def topology_from_counts(supermarkets, locations, fridges):
+    # Same number of locations in every supermarket and of fridges in every location
+    return {
+        f"Supermarket{s}": {
+            f"Location{l}": [f"Fridge{f}" for f in range(1, fridges + 1)]
+            for l in range(1, locations + 1)
+        }
+        for s in range(1, supermarkets + 1)
+    }
+
+
+def load_manifest(filename):
+    # A manifest is either {"tree": {supermarket: {location: [fridges]}}}
+    # or the counts {"supermarkets": S, "locations": L, "fridges": F}
+    with open(filename) as f:
+        manifest = json.load(f)
+    if "tree" in manifest:
+        return manifest["tree"]
+    return topology_from_counts(manifest["supermarkets"], manifest["locations"], manifest["fridges"])
+
+
+def _object_item(idx, nodeid, parent, name, typedef, reftype):
+    item = ua.AddNodesItem()
+    item.RequestedNewNodeId = ua.NodeId(nodeid, idx)
+    item.BrowseName = ua.QualifiedName(name, idx)
+    item.NodeClass = ua.NodeClass.Object
+    item.ParentNodeId = parent
+    item.ReferenceTypeId = ua.NodeId(reftype)
+    item.TypeDefinition = typedef
+    attrs = ua.ObjectAttributes()
+    attrs.EventNotifier = 0
+    attrs.Description = ua.LocalizedText(name)
+    attrs.DisplayName = ua.LocalizedText(name)
+    attrs.WriteMask = 0
+    attrs.UserWriteMask = 0
+    item.NodeAttributes = attrs
+    return item
+
+
+def _variable_attributes(name, historizing=False):
+    # Same attributes as the variables of the Fridges type: Float, writable, initialised to 0.0
+    access = ua.AccessLevel.CurrentRead.mask | ua.AccessLevel.CurrentWrite.mask
+    if historizing:
+        access |= ua.AccessLevel.HistoryRead.mask
+    attrs = ua.VariableAttributes()
+    attrs.Description = ua.LocalizedText(name)
+    attrs.DisplayName = ua.LocalizedText(name)
+    attrs.DataType = ua.NodeId(ua.ObjectIds.Float)
+    attrs.Value = ua.Variant(0.0)
+    attrs.ValueRank = ua.ValueRank.Scalar
+    attrs.ArrayDimensions = None
+    attrs.WriteMask = 0
+    attrs.UserWriteMask = 0
+    attrs.Historizing = historizing
+    attrs.AccessLevel = access
+    attrs.UserAccessLevel = access
+    return attrs
+
+
+async def build_fleet(server, idx, supermarket_type, location_type, fridge_type, tree, batch_size=BUILD_BATCH_SIZE,
+                      historizing=False, kpis=False):
+    # Instead of one add_object per instance (which browses the type again for every fridge), all the
+    # objects and variables are described up front and added in bulk through the node management service.
+    # NodeIds are strings like "Supermarket1.Location1.Fridge1.tempC1"
+    start = time.perf_counter()
+    names = VARIABLES + KPIS if kpis else VARIABLES
+    variable_attributes = {name: _variable_attributes(name, historizing) for name in names}
+    items = []
+    fridges = []
+
+    for supermarket_name, locations in tree.items():
+        supermarket_id = ua.NodeId(supermarket_name, idx)
+        items.append(_object_item(idx, supermarket_name, server.nodes.objects.nodeid, supermarket_name,
+                                  supermarket_type.nodeid, ua.ObjectIds.Organizes))
+
+        for location_name, fridge_names in locations.items():
+            location_id = ua.NodeId(f"{supermarket_name}.{location_name}", idx)
+            items.append(_object_item(idx, location_id.Identifier, supermarket_id, location_name,
+                                      location_type.nodeid, ua.ObjectIds.HasComponent))
+
+            for fridge_name in fridge_names:
+                fridge_id = ua.NodeId(f"{location_id.Identifier}.{fridge_name}", idx)
+                items.append(_object_item(idx, fridge_id.Identifier, location_id, fridge_name,
+                                          fridge_type.nodeid, ua.ObjectIds.HasComponent))
+                fridge = FridgeInfo((supermarket_name, location_name, fridge_name), fridge_id)
+
+                for name in names:
+                    item = ua.AddNodesItem()
+                    item.RequestedNewNodeId = ua.NodeId(f"{fridge_id.Identifier}.{name}", idx)
+                    item.BrowseName = ua.QualifiedName(name, idx)
+                    item.NodeClass = ua.NodeClass.Variable
+                    item.ParentNodeId = fridge_id
+                    item.ReferenceTypeId = ua.NodeId(ua.ObjectIds.HasComponent)
+                    item.TypeDefinition = ua.NodeId(ua.ObjectIds.BaseDataVariableType)
+                    item.NodeAttributes = variable_attributes[name]
+                    items.append(item)
+                    fridge.variables[name] = item.RequestedNewNodeId
+
+                fridges.append(fridge)
+
+    # Parents always come before their children, so the batches can be added in order
+    for first in range(0, len(items), batch_size):
+        batch = items[first:first + batch_size]
+        for item, result in zip(batch, server.iserver.node_mgt_service.add_nodes(batch)):
+            if not result.StatusCode.is_good():
+                raise RuntimeError(f"Could not add {item.RequestedNewNodeId}: {result.StatusCode}")
+        await asyncio.sleep(0)
+
+    elapsed = time.perf_counter() - start
+    _logger.info(f"Built {len(fridges)} fridges ({len(items)} nodes) in {elapsed:.2f} s "
+                 f"({len(items) / elapsed:.0f} nodes/s)")
+    return fridges
+
+
+# In-process replay: same interface as controller.FleetReplay, but every tick goes through the server's
+# local write path in one batch instead of client encode, TCP and server decode
+
+class LocalReplay:
+    def __init__(self, server, dataset, fridges, saturation_table=None):
+        self.server = server
+        self.dataset = dataset
+        self.nodeids = []
+        self.cursors = []
+        self.ticks = 0
+        self.writes = 0
+        self.errors = 0
+        for i, fridge in enumerate(fridges):
+            self.nodeids.append([fridge.variables[name] for name in dataset.columns])
+            self.cursors.append(ReplayCursor(dataset.data, (i * ROW_STRIDE) % dataset.n_rows))
+        # With a saturation table the KPI variables of the fridges are written too, computed for the
+        # whole fleet at once from the rows of the tick
+        self.saturation_table = saturation_table
+        self.kpi_nodeids = [[fridge.variables[name] for name in KPIS] for fridge in fridges] \
+            if saturation_table is not None else []
+
+    async def tick(self):
+        timestamp = datetime.now(timezone.utc)
+        params = ua.WriteParameters()
+        rows = [next(cursor) for cursor in self.cursors]
+        for nodeids, row in zip(self.nodeids, rows):
+            for nodeid, value in zip(nodeids, row):
+                params.NodesToWrite.append(ua.WriteValue(
+                    NodeId=nodeid,
+                    AttributeId=ua.AttributeIds.Value,
+                    Value=ua.DataValue(ua.Variant(value, ua.VariantType.Double), SourceTimestamp=timestamp),
+                ))
+        if self.saturation_table is not None and rows:
+            kpis = compute_kpis(np.array(rows), self.saturation_table, self.dataset.columns)
+            for nodeids, row in zip(self.kpi_nodeids, kpis.tolist()):
+                for nodeid, value in zip(nodeids, row):
+                    params.NodesToWrite.append(ua.WriteValue(
+                        NodeId=nodeid,
+                        AttributeId=ua.AttributeIds.Value,
+                        Value=ua.DataValue(ua.Variant(value, ua.VariantType.Double), SourceTimestamp=timestamp),
+                    ))
+
+        results = await self.server.iserver.attribute_service.write(params)
+        self.writes += len(results)
+        for write, status in zip(params.NodesToWrite, results):
+            if not status.is_good():
+                self.errors += 1
+                _logger.warning(f"Write of {write.NodeId} failed: {status}")
+        self.ticks += 1
+
 
 # standard lines to log and start a server
 
-async def main():
+async def main(tree=None, replay=False, dataset_file=DATASET_FILE, sample_period=1.0, speed=1.0,
+               history_depth=0, history_memory=HISTORY_MEMORY_CAP, refrigerant=None):
     # Create and initialize OPC UA server
     server = Server()
     await server.init()
@@ -132,6 +320,12 @@ async def main():
     await tempC3.set_modelling_rule(True) # this allows us to add the variable as default to fridges
     await tempC3.set_writable()    
 
+    # Derived KPIs (superheat, subcooling, pressure ratio, saturation temperatures), only when requested
+    if refrigerant:
+        for name in KPIS:
+            kpi = await fridges.add_variable(idx, name, val=0.0, datatype=ua.NodeId(ua.ObjectIds.Float))
+            await kpi.set_modelling_rule(True)
+
     """
     # Create Methods
 
@@ -148,42 +342,73 @@ async def main():
     await openDoorFunc.set_modelling_rule(True) 
     """
 
-    # Instatiate supermarket 1
-    supermarket1 = await server.nodes.objects.add_object(idx, "Supermarket1", supermarket)
-
-
-    location1_1 = await supermarket1.add_object(idx, "Location1", location)
-
-    fridge1_1 = await location1_1.add_object(idx, "Fridge1", fridges)
-
-    fridge2_1 = await location1_1.add_object(idx, "Fridge2", fridges)
-
-
-    location2_1 = await supermarket1.add_object(idx, "Location2", location)
-
-    fridge1_2 = await location2_1.add_object(idx, "Fridge1", fridges)
-
-
-    # Instatiate supermarket 2
-
-    supermarket2 = await server.nodes.objects.add_object(idx, "Supermarket2", supermarket)
-
-    location1_2 = await supermarket2.add_object(idx, "Location1", location)
-
-    fridge1_1 = await location1_2.add_object(idx, "Fridge1", fridges)
+    # Instantiate the supermarkets, locations and fridges described by the manifest
+    fleet = await build_fleet(server, idx, supermarket, location, fridges, tree or DEFAULT_TOPOLOGY,
+                              historizing=bool(history_depth), kpis=bool(refrigerant))
+
+    # Historian: the last history_depth samples of every fridge variable, served through HistoryRead
+    if history_depth:
+        n_variables = sum(len(fridge.variables) for fridge in fleet)
+        depth = min(history_depth, history_memory // (n_variables * BYTES_PER_SAMPLE))
+        if depth < 1:
+            raise RuntimeError(f"A history memory of {history_memory} bytes cannot hold one sample of each of the "
+                               f"{n_variables} variables, raise --history-memory")
+        if depth < history_depth:
+            _logger.warning(f"History depth reduced from {history_depth} to {depth} samples to stay within "
+                            f"{history_memory} bytes")
+        history = FridgeHistoryManager(server.iserver)
+        history.set_storage(RingBufferHistory(depth, history_memory))
+        await history.init()
+        server.iserver.history_manager = history
 
     # Start the server (ALWAYS EQUAL)
 
     async with server:
         print("Server started")
-        await asyncio.sleep(999999)
+        if history_depth:
+            await history.historize_nodes(
+                [server.get_node(nodeid) for fridge in fleet for nodeid in fridge.variables.values()], depth)
+
+        if replay:
+            # Feed the dataset directly into the address space, no controller needed
+            local_replay = LocalReplay(server, load_dataset(dataset_file), fleet,
+                                       SaturationTable(refrigerant) if refrigerant else None)
+            await ReplayScheduler(sample_period, speed).run(local_replay)
+        else:
+            await asyncio.sleep(999999)
 
 if __name__ == "__main__":    
+    parser = argparse.ArgumentParser(description="Supermarket OPC UA server")
+    parser.add_argument("--manifest", help="JSON file describing the supermarkets, locations and fridges to create")
+    parser.add_argument("--counts", type=int, nargs=3, metavar=("SUPERMARKETS", "LOCATIONS", "FRIDGES"),
+                        help="generate a regular fleet instead of reading a manifest")
+    parser.add_argument("--history-depth", type=int, default=0,
+                        help="samples kept per variable for HistoryRead; 0 disables the historian")
+    parser.add_argument("--history-memory", type=int, default=HISTORY_MEMORY_CAP // (1024 * 1024),
+                        help="memory cap of the historian in MiB")
+    parser.add_argument("--replay", action="store_true",
+                        help="replay the dataset into the address space from inside the server")
+    parser.add_argument("--dataset", default=DATASET_FILE, help="CSV or XLSX file to replay")
+    parser.add_argument("--sample-period", type=float, default=1.0, help="seconds between two rows of the dataset")
+    parser.add_argument("--speed", type=float, default=1.0,
+                        help="time compression factor of the replay; 0 = as fast as possible")
+    parser.add_argument("--kpis", nargs="?", const=DEFAULT_REFRIGERANT, default=None, choices=list(REFRIGERANTS),
+                        help="add superheat, subcooling and pressure ratio variables to the fridges, computed by "
+                             f"the replay (needs --replay; refrigerant {DEFAULT_REFRIGERANT} by default)")
+    args = parser.parse_args()
+    # Only the in-process replay writes the KPIs: with an external controller they would stay at 0.0
+    if args.kpis and not args.replay:
+        parser.error("--kpis needs --replay")
+
+    tree = None
+    if args.manifest:
+        tree = load_manifest(args.manifest)
+    elif args.counts:
+        tree = topology_from_counts(*args.counts)
+
     # Configuration of the logging (how much the server comunicates with us) option
     logging.basicConfig(level=logging.INFO)
     # Run the "main" part of the code in a asyncronous way
-    asyncio.run(main()) # Execute the function "main" asyncronously, basically it allows us to go on with the rest of the code
-                        # while waiting for an answare from the server for example. If it was syncronous it will wait for the answare
-
-    
-
+    asyncio.run(main(tree, args.replay, args.dataset, args.sample_period, args.speed,
+                     args.history_depth, args.history_memory * 1024 * 1024, args.kpis)) # Execute the function "main" asyncronously, basically it allows us to go on with the rest of the code
+                            # while waiting for an answare from the server for example. If it was syncronous it will wait for the answare
@@ -0,0 +1,40 @@
+import socket
+from contextlib import asynccontextmanager
+
+from asyncua import Server
+
+from fleet import NAMESPACE, VARIABLES
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+@asynccontextmanager
+async def fridge_server(tree):
+    """An in-process OPC UA server with the object types of supermarket_server.py and the fridges of
+    tree ({supermarket: {location: [fridges]}}); yields (server, url, namespace index)"""
+    server = Server()
+    await server.init()
+    url = f"opc.tcp://127.0.0.1:{_free_port()}"
+    server.set_endpoint(url)
+    idx = await server.register_namespace(NAMESPACE)
+
+    supermarket_type = await server.nodes.base_object_type.add_object_type(idx, "SupermarketType")
+    location_type = await supermarket_type.add_object_type(idx, "LocationType")
+    fridge_type = await location_type.add_object_type(idx, "Fridges")
+    for name in VARIABLES:
+        variable = await fridge_type.add_variable(idx, name, 0.0)
+        await variable.set_modelling_rule(True)
+
+    for supermarket_name, locations in tree.items():
+        supermarket = await server.nodes.objects.add_object(idx, supermarket_name, supermarket_type)
+        for location_name, fridge_names in locations.items():
+            location = await supermarket.add_object(idx, location_name, location_type)
+            for fridge_name in fridge_names:
+                await location.add_object(idx, fridge_name, fridge_type)
+
+    async with server:
+        yield server, url, idx
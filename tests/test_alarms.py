@@ -0,0 +1,122 @@
+import numpy as np
+import pytest
+
+from alarms import AlarmEngine, Rule, load_rules
+from fleet import VARIABLES, FridgeInfo
+
+COL = VARIABLES.index("tempC1")
+
+
+def _engine(*rules, n_fridges=2):
+    fridges = [FridgeInfo(("Supermarket1", "Location1", f"Fridge{i + 1}"), None) for i in range(n_fridges)]
+    return AlarmEngine(fridges, list(rules))
+
+
+def _tables(engine, temperature, t):
+    values = np.full((len(engine.fridges), len(VARIABLES)), 275.0)
+    values[0, COL] = temperature
+    return values, np.full(values.shape, float(t))
+
+
+def _states(events):
+    return [(event["fridge"], event["state"]) for event in events]
+
+
+def test_raised_after_duration_and_cleared_at_once():
+    engine = _engine(Rule("TooWarm", "tempC1", "above", 281.15, duration=10))
+    assert engine.evaluate(*_tables(engine, 285.0, 0), now=0) == []
+    assert engine.evaluate(*_tables(engine, 285.0, 5), now=5) == []
+    events = engine.evaluate(*_tables(engine, 285.0, 10), now=10)
+    assert _states(events) == [("Fridge1", "raised")]
+    assert events[0]["value"] == 285.0
+
+    assert engine.evaluate(*_tables(engine, 285.0, 15), now=15) == []  # still active, no new event
+    assert len(engine.active_alarms(_tables(engine, 285.0, 15)[0])) == 1
+    assert _states(engine.evaluate(*_tables(engine, 280.0, 16), now=16)) == [("Fridge1", "cleared")]
+    assert engine.active_alarms(_tables(engine, 280.0, 16)[0]) == []
+
+
+def test_interrupted_condition_restarts_the_duration():
+    engine = _engine(Rule("TooCold", "tempC1", "below", 268.15, duration=10))
+    engine.evaluate(*_tables(engine, 260.0, 0), now=0)
+    engine.evaluate(*_tables(engine, 270.0, 8), now=8)  # back in range before the duration
+    assert engine.evaluate(*_tables(engine, 260.0, 12), now=12) == []
+    assert engine.evaluate(*_tables(engine, 260.0, 21), now=21) == []
+    assert _states(engine.evaluate(*_tables(engine, 260.0, 22), now=22)) == [("Fridge1", "raised")]
+
+
+def test_rate_rule_uses_the_source_timestamps():
+    engine = _engine(Rule("WarmingFast", "tempC1", "rate", 0.05))
+    assert engine.evaluate(*_tables(engine, 275.0, 0), now=0) == []
+    events = engine.evaluate(*_tables(engine, 276.0, 10), now=10)  # 0.1 K/s
+    assert _states(events) == [("Fridge1", "raised")]
+    assert events[0]["value"] == pytest.approx(0.1)
+    # Same source timestamp: the rate is not recomputed and the alarm stays
+    assert engine.evaluate(*_tables(engine, 276.0, 10), now=11) == []
+    assert _states(engine.evaluate(*_tables(engine, 276.1, 20), now=20)) == [("Fridge1", "cleared")]
+
+
+def test_missing_values_do_not_raise():
+    engine = _engine(Rule("TooWarm", "tempC1", "above", 281.15))
+    assert engine.evaluate(*_tables(engine, np.nan, 0), now=0) == []
+
+
+def test_invalid_rules():
+    with pytest.raises(ValueError):
+        Rule("Bad", "notAVariable", "above", 0)
+    with pytest.raises(ValueError):
+        Rule("Bad", "tempC1", "sideways", 0)
+    assert all(rule.variable in VARIABLES for rule in load_rules())
+
+
+def _feed(engine, samples):
+    """samples: (time, value of tempC1 of Fridge1), one update per sample at its own time"""
+    events = []
+    for t, value in samples:
+        events += engine.update(0, COL, value, float(t), now=t)
+    return events
+
+
+def test_every_sample_is_evaluated():
+    # A spike shorter than a snapshot period is still seen
+    engine = _engine(Rule("TooWarm", "tempC1", "above", 281.15))
+    events = _feed(engine, [(0, 275.0), (0.1, 290.0), (0.2, 275.0)])
+    assert _states(events) == [("Fridge1", "raised"), ("Fridge1", "cleared")]
+    assert events[0]["value"] == 290.0
+
+
+def test_rate_between_consecutive_samples():
+    engine = _engine(Rule("WarmingFast", "tempC1", "rate", 0.5))
+    # 0.1 K in 0.1 s is a rate of 1 K/s, which a 1 s snapshot would have seen as 0.1 K/s
+    events = _feed(engine, [(0, 275.0), (0.1, 275.1), (1.0, 275.1)])
+    assert _states(events) == [("Fridge1", "raised"), ("Fridge1", "cleared")]
+    assert events[0]["value"] == pytest.approx(1.0)
+
+
+def test_duration_ends_without_new_samples():
+    engine = _engine(Rule("TooWarm", "tempC1", "above", 281.15, duration=10))
+    assert _feed(engine, [(0, 275.0), (3.5, 285.0)]) == []
+    assert engine.next_deadline() == 13.5
+    assert engine.expire(now=13.4) == []
+    events = engine.expire(now=13.5)
+    assert _states(events) == [("Fridge1", "raised")]
+    assert events[0]["value"] == 285.0
+    assert engine.next_deadline() is None
+    assert _states(_feed(engine, [(14, 280.0)])) == [("Fridge1", "cleared")]
+
+
+def test_update_matches_evaluate():
+    rng = np.random.default_rng(0)
+    rules = load_rules()
+    snapshots, samples = _engine(*rules, n_fridges=3), _engine(*rules, n_fridges=3)
+    values = np.full((3, len(VARIABLES)), 275.0)
+    for t in range(200):
+        values += rng.normal(scale=3.0, size=values.shape)
+        times = np.full(values.shape, float(t))
+        expected = snapshots.evaluate(values, times, now=t)
+        events = samples.expire(now=t)
+        for row, col in np.ndindex(values.shape):
+            events += samples.update(row, col, values[row, col], float(t), now=t)
+        key = lambda event: (event["fridge"], event["rule"], event["variable"], event["state"])
+        assert sorted(map(key, events)) == sorted(map(key, expected))
+    np.testing.assert_array_equal(samples.active, snapshots.active)
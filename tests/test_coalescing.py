@@ -0,0 +1,80 @@
+import asyncio
+
+import pytest
+
+from middleware_chrome import SingleFlight
+
+
+class Fetch:
+    def __init__(self, delay=0.05, fail=0):
+        self.calls = 0
+        self.delay = delay
+        self.fail = fail  # number of calls that raise
+
+    async def __call__(self):
+        self.calls += 1
+        await asyncio.sleep(self.delay)
+        if self.calls <= self.fail:
+            raise ConnectionError("server down")
+        return self.calls
+
+
+def test_concurrent_calls_share_one_fetch():
+    fetch = Fetch()
+
+    async def scenario():
+        flight = SingleFlight(ttl=0)
+        results = await asyncio.gather(*(flight.do("fridge", fetch) for _ in range(10)))
+        other = await flight.do("other", fetch)
+        return flight, results, other
+
+    flight, results, other = asyncio.run(scenario())
+    assert results == [1] * 10
+    assert other == 2
+    assert flight.stats()["misses"] == 2
+    assert flight.stats()["coalesced"] == 9
+    assert flight.stats()["in_flight"] == 0
+
+
+def test_results_are_kept_for_ttl():
+    fetch = Fetch(delay=0)
+
+    async def scenario():
+        flight = SingleFlight(ttl=0.2)
+        first, second = await flight.do("fridge", fetch), await flight.do("fridge", fetch)
+        await asyncio.sleep(0.25)
+        return flight, first, second, await flight.do("fridge", fetch)
+
+    flight, first, second, expired = asyncio.run(scenario())
+    assert (first, second, expired) == (1, 1, 2)
+    assert flight.hits == 1
+
+
+def test_errors_are_shared_but_not_cached():
+    fetch = Fetch(fail=1)
+
+    async def scenario():
+        flight = SingleFlight(ttl=10)
+        failed = await asyncio.gather(flight.do("fridge", fetch), flight.do("fridge", fetch), return_exceptions=True)
+        return failed, await flight.do("fridge", fetch)
+
+    failed, retried = asyncio.run(scenario())
+    assert all(isinstance(error, ConnectionError) for error in failed)
+    assert retried == 2
+
+
+def test_cancelled_caller_does_not_cancel_the_fetch():
+    fetch = Fetch()
+
+    async def scenario():
+        flight = SingleFlight(ttl=0)
+        first = asyncio.create_task(flight.do("fridge", fetch))
+        second = asyncio.create_task(flight.do("fridge", fetch))
+        await asyncio.sleep(0.01)
+        first.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await first
+        return await second
+
+    assert asyncio.run(scenario()) == 1
+    assert fetch.calls == 1
@@ -0,0 +1,71 @@
+import os
+
+import numpy as np
+
+import controller
+
+
+def _csv(tmp_path, rows=6):
+    # One column more than the variables: the extra ones are ignored
+    data = np.arange(rows * (len(controller.VARIABLES) + 1), dtype=np.float64).reshape(rows, -1) / 4
+    path = tmp_path / "dataset.csv"
+    np.savetxt(path, data, delimiter=",")
+    return str(path), data
+
+
+def test_columns_in_variable_order(tmp_path):
+    filename, data = _csv(tmp_path)
+    dataset = controller.load_dataset(filename)
+    assert dataset.columns == tuple(controller.VARIABLES)
+    assert dataset.n_rows == len(data)
+    assert dataset.data.dtype == np.float32
+    assert dataset.data.flags.f_contiguous  # every column is contiguous
+    np.testing.assert_array_equal(dataset.data, data[:, :len(controller.VARIABLES)].astype(np.float32))
+    np.testing.assert_array_equal(dataset.column("tempC1"),
+                                  data[:, controller.VARIABLES.index("tempC1")].astype(np.float32))
+
+
+def test_parsed_once_per_process(tmp_path):
+    filename, _ = _csv(tmp_path)
+    assert controller.load_dataset(filename) is controller.load_dataset(filename)
+
+
+def test_cache_is_built_and_mapped(tmp_path):
+    filename, data = _csv(tmp_path)
+    dataset = controller.load_dataset(filename)
+    assert os.path.exists(controller.cache_path(filename))
+    assert isinstance(dataset.data, np.memmap)
+    np.testing.assert_array_equal(dataset.data, data[:, :len(controller.VARIABLES)].astype(np.float32))
+
+
+def test_cache_freshness(tmp_path):
+    filename, _ = _csv(tmp_path)
+    controller.build_cache(filename)
+    header, _ = controller._read_cache_header(controller.cache_path(filename))
+    assert controller._cache_is_fresh(header, filename)
+
+    # Touched but identical: the checksum keeps the cache
+    stat = os.stat(filename)
+    os.utime(filename, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    assert controller._cache_is_fresh(header, filename)
+
+    # Same size, different content
+    with open(filename, "rb") as f:
+        content = f.read()
+    with open(filename, "wb") as f:
+        f.write(content.replace(b"1", b"7", 1))
+    assert os.path.getsize(filename) == stat.st_size
+    assert not controller._cache_is_fresh(header, filename)
+
+    with open(filename, "ab") as f:
+        f.write(content.splitlines(keepends=True)[0])
+    assert not controller._cache_is_fresh(header, filename)
+
+
+def test_invalid_cache_is_rebuilt(tmp_path):
+    filename, data = _csv(tmp_path)
+    with open(controller.cache_path(filename), "wb") as f:
+        f.write(b"not a cache")
+    dataset = controller.load_dataset(filename)
+    np.testing.assert_array_equal(dataset.data, data[:, :len(controller.VARIABLES)].astype(np.float32))
+    assert controller._read_cache_header(controller.cache_path(filename)) is not None
@@ -0,0 +1,70 @@
+import gzip
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from starlette.requests import Request
+
+from middleware_chrome import COMPRESS_MIN_SIZE, EncodedBody, fridge_body
+
+BODY = b'{"value": 275.15}' * (COMPRESS_MIN_SIZE // 10)
+
+
+def _request(*headers):
+    return Request({"type": "http", "method": "GET", "path": "/", "query_string": b"",
+                    "headers": [(name.encode(), value.encode()) for name, value in headers]})
+
+
+def test_gzip_when_accepted():
+    response = EncodedBody(BODY, "application/json").response(_request(("accept-encoding", "gzip, deflate")))
+    assert response.headers["content-encoding"] == "gzip"
+    assert response.headers["vary"] == "Accept-Encoding"
+    assert gzip.decompress(response.body) == BODY
+
+
+@pytest.mark.parametrize("accept", ["", "deflate", "gzip;q=0", "identity"])
+def test_identity_when_gzip_is_not_accepted(accept):
+    response = EncodedBody(BODY, "application/json").response(_request(("accept-encoding", accept)))
+    assert "content-encoding" not in response.headers
+    assert response.body == BODY
+
+
+def test_small_bodies_are_not_compressed():
+    response = EncodedBody(b"{}", "application/json").response(_request(("accept-encoding", "gzip")))
+    assert "content-encoding" not in response.headers
+    assert response.body == b"{}"
+
+
+def test_brotli_is_preferred():
+    brotli = pytest.importorskip("brotli")
+    response = EncodedBody(BODY, "application/json").response(_request(("accept-encoding", "gzip, br")))
+    assert response.headers["content-encoding"] == "br"
+    assert brotli.decompress(response.body) == BODY
+
+
+def test_variants_are_encoded_once():
+    body = EncodedBody(BODY, "application/json")
+    assert body.encoded("gzip") is body.encoded("gzip")
+
+
+def _fridge(seconds):
+    timestamp = datetime(2024, 1, 1, tzinfo=timezone.utc) + timedelta(seconds=seconds)
+    return {"ns=2;s=Supermarket1.Location1.Fridge1.tempC1": {
+        "alias": "tempC1", "value": 275.15, "timestamp": timestamp, "quality": "Good"}}
+
+
+def test_etag_follows_the_source_timestamps():
+    assert fridge_body(_fridge(0)).etag == fridge_body(_fridge(0)).etag
+    assert fridge_body(_fridge(0)).etag != fridge_body(_fridge(1)).etag
+
+
+@pytest.mark.parametrize("if_none_match, status", [
+    (None, 200), ('"other"', 200), ("ETAG", 304), ("W/ETAG", 304), ('"other", ETAG', 304), ("*", 304),
+])
+def test_conditional_get(if_none_match, status):
+    body = fridge_body(_fridge(0))
+    headers = [] if if_none_match is None else [("if-none-match", if_none_match.replace("ETAG", body.etag))]
+    response = body.response(_request(*headers))
+    assert response.status_code == status
+    assert response.headers["etag"] == body.etag
+    if status == 304:
+        assert response.body == b""
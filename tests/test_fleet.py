@@ -0,0 +1,70 @@
+import asyncio
+
+from asyncua import Client
+
+from fleet import VARIABLES, discover_fridges, natural_key
+from fridge_server import fridge_server
+
+TREE = {
+    "Supermarket1": {"Location1": ["Fridge10", "Fridge2", "Fridge1"], "Location2": ["Fridge1"]},
+    "Supermarket2": {"Location1": []},
+}
+PATHS = [
+    ("Supermarket1", "Location1", "Fridge1"),
+    ("Supermarket1", "Location1", "Fridge2"),
+    ("Supermarket1", "Location1", "Fridge10"),
+    ("Supermarket1", "Location2", "Fridge1"),
+]
+
+
+def _counted(uaclient, name, calls):
+    call = getattr(uaclient, name)
+
+    async def counted(*args, **kwargs):
+        calls[name] = calls.get(name, 0) + 1
+        return await call(*args, **kwargs)
+    setattr(uaclient, name, counted)
+
+
+def test_discovery_does_not_depend_on_the_batch_size():
+    async def scenario():
+        async with fridge_server(TREE) as (server, url, idx):
+            async with Client(url) as client:
+                results = {}
+                for batch_size in (1, 3, 1000):
+                    calls = {}
+                    _counted(client.uaclient, "browse", calls)
+                    _counted(client.uaclient, "translate_browsepaths_to_nodeids", calls)
+                    results[batch_size] = (await discover_fridges(client, batch_size=batch_size), calls)
+                    del client.uaclient.browse, client.uaclient.translate_browsepaths_to_nodeids
+                return results
+
+    results = asyncio.run(scenario())
+    expected = None
+    for batch_size, (fridges, calls) in results.items():
+        assert [fridge.path for fridge in fridges] == PATHS
+        assert all(tuple(fridge.variables) == VARIABLES for fridge in fridges)
+        variables = [fridge.variables for fridge in fridges]
+        assert expected is None or variables == expected
+        expected = variables
+    # One Browse per level of the tree and one translate for the type and for all the variables
+    assert results[1000][1] == {"browse": 3, "translate_browsepaths_to_nodeids": 2}
+    assert results[1][1]["translate_browsepaths_to_nodeids"] == 1 + len(PATHS) * len(VARIABLES)
+
+
+def test_missing_variables_are_left_out():
+    async def scenario():
+        async with fridge_server({"Supermarket1": {"Location1": ["Fridge1"]}}) as (server, url, idx):
+            fridge = await server.nodes.objects.get_child([f"{idx}:Supermarket1", f"{idx}:Location1", f"{idx}:Fridge1"])
+            await (await fridge.get_child(f"{idx}:tempC3")).delete()
+            async with Client(url) as client:
+                return await discover_fridges(client)
+
+    (fridge,) = asyncio.run(scenario())
+    assert "tempC3" not in fridge.variables
+    assert len(fridge.variables) == len(VARIABLES) - 1
+
+
+def test_natural_key():
+    names = [("S1", "L1", "Fridge10"), ("S1", "L1", "Fridge9"), ("S10", "L1", "Fridge1"), ("S2", "L1", "Fridge1")]
+    assert sorted(names, key=natural_key) == [names[1], names[0], names[3], names[2]]
@@ -0,0 +1,79 @@
+import asyncio
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from asyncua import ua
+
+from historian import RingBufferHistory
+
+NODE = ua.NodeId("Supermarket1.Location1.Fridge1.tempC1", 2)
+START = datetime(2024, 1, 1, tzinfo=timezone.utc)
+
+
+def _history(samples, depth=100):
+    """A storage holding (seconds after START, value) samples of NODE"""
+    history = RingBufferHistory(depth)
+    asyncio.run(history.new_historized_node(NODE, None))
+    for seconds, value in samples:
+        dv = ua.DataValue(ua.Variant(value, ua.VariantType.Double), SourceTimestamp=START + timedelta(seconds=seconds))
+        asyncio.run(history.save_node_value(NODE, dv))
+    return history
+
+
+def _aggregate(history, aggregate, seconds, interval):
+    dvs = history.aggregate(NODE, ua.NodeId(aggregate), START, START + timedelta(seconds=seconds), interval * 1000)
+    return [dv.Value.Value if dv.StatusCode.is_good() else None for dv in dvs]
+
+
+# Samples in the buckets [0, 10) and [20, 30), none in [10, 20)
+SAMPLES = [(1, 1.0), (3, 5.0), (8, 3.0), (21, 2.0), (25, 4.0)]
+
+
+@pytest.mark.parametrize("aggregate, expected", [
+    (ua.ObjectIds.AggregateFunction_Average, [3.0, None, 3.0]),
+    (ua.ObjectIds.AggregateFunction_Minimum, [1.0, None, 2.0]),
+    (ua.ObjectIds.AggregateFunction_Maximum, [5.0, None, 4.0]),
+    (ua.ObjectIds.AggregateFunction_Total, [9.0, None, 6.0]),
+    (ua.ObjectIds.AggregateFunction_Range, [4.0, None, 2.0]),
+    (ua.ObjectIds.AggregateFunction_Start, [1.0, None, 2.0]),
+    (ua.ObjectIds.AggregateFunction_End, [3.0, None, 4.0]),
+    (ua.ObjectIds.AggregateFunction_Count, [3.0, 0.0, 2.0]),
+])
+def test_aggregates_with_an_empty_bucket(aggregate, expected):
+    assert _aggregate(_history(SAMPLES), aggregate, 30, 10) == expected
+
+
+def test_empty_bucket_is_bad_no_data():
+    dvs = _history(SAMPLES).aggregate(NODE, ua.NodeId(ua.ObjectIds.AggregateFunction_Average),
+                                      START, START + timedelta(seconds=30), 10000)
+    assert dvs[1].StatusCode.value == ua.StatusCodes.BadNoData
+    assert [dv.SourceTimestamp for dv in dvs] == [START + timedelta(seconds=s) for s in (0, 10, 20)]
+
+
+def test_aggregates_without_samples():
+    assert _aggregate(_history([]), ua.ObjectIds.AggregateFunction_Maximum, 20, 10) == [None, None]
+
+
+def test_ring_keeps_the_last_samples():
+    history = _history([(s, float(s)) for s in range(10)], depth=4)
+    dvs, cont = asyncio.run(history.read_node_history(NODE, START, START + timedelta(seconds=100), 0))
+    assert [dv.Value.Value for dv in dvs] == [6.0, 7.0, 8.0, 9.0]
+    assert cont is None
+
+
+def test_depth_below_one_is_refused():
+    with pytest.raises(ua.UaError):
+        asyncio.run(RingBufferHistory(0).new_historized_node(NODE, None))
+
+
+def test_unsupported_aggregate():
+    with pytest.raises(ua.UaStatusCodeError):
+        _history(SAMPLES).aggregate(NODE, ua.NodeId(ua.ObjectIds.AggregateFunction_Interpolative),
+                                    START, START + timedelta(seconds=30), 10000)
+
+
+@pytest.mark.parametrize("start, end", [(None, START), (START, None), (ua.get_win_epoch(), START)])
+def test_processed_read_needs_start_and_end(start, end):
+    with pytest.raises(ua.UaStatusCodeError) as error:
+        _history(SAMPLES).aggregate(NODE, ua.NodeId(ua.ObjectIds.AggregateFunction_Average), start, end, 10000)
+    assert error.value.code == ua.StatusCodes.BadInvalidTimestampArgument
@@ -0,0 +1,53 @@
+import numpy as np
+import pytest
+
+from fleet import VARIABLES
+from kpis import KPIS, REFRIGERANTS, SaturationTable, compute_kpis
+
+
+@pytest.mark.parametrize("pressure, celsius", [
+    (0.29280, 0.0),  # table points
+    (0.57171, 20.0),
+    (0.2, -10.09),  # between table points, published R134a saturation data
+    (0.5, 15.71),
+    (1.0, 39.37),
+])
+def test_r134a_saturation_temperature(pressure, celsius):
+    assert SaturationTable("R134a").temperature(pressure) == pytest.approx(celsius + 273.15, abs=0.05)
+
+
+def test_outside_the_table_is_nan():
+    table = REFRIGERANTS["R134a"]
+    temperatures = SaturationTable().temperature([table[0, 1] / 2, table[-1, 1] * 2, 0.0, -1.0, np.nan])
+    assert np.isnan(temperatures).all()
+
+
+def test_unknown_refrigerant():
+    with pytest.raises(ValueError):
+        SaturationTable("R22")
+
+
+def _row(**values):
+    row = np.full(len(VARIABLES), 275.0)
+    for name, value in values.items():
+        row[VARIABLES.index(name)] = value
+    return row
+
+
+def test_compute_kpis():
+    table = SaturationTable()
+    values = np.stack([
+        _row(evapOutPres=0.29280, evapOutTemp=278.15, condOutPres=0.57171, condOutTemp=290.15, compOutPres=0.7),
+        _row(evapOutPres=0.0, evapOutTemp=0.49, condOutPres=np.nan, condOutTemp=290.15, compOutPres=0.7),
+    ])
+    kpis = compute_kpis(values, table)
+    assert kpis.shape == (2, len(KPIS))
+
+    first = dict(zip(KPIS, kpis[0]))
+    assert first["superheat"] == pytest.approx(5.0)
+    assert first["subcooling"] == pytest.approx(3.0)
+    assert first["pressureRatio"] == pytest.approx(0.7 / 0.29280)
+    assert first["evapSatTemp"] == pytest.approx(273.15)
+    assert first["condSatTemp"] == pytest.approx(293.15)
+    # no evaporator pressure, a faulty temperature sensor and no condenser pressure: nothing is computable
+    assert np.isnan(kpis[1]).all()
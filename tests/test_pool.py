@@ -0,0 +1,91 @@
+import asyncio
+
+import pytest
+from asyncua import ua
+
+from fridge_server import fridge_server
+from middleware_chrome import OPCConnection
+
+
+def _run(scenario, **kwargs):
+    """Runs scenario(pool) against a test server with a fast reconnecting pool"""
+    async def main():
+        async with fridge_server({}) as (server, url, idx):
+            pool = OPCConnection(url, keep_alive=60, backoff_min=0.05, backoff_max=0.1, **kwargs)
+            await pool.connect()
+            try:
+                return await scenario(pool)
+            finally:
+                await pool.disconnect()
+    return asyncio.run(main())
+
+
+async def _wait_for(condition, timeout=5.0):
+    for _ in range(int(timeout / 0.05)):
+        if condition():
+            return
+        await asyncio.sleep(0.05)
+    raise AssertionError("condition not met")
+
+
+def test_requests_take_the_least_loaded_session():
+    async def scenario(pool):
+        assert pool.stats()["healthy"] == 3
+        async with pool.session() as a, pool.session() as b, pool.session() as c:
+            assert len({id(a), id(b), id(c)}) == 3
+            assert pool.stats()["in_flight"] == 3
+            assert await a.nodes.server_state.read_value() == ua.ServerState.Running
+        assert pool.stats()["in_flight"] == 0
+
+    _run(scenario, pool_size=3)
+
+
+def test_busy_pool_waits_then_times_out():
+    async def scenario(pool):
+        async with pool.session():
+            with pytest.raises(ConnectionError):
+                async with pool.session():
+                    pass
+        assert pool.waits == 1
+
+        # A waiting request gets the session as soon as it is released
+        async def waiting():
+            async with pool.session() as client:
+                return client
+        async with pool.session() as held:
+            task = asyncio.create_task(waiting())
+            await asyncio.sleep(0.05)
+            assert not task.done()
+        assert await task is held
+
+    _run(scenario, pool_size=1, max_in_flight=1, acquire_timeout=0.3)
+
+
+def test_broken_session_is_reconnected():
+    restored = []
+
+    async def scenario(pool):
+        pool.on_reconnect.append(lambda: asyncio.sleep(0, restored.append(True)))
+        with pytest.raises(ConnectionError):
+            async with pool.session():
+                raise ConnectionError("connection lost")
+        assert pool.stats()["healthy"] == 0
+        assert pool.failures == 1
+        await _wait_for(lambda: pool.reconnects == 1)
+        assert pool.stats()["healthy"] == 1
+        async with pool.session() as client:
+            await client.nodes.server_state.read_value()
+
+    _run(scenario, pool_size=1)
+    assert restored == [True]  # the primary session came back
+
+
+def test_bad_status_keeps_the_session():
+    async def scenario(pool):
+        with pytest.raises(ua.UaStatusCodeError):
+            async with pool.session() as client:
+                await client.get_node(ua.NodeId("doesNotExist", 2)).read_value()
+        assert pool.failures == 0
+        assert pool.stats()["healthy"] == 1
+
+    _run(scenario, pool_size=1)
@@ -0,0 +1,75 @@
+import numpy as np
+import pytest
+
+from query import ValueIndex, parse_condition
+
+VALUES = np.array([
+    [3.0, 10.0],
+    [1.0, np.nan],
+    [2.0, 30.0],
+    [np.nan, 20.0],
+    [2.0, 40.0],
+])
+
+
+@pytest.mark.parametrize("op, limit, expected", [
+    (">", 2.0, [0]),
+    (">=", 2.0, [0, 2, 4]),
+    ("<", 2.0, [1]),
+    ("<=", 2.0, [1, 2, 4]),
+    ("==", 2.0, [2, 4]),
+    ("==", 2.5, []),
+    (">", 100.0, []),
+    ("<", 100.0, [0, 1, 2, 4]),  # the missing value never matches
+])
+def test_select_matches_a_scan(op, limit, expected):
+    mask = ValueIndex(VALUES).select(0, op, limit)
+    assert np.flatnonzero(mask).tolist() == expected
+
+
+def test_select_on_random_values():
+    rng = np.random.default_rng(0)
+    values = rng.integers(0, 20, size=(500, 3)).astype(np.float64)
+    values[rng.random(values.shape) < 0.1] = np.nan
+    index = ValueIndex(values)
+    scans = {">": np.greater, ">=": np.greater_equal, "<": np.less, "<=": np.less_equal, "==": np.equal}
+    with np.errstate(invalid="ignore"):
+        for col in range(3):
+            for op, scan in scans.items():
+                np.testing.assert_array_equal(index.select(col, op, 7.0), scan(values[:, col], 7.0))
+
+
+def test_decimal_equality_on_float32_values():
+    # Values as they arrive from the server: Floats widened to float64
+    values = np.array([[4.1], [4.2], [np.nan], [4.1]], dtype=np.float32).astype(np.float64)
+    index = ValueIndex(values)
+    assert np.flatnonzero(index.select(0, "==", 4.1)).tolist() == [0, 3]
+    assert np.flatnonzero(index.select(0, ">", 4.1)).tolist() == [1]
+    assert np.flatnonzero(index.select(0, "<=", 4.1)).tolist() == [0, 3]
+    assert np.flatnonzero(index.select(0, "==", 4.1000001)).tolist() == [0, 3]  # same float32
+    assert np.flatnonzero(index.select(0, "==", 4.1001)).tolist() == []
+
+
+def test_ranked_skips_missing_values():
+    index = ValueIndex(VALUES)
+    everything = np.ones(len(VALUES), dtype=bool)
+    assert index.ranked(1, everything).tolist() == [4, 2, 3, 0]
+    assert index.ranked(1, everything, descending=False).tolist() == [0, 3, 2, 4]
+    assert index.ranked(1, index.select(0, ">=", 2.0)).tolist() == [4, 2, 0]
+
+
+def test_index_keeps_its_own_copy():
+    values = VALUES.copy()
+    index = ValueIndex(values)
+    values[:] = 0.0
+    assert np.flatnonzero(index.select(0, "==", 2.0)).tolist() == [2, 4]
+
+
+def test_parse_condition():
+    assert parse_condition("tempC3>271.15") == ("tempC3", ">", 271.15)
+    assert parse_condition(" compOutPres <= 1e-1 ") == ("compOutPres", "<=", 0.1)
+    assert parse_condition("tempC1=270") == ("tempC1", "==", 270.0)
+    with pytest.raises(ValueError):
+        parse_condition("tempC3>>1")
+    with pytest.raises(ValueError):
+        parse_condition("unknown>1")
@@ -0,0 +1,38 @@
+import numpy as np
+import pytest
+
+from controller import ReplayCursor
+
+
+def test_wraps_around_its_range():
+    cursor = ReplayCursor(np.arange(10, dtype=np.float32), start=7)
+    assert [next(cursor) for _ in range(5)] == [7.0, 8.0, 9.0, 7.0, 8.0]
+
+
+def test_stop_and_no_loop():
+    cursor = ReplayCursor(np.arange(10, dtype=np.float32), start=2, stop=5, loop=False)
+    assert list(cursor) == [2.0, 3.0, 4.0]
+    with pytest.raises(StopIteration):
+        next(cursor)
+
+
+def test_rows_of_a_block_are_plain_floats():
+    block = np.asfortranarray(np.arange(12, dtype=np.float32).reshape(4, 3))
+    cursor = ReplayCursor(block, start=2)
+    row = next(cursor)
+    assert row == [6.0, 7.0, 8.0] and all(type(value) is float for value in row)
+    assert next(cursor) == [9.0, 10.0, 11.0]
+    assert next(cursor) == [6.0, 7.0, 8.0]
+
+
+def test_values_are_not_copied():
+    column = np.arange(5, dtype=np.float32)
+    cursor = ReplayCursor(column)
+    column[0] = 42.0
+    assert next(cursor) == 42.0
+
+
+@pytest.mark.parametrize("start, stop", [(5, 5), (-1, 3), (10, None), (3, 2)])
+def test_empty_range(start, stop):
+    with pytest.raises(ValueError):
+        ReplayCursor(np.arange(5, dtype=np.float32), start, stop)
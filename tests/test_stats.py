@@ -0,0 +1,92 @@
+import numpy as np
+import pytest
+
+from fleet import FridgeInfo
+from stats import MIN_PEERS, MIN_SAMPLES, OnlineStats
+
+
+def _fridges(*locations):
+    return [FridgeInfo(("Supermarket1", location, f"Fridge{i + 1}"), None) for i, location in enumerate(locations)]
+
+
+def _feed(stats, samples):
+    """samples: [tick, fridge, variable] values, one tick per update with a new timestamp"""
+    for tick, values in enumerate(samples):
+        stats.update(values, np.full(values.shape, float(tick)))
+
+
+def test_welford_matches_numpy():
+    rng = np.random.default_rng(0)
+    samples = 275 + rng.normal(scale=2.0, size=(200, 3, 2))
+    stats = OnlineStats(_fridges("L1", "L1", "L2"), variables=("a", "b"))
+    _feed(stats, samples)
+
+    np.testing.assert_array_equal(stats.count, 200)
+    np.testing.assert_allclose(stats.mean, samples.mean(axis=0), rtol=1e-12)
+    np.testing.assert_allclose(stats.std(), samples.std(axis=0, ddof=1), rtol=1e-9)
+    np.testing.assert_array_equal(stats.min, samples.min(axis=0))
+    np.testing.assert_array_equal(stats.max, samples.max(axis=0))
+
+
+def test_only_new_timestamps_and_values_are_added():
+    stats = OnlineStats(_fridges("L1"), variables=("a", "b"))
+    values = np.array([[1.0, np.nan]])
+    times = np.array([[0.0, 0.0]])
+    assert stats.update(values, times) == 1
+    assert stats.update(values, times) == 0  # same timestamp
+    np.testing.assert_array_equal(stats.count, [[1, 0]])
+    assert np.isnan(stats.std()).all()
+
+
+def test_ewma_and_self_score():
+    stats = OnlineStats(_fridges("L1"), variables=("a",), alpha=0.5)
+    _feed(stats, np.array([[[2.0]], [[4.0]]]))
+    # first sample initialises the average, the second moves it half way
+    assert stats.ewma[0, 0] == 3.0
+    assert stats.ewm_var[0, 0] == 0.5 * (0 + 0.5 * 2.0 ** 2)
+
+    _feed(stats, np.array([[[2.0]], [[4.0]]] * (MIN_SAMPLES // 2 - 1)))
+    ewma, ewm_var = stats.ewma[0, 0], stats.ewm_var[0, 0]
+    assert stats.ewm_std()[0, 0] == pytest.approx(np.sqrt(ewm_var / (1 - 0.5 ** (MIN_SAMPLES - 1))))
+    # the next sample is scored against the average before it, with the variance debiased from its zero start
+    stats.update(np.array([[7.0]]), np.array([[float(MIN_SAMPLES)]]))
+    assert stats.z_self[0, 0] == pytest.approx((7.0 - ewma) / np.sqrt(ewm_var / (1 - 0.5 ** (MIN_SAMPLES - 1))))
+
+
+def test_self_score_waits_for_enough_samples():
+    stats = OnlineStats(_fridges("L1"), variables=("a",))
+    _feed(stats, np.array([[[277.0]], [[277.1]], [[277.2]]]))
+    assert np.isnan(stats.z_self[0, 0])
+    assert np.isnan(stats.scores()[0])
+
+    # A steady drift keeps a small score once the statistics have warmed up
+    for tick in range(3, 200):
+        stats.add(0, 0, 277.0 + 0.1 * tick + 0.05 * (tick % 2), float(tick))
+    assert abs(stats.z_self[0, 0]) < 3
+
+
+def test_single_samples_match_tables():
+    rng = np.random.default_rng(1)
+    samples = 275 + rng.normal(size=(50, 4, 2))
+    samples[:, 1:][rng.random(samples[:, 1:].shape) < 0.1] = np.nan
+    tables, single = (OnlineStats(_fridges("L1", "L1", "L1", "L2"), variables=("a", "b")) for _ in range(2))
+    _feed(tables, samples)
+    for tick, values in enumerate(samples):
+        for row, col in np.ndindex(values.shape):
+            single.add(row, col, values[row, col], float(tick))
+        assert not single.add(0, 0, 0.0, float(tick))  # same timestamp again
+    single.score_peers()
+    for name in ("count", "mean", "m2", "min", "max", "ewma", "ewm_var", "z_self", "z_peer"):
+        np.testing.assert_allclose(getattr(single, name), getattr(tables, name), rtol=1e-12)
+
+
+def test_peer_score_needs_enough_peers():
+    stats = OnlineStats(_fridges(*(["L1"] * MIN_PEERS + ["L2"] * (MIN_PEERS - 1))), variables=("a",))
+    values = np.array([[1.0], [2.0], [6.0], [3.0], [5.0]])[:MIN_PEERS * 2 - 1]
+    stats.update(values, np.zeros(values.shape))
+
+    group = values[:MIN_PEERS, 0]
+    expected = (group - group.mean()) / group.std()
+    np.testing.assert_allclose(stats.z_peer[:MIN_PEERS, 0], expected)
+    assert np.isnan(stats.z_peer[MIN_PEERS:, 0]).all()
+    assert stats.scores()[2] == pytest.approx(np.abs(expected).max())
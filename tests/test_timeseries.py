@@ -0,0 +1,111 @@
+import numpy as np
+import pytest
+
+from timeseries import BYTES_PER_SAMPLE, RingBuffer, SeriesBuffer, lttb, minmax
+
+
+def _reference_lttb(x, y, n_out):
+    """Plain loop version of Largest-Triangle-Three-Buckets (Steinarsson), point by point"""
+    n = len(x)
+    every = (n - 2) / (n_out - 2)
+    chosen, a = [0], 0
+    for i in range(n_out - 2):
+        start, end = int(i * every) + 1, int((i + 1) * every) + 1
+        next_start, next_end = end, min(int((i + 2) * every) + 1, n)
+        if next_start >= n - 1:
+            avg_x, avg_y = x[-1], y[-1]
+        else:
+            avg_x, avg_y = np.mean(x[next_start:next_end]), np.mean(y[next_start:next_end])
+        best, best_area = start, -1.0
+        for j in range(start, end):
+            area = abs((x[a] - avg_x) * (y[j] - y[a]) - (x[a] - x[j]) * (avg_y - y[a]))
+            if area > best_area:
+                best, best_area = j, area
+        chosen.append(best)
+        a = best
+    chosen.append(n - 1)
+    return np.array(chosen)
+
+
+@pytest.mark.parametrize("n, n_out", [(1000, 100), (1001, 37), (50, 3), (10, 9)])
+def test_lttb_matches_reference(n, n_out):
+    rng = np.random.default_rng(n)
+    times = np.arange(n, dtype=np.float64) + rng.random(n) * 0.5
+    values = np.cumsum(rng.normal(size=n)).astype(np.float32)
+    sampled_times, sampled_values = lttb(times, values, n_out)
+    chosen = _reference_lttb(times, values.astype(np.float64), n_out)
+    assert len(sampled_times) == n_out
+    np.testing.assert_array_equal(sampled_times, times[chosen])
+    np.testing.assert_array_equal(sampled_values, values[chosen])
+
+
+def test_lttb_keeps_short_series():
+    times, values = np.arange(5.0), np.arange(5.0)
+    assert lttb(times, values, 10)[0] is times
+    assert lttb(times, values, 5)[0] is times
+
+
+@pytest.mark.parametrize("downsample", [lttb, minmax])
+@pytest.mark.parametrize("n_out, expected", [(2, [0.0, 9.0]), (1, [9.0])])
+def test_never_more_points_than_asked(downsample, n_out, expected):
+    times, values = np.arange(10.0), np.arange(10.0, dtype=np.float32)
+    sampled_times, sampled_values = downsample(times, values, n_out)
+    np.testing.assert_array_equal(sampled_times, expected)
+    np.testing.assert_array_equal(sampled_values, expected)
+    with pytest.raises(ValueError):
+        downsample(times, values, 0)
+
+
+def test_minmax_keeps_the_extremes_of_every_bucket():
+    rng = np.random.default_rng(0)
+    n, n_out = 1000, 20
+    times = np.arange(n, dtype=np.float64)
+    values = rng.normal(size=n).astype(np.float32)
+    sampled_times, sampled_values = minmax(times, values, n_out)
+
+    buckets = np.arange(n) * (n_out // 2) // n
+    expected = set()
+    for b in range(n_out // 2):
+        index = np.flatnonzero(buckets == b)
+        expected.add(index[np.argmin(values[index])])
+        expected.add(index[np.argmax(values[index])])
+    np.testing.assert_array_equal(sampled_times, times[sorted(expected)])
+    assert np.all(np.diff(sampled_times) > 0)
+
+
+def test_minmax_flat_series_gives_one_point_per_bucket():
+    times, values = np.arange(100.0), np.ones(100, dtype=np.float32)
+    sampled_times, _ = minmax(times, values, 10)
+    np.testing.assert_array_equal(sampled_times, np.arange(0.0, 100.0, 20.0))
+
+
+def test_series_buffer_wraps_around():
+    buffer = SeriesBuffer(2, 3, depth=4)
+    for t in range(6):
+        buffer.append(buffer.series(1, 2), float(t), float(t * 10))
+    buffer.append(buffer.series(0, 0), 100.0, 1.0)
+
+    times, values = buffer.window(buffer.series(1, 2), 0.0, 10.0)
+    np.testing.assert_array_equal(times, [2.0, 3.0, 4.0, 5.0])
+    np.testing.assert_array_equal(values, [20.0, 30.0, 40.0, 50.0])
+    times, _ = buffer.window(buffer.series(1, 2), 3.0, 4.0)
+    np.testing.assert_array_equal(times, [3.0, 4.0])
+    assert len(buffer.window(buffer.series(0, 1), 0.0, 1000.0)[0]) == 0
+
+
+def test_series_buffer_stays_below_the_memory_cap():
+    buffer = SeriesBuffer(10, 5, depth=1000, memory_cap=50 * BYTES_PER_SAMPLE * 20)
+    assert buffer.depth == 20
+    assert buffer.times.nbytes + buffer.values.nbytes == 50 * 20 * BYTES_PER_SAMPLE
+
+
+def test_ring_buffer_with_integer_times():
+    ring = RingBuffer(1, depth=3, time_dtype=np.int64)
+    for us in (10, 20, 30, 40):
+        ring.append(0, us, us / 10)
+    times, values = ring.ordered(0)
+    assert times.dtype == np.int64
+    np.testing.assert_array_equal(times, [20, 30, 40])
+    np.testing.assert_array_equal(values, [2.0, 3.0, 4.0])
+    with pytest.raises(ValueError):
+        RingBuffer(1, depth=0)
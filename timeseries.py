@@ -0,0 +1,134 @@
+import logging
+import numpy as np
+from typing import Tuple
+
+_logger = logging.getLogger(__name__)
+
+
+BYTES_PER_SAMPLE = 12  # an 8 byte timestamp and a float32 value
+HISTORY_MEMORY_CAP = 256 * 1024 * 1024
+
+
+class RingBuffer:
+    """The last `depth` samples of n_series series in preallocated (n_series, depth) arrays.
+
+    Values are float32 and times 8 bytes (float64 seconds or int64 microseconds, see time_dtype), so a sample
+    costs BYTES_PER_SAMPLE bytes whatever the number of writes; nothing is allocated per sample.
+    """
+    def __init__(self, n_series: int, depth: int = 3600, time_dtype=np.float64):
+        if depth < 1:
+            raise ValueError(f"A ring buffer holds at least 1 sample, not {depth}")
+        self.depth = depth
+        self.times = np.zeros((n_series, depth), dtype=time_dtype)
+        self.values = np.zeros((n_series, depth), dtype=np.float32)
+        self.head = np.zeros(n_series, dtype=np.int64)
+        self.count = np.zeros(n_series, dtype=np.int64)
+
+    def append(self, series: int, timestamp, value: float):
+        head = self.head[series]
+        self.times[series, head] = timestamp
+        self.values[series, head] = value
+        self.head[series] = (head + 1) % self.depth
+        if self.count[series] < self.depth:
+            self.count[series] += 1
+
+    def ordered(self, series: int) -> Tuple[np.ndarray, np.ndarray]:
+        """Samples of a series from the oldest to the newest"""
+        count, head = self.count[series], self.head[series]
+        if count < self.depth:
+            return self.times[series, :count], self.values[series, :count]
+        return np.roll(self.times[series], -head), np.roll(self.values[series], -head)
+
+    def window(self, series: int, start, end) -> Tuple[np.ndarray, np.ndarray]:
+        """Samples with start <= time <= end, oldest first"""
+        times, values = self.ordered(series)
+        first = np.searchsorted(times, start, side="left")
+        last = np.searchsorted(times, end, side="right")
+        return times[first:last], values[first:last]
+
+
+class SeriesBuffer(RingBuffer):
+    """Ring buffer of every fridge variable, with times in seconds since the Unix epoch.
+
+    Series are numbered row * n_cols + col, like the cells of the live value cache, and the depth is reduced
+    to keep the buffer below memory_cap.
+    """
+    def __init__(self, n_rows: int, n_cols: int, depth: int = 3600, memory_cap: int = HISTORY_MEMORY_CAP):
+        n_series = n_rows * n_cols
+        max_depth = memory_cap // max(n_series * BYTES_PER_SAMPLE, 1)
+        if depth > max_depth:
+            _logger.warning(f"History depth reduced from {depth} to {max_depth} samples to stay below "
+                            f"{memory_cap // (1024 * 1024)} MiB")
+            depth = max_depth
+        super().__init__(n_series, max(depth, 1))
+        self.n_cols = n_cols
+
+    def series(self, row: int, col: int) -> int:
+        return row * self.n_cols + col
+
+
+def _endpoints(times: np.ndarray, values: np.ndarray, n_out: int) -> Tuple[np.ndarray, np.ndarray]:
+    """The first and the last point when at most two are asked for, or only the last one"""
+    if n_out < 1:
+        raise ValueError(f"Cannot downsample to {n_out} points")
+    chosen = [0, len(times) - 1][-n_out:]
+    return times[chosen], values[chosen]
+
+
+def lttb(times: np.ndarray, values: np.ndarray, n_out: int) -> Tuple[np.ndarray, np.ndarray]:
+    """Largest-Triangle-Three-Buckets: n_out points that keep the visual shape of the series.
+
+    The choice in a bucket depends on the point chosen in the previous one, so buckets are walked in order,
+    but the areas inside a bucket and the bucket averages are computed with array operations.
+    """
+    n = len(times)
+    if n_out >= n:
+        return times, values
+    if n_out < 3:
+        return _endpoints(times, values, n_out)
+    x = times.astype(np.float64)
+    y = values.astype(np.float64)
+
+    # Inner buckets split points 1..n-2; the first and last point are always kept
+    edges = np.linspace(1, n - 1, n_out - 1).astype(np.int64)
+    sums_x = np.add.reduceat(x[1:n - 1], edges[:-1] - 1)
+    sums_y = np.add.reduceat(y[1:n - 1], edges[:-1] - 1)
+    sizes = np.diff(edges)
+    avg_x = np.append(sums_x / sizes, x[-1])  # the average of the bucket after the last one is the last point
+    avg_y = np.append(sums_y / sizes, y[-1])
+
+    chosen = np.empty(n_out, dtype=np.int64)
+    chosen[0], chosen[-1] = 0, n - 1
+    a = 0
+    for i in range(n_out - 2):
+        lo, hi = edges[i], edges[i + 1]
+        areas = np.abs((x[a] - avg_x[i + 1]) * (y[lo:hi] - y[a]) - (x[a] - x[lo:hi]) * (avg_y[i + 1] - y[a]))
+        a = lo + int(np.argmax(areas))
+        chosen[i + 1] = a
+    return times[chosen], values[chosen]
+
+
+def _first_where(mask: np.ndarray, buckets: np.ndarray, n_buckets: int) -> np.ndarray:
+    """Index of the first True of every bucket (each bucket has at least one)"""
+    index = np.flatnonzero(mask)
+    return index[np.searchsorted(buckets[index], np.arange(n_buckets))]
+
+
+def minmax(times: np.ndarray, values: np.ndarray, n_out: int) -> Tuple[np.ndarray, np.ndarray]:
+    """The minimum and the maximum of n_out // 2 equal-count buckets, in time order, fully vectorized"""
+    n = len(times)
+    n_buckets = n_out // 2
+    if n_out >= n:
+        return times, values
+    if n_buckets < 1:
+        return _endpoints(times, values, n_out)
+    buckets = np.arange(n) * n_buckets // n
+    starts = np.searchsorted(buckets, np.arange(n_buckets))
+
+    lowest = _first_where(values == np.minimum.reduceat(values, starts)[buckets], buckets, n_buckets)
+    highest = _first_where(values == np.maximum.reduceat(values, starts)[buckets], buckets, n_buckets)
+    chosen = np.unique(np.concatenate((lowest, highest)))  # sorted, so in time order
+    return times[chosen], values[chosen]
+
+
+DOWNSAMPLING = {"lttb": lttb, "minmax": minmax}